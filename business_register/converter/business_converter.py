@@ -58,7 +58,7 @@ class BusinessConverter(Converter):
         """
         status = status_from_record.lower()
         if status not in self.all_statuses_dict:
-            new_status = Status.objects.create(name=status)
+            new_status, created = self.get_or_create_reference(Status, name=status)
             self.all_statuses_dict[status] = new_status
             return new_status
         return self.all_statuses_dict[status]
@@ -69,7 +69,7 @@ class BusinessConverter(Converter):
         """
         authority = authority_from_record.lower()
         if authority not in self.all_authorities_dict:
-            new_authority = Authority.objects.create(name=authority)
+            new_authority, created = self.get_or_create_reference(Authority, name=authority)
             self.all_authorities_dict[authority] = new_authority
             return new_authority
         return self.all_authorities_dict[authority]
@@ -80,7 +80,7 @@ class BusinessConverter(Converter):
         """
         taxpayer_type = taxpayer_type_from_record.lower()
         if taxpayer_type not in self.all_taxpayer_types_dict:
-            new_taxpayer_type = TaxpayerType.objects.create(name=taxpayer_type)
+            new_taxpayer_type, created = self.get_or_create_reference(TaxpayerType, name=taxpayer_type)
             self.all_taxpayer_types_dict[taxpayer_type] = new_taxpayer_type
             return new_taxpayer_type
         return self.all_taxpayer_types_dict[taxpayer_type]
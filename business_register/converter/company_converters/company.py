@@ -150,11 +150,13 @@ class CompanyConverter(BusinessConverter):
         return None
 
     def create_company_type(self, name, name_eng):
-        company_type = CompanyType.objects.create(name=name, name_eng=name_eng)
+        company_type, created = self.get_or_create_reference(CompanyType, name=name, name_eng=name_eng)
         self.all_ukr_company_type_dict[name] = company_type
         self.all_eng_company_type_dict[name_eng] = company_type
-        print(f'New company type: id={company_type.id}, name={company_type.name}, name_eng={company_type.name_eng}')
-        send_new_company_type_message(company_type)
+        if created:
+            print(f'New company type: id={company_type.id}, name={company_type.name}, '
+                  f'name_eng={company_type.name_eng}')
+            send_new_company_type_message(company_type)
         return company_type
 
     def save_or_get_company_type(self, type_from_record, locale):
@@ -1,15 +1,21 @@
+import csv
 import logging
-from csv import DictReader
+import multiprocessing
+from collections import Counter
 
 import requests
 from django.conf import settings
+from django.db import connections
 from django.utils import timezone
 from lxml import html
 
 from business_register.converter.company_converters.company import CompanyConverter
 from business_register.models.company_models import Company
+from data_ocean.converter import (
+    UpsertManager, call_in_worker, get_line_shards, init_worker, iter_lines, soft_delete_by_ids
+)
 from data_ocean.downloader import Downloader
-from data_ocean.utils import format_date_to_yymmdd, to_lower_string_if_exists
+from data_ocean.utils import format_date_to_yymmdd
 
 # Standard instance of a logger with __name__
 from stats.tasks import endpoints_cache_warm_up
@@ -19,75 +25,124 @@ logger.setLevel(logging.DEBUG)
 
 
 class UkCompanyConverter(CompanyConverter):
-
-    def save_to_db(self, file):
-        with open(file, newline='') as csvfile:
-            index = 0
-
-            for row in DictReader(csvfile):
-                name = row['CompanyName'].lower()
-                # number is unique identifier in Company House
-                number = row[' CompanyNumber']
-                code = name + number
-                country = self.save_or_get_country(row['CountryOfOrigin'])
-                address = (
-                    f"{row['RegAddress.Country']} {row['RegAddress.PostCode']} "
-                    f"{row['RegAddress.County']} {row['RegAddress.PostTown']} "
-                    f"{row[' RegAddress.AddressLine2']} {row['RegAddress.AddressLine1']} "
-                    f"{row['RegAddress.POBox']} {row['RegAddress.CareOf']}"
-                )
-                company_type = self.save_or_get_company_type(row['CompanyCategory'], 'en')
-                status = self.save_or_get_status(row['CompanyStatus'])
-                if len(row['IncorporationDate']) == 10:
-                    registration_date = format_date_to_yymmdd(row['IncorporationDate'])
-                else:
-                    registration_date = None
-                source = Company.GREAT_BRITAIN_REGISTER
-                company = Company.objects.filter(edrpou=number, source=Company.GREAT_BRITAIN_REGISTER).first()
-                if not company:
-                    company = Company(
-                        name=name,
-                        company_type=company_type,
-                        edrpou=number,
-                        address=address,
-                        country=country,
-                        status=status,
-                        registration_date=registration_date,
-                        code=code,
-                        source=source
-                    )
-                    company.save()
-                else:
-                    update_fields = []
-                    if company.name != name:
-                        company.name = name
-                        update_fields.append('name')
-                    if company.company_type_id != company_type.id:
-                        company.company_type = company_type
-                        update_fields.append('company_type')
-                    if company.address != address:
-                        company.address = address
-                        update_fields.append('address')
-                    if company.country_id != country.id:
-                        company.country = country
-                        update_fields.append('country')
-                    if company.status_id != status.id:
-                        company.status = status
-                        update_fields.append('status')
-                    if to_lower_string_if_exists(company.registration_date) != registration_date:
-                        company.registration_date = registration_date
-                        update_fields.append('registration_date')
-                    if company.code != code:
-                        company.code = code
-                        update_fields.append('code')
-                    if company.source != source:
-                        company.source = source
-                        update_fields.append('source')
-                    if update_fields:
-                        update_fields.append('updated_at')
-                        company.save(update_fields=update_fields)
-
-            print('All companies from UK register were saved')
+    IMPORT_RUN_REGISTER = 'business_uk_company'
+    # the CSV file is split into shards of about SHARD_SIZE bytes that are saved by WORKERS processes
+    SHARD_SIZE = 32 * 1024 * 1024
+    WORKERS = 4
+    CHUNK_SIZE = 5000
+
+    def __init__(self):
+        super().__init__()
+        self.source = Company.GREAT_BRITAIN_REGISTER
+        self.fieldnames = None
+        self.upsert_manager = UpsertManager(
+            Company,
+            key_fields=('edrpou', 'source'),
+            update_fields=('name', 'company_type_id', 'address', 'country_id', 'status_id',
+                           'registration_date', 'code'),
+            run_field='last_seen_run',
+        )
+
+    def get_worker_state(self):
+        state = super().get_worker_state()
+        state['fieldnames'] = self.fieldnames
+        return state
+
+    def read_fieldnames(self, file):
+        # returns the offset of the first row
+        with open(file, 'rb') as csvfile:
+            header = csvfile.readline()
+        self.fieldnames = next(csv.reader([header.decode('utf-8-sig')]))
+        return len(header)
+
+    def save_to_db(self, file, workers=None):
+        workers = workers or self.WORKERS
+        self.start_import_run()
+        shards = get_line_shards(file, self.SHARD_SIZE, self.read_fieldnames(file))
+        counters = Counter()
+        if workers == 1:
+            for start, end in shards:
+                counters.update(self.save_shard(file, start, end))
+        else:
+            self.creation_lock = multiprocessing.get_context('fork').Lock()
+            # connections must not be shared with the forked workers
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(
+                    workers,
+                    initializer=init_worker,
+                    initargs=(type(self), self.get_worker_state())
+            ) as pool:
+                results = [pool.apply_async(call_in_worker, ('save_shard', file, start, end))
+                           for start, end in shards]
+                for result in results:
+                    counters.update(result.get())
+        logger.info(f'UK companies: {counters["rows"]} rows, {counters["inserted"]} new, '
+                     f'{counters["updated"]} changed')
+        self.delete_outdated()
+        self.import_run.finish()
+        print('All companies from UK register were saved')
+
+    def get_references(self, country, company_type, status):
+        # new names are created under creation_lock, see get_or_create_reference()
+        return (self.save_or_get_country(country), self.save_or_get_company_type(company_type, 'en'),
+                self.save_or_get_status(status))
+
+    def get_company_row(self, row):
+        name = row['CompanyName'].lower()
+        # number is unique identifier in Company House
+        number = row[' CompanyNumber']
+        country, company_type, status = self.get_references(
+            row['CountryOfOrigin'], row['CompanyCategory'], row['CompanyStatus']
+        )
+        address = (
+            f"{row['RegAddress.Country']} {row['RegAddress.PostCode']} "
+            f"{row['RegAddress.County']} {row['RegAddress.PostTown']} "
+            f"{row[' RegAddress.AddressLine2']} {row['RegAddress.AddressLine1']} "
+            f"{row['RegAddress.POBox']} {row['RegAddress.CareOf']}"
+        )
+        if len(row['IncorporationDate']) == 10:
+            registration_date = format_date_to_yymmdd(row['IncorporationDate'])
+        else:
+            registration_date = None
+        return {
+            'name': name,
+            'company_type_id': company_type.id,
+            'edrpou': number,
+            'address': address,
+            'country_id': country.id,
+            'status_id': status.id,
+            'registration_date': registration_date,
+            'code': name + number,
+            'source': self.source,
+            'last_seen_run': self.import_run.id,
+        }
+
+    def save_shard(self, file, start, end):
+        """ saves the rows of the [start, end) byte range of the file, returns the counters of the shard """
+        counters = Counter()
+        company_rows = {}
+        for row in csv.DictReader(iter_lines(file, start, end), fieldnames=self.fieldnames):
+            # the last row of the company wins
+            company_rows[row[' CompanyNumber']] = self.get_company_row(row)
+            counters['rows'] += 1
+            if len(company_rows) >= self.CHUNK_SIZE:
+                self.save_companies(company_rows, counters)
+                company_rows = {}
+        self.save_companies(company_rows, counters)
+        return counters
+
+    def save_companies(self, company_rows, counters):
+        result = self.upsert_manager.upsert(list(company_rows.values()))
+        counters['inserted'] += len(result.inserted)
+        counters['updated'] += len(result.updated)
+
+    def delete_outdated(self):
+        # companies that were not stamped with the current run are not in the file anymore
+        outdated_companies = Company.objects.filter(
+            source=self.source
+        ).exclude(last_seen_run=self.import_run.id).values_list('id', flat=True)
+        deleted = soft_delete_by_ids(outdated_companies, [(Company, 'id')])
+        logger.info(f'UK companies: {deleted.get(Company._meta.label, 0)} outdated records deleted')
 
 
 class UkCompanyDownloader(Downloader):
@@ -113,13 +168,17 @@ class UkCompanyDownloader(Downloader):
         logger.info(f'{self.reg_name}: Update started...')
 
         self.report_init()
-        self.download()
+        if not self.download():
+            self.report_not_modified()
+            return
 
         self.report.update_start = timezone.now()
         self.report.save()
 
         logger.info(f'{self.reg_name}: save_to_db({self.file_path}) started ...')
-        UkCompanyConverter().save_to_db(self.file_path)
+        converter = UkCompanyConverter()
+        converter.report = self.report
+        converter.save_to_db(self.file_path)
         logger.info(f'{self.reg_name}: save_to_db({self.file_path}) finished successfully.')
 
         self.report.update_finish = timezone.now()
@@ -42,7 +42,7 @@ class UkrCompanyConverter(CompanyConverter):
 
     def save_or_get_bylaw(self, bylaw_from_record):
         if bylaw_from_record not in self.all_bylaw_dict:
-            new_bylaw = Bylaw.objects.create(name=bylaw_from_record)
+            new_bylaw, created = self.get_or_create_reference(Bylaw, name=bylaw_from_record)
             self.all_bylaw_dict[bylaw_from_record] = new_bylaw
             return new_bylaw
         return self.all_bylaw_dict[bylaw_from_record]
@@ -781,7 +781,9 @@ class UkrCompanyDownloader(Downloader):
         logger.info(f'{self.reg_name}: Update started...')
 
         self.report_init()
-        self.download()
+        if not self.download():
+            self.report_not_modified()
+            return
 
         self.report.update_start = timezone.now()
         self.report.save()
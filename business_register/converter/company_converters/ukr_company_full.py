@@ -4,18 +4,24 @@ import requests
 from time import sleep
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 
 from business_register.converter.company_converters.company import CompanyConverter
+from business_register.converter.record_schemas import UKR_COMPANY_FULL
 from business_register.models.company_models import (
     Assignee, BancruptcyReadjustment, Bylaw, Company, CompanyDetail, CompanyToKved,
     CompanyToPredecessor, ExchangeDataCompany, Founder, Predecessor,
     Signer, TerminationStarted
 )
-from data_ocean.converter import BulkCreateManager
+from data_ocean.converter import (
+    BulkCreateManager, BulkUpdateManager, FingerprintManager, UpsertManager, soft_delete_by_ids
+)
 from data_ocean.downloader import Downloader
-from data_ocean.utils import (cut_first_word, format_date_to_yymmdd, get_first_word,
-                              to_lower_string_if_exists, log_records)
+from data_ocean.utils import (
+    cut_first_word, format_date_to_yymmdd, get_first_word, log_records, to_lower_string_if_exists
+)
 from location_register.converter.address import AddressConverter
 from stats.tasks import endpoints_cache_warm_up
 
@@ -28,14 +34,20 @@ class UkrCompanyFullConverter(CompanyConverter):
     Uncomment for switch Timer ON.
     """
     # timing = True
+    PARALLEL_COUNTERS = ('invalid_data_counter', 'records_skipped', 'records_processed')
+    IMPORT_RUN_REGISTER = 'business_ukr_company'
 
     def __init__(self):
         self.LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_FULL
         self.LOCAL_FOLDER = settings.LOCAL_FOLDER
         self.CHUNK_SIZE = settings.CHUNK_SIZE_UO_FULL
         self.RECORD_TAG = 'SUBJECT'
-        self.bulk_manager = BulkCreateManager()
+        # millions of these rows are written during the first import, COPY is much faster for them
+        self.bulk_manager = BulkCreateManager(
+            copy_models=(Company, Founder, Signer, CompanyToKved, ExchangeDataCompany)
+        )
         self.branch_bulk_manager = BulkCreateManager()
+        self.update_manager = BulkUpdateManager()
         self.all_bylaw_dict = self.put_objects_to_dict("name", "business_register", "Bylaw")
         self.all_predecessors_dict = self.put_objects_to_dict("name", "business_register", "Predecessor")
         self.all_companies_dict = {}
@@ -51,32 +63,44 @@ class UkrCompanyFullConverter(CompanyConverter):
         self.assignee_to_dict = {}
         self.exchange_data_to_dict = {}
         self.branches_to_dict = {}
+        self.prefetch_stored_children([])
         self.company_country = AddressConverter().save_or_get_country('Ukraine')
         self.source = Company.UKRAINE_REGISTER
-        self.already_stored_companies =\
-            list(Company.objects.filter(source=Company.UKRAINE_REGISTER).values_list('id', flat=True))
-        self.uptodated_companies = []
+        self.company_upsert_manager = UpsertManager(
+            Company,
+            key_fields=('code', 'source'),
+            update_fields=('name', 'short_name', 'company_type_id', 'authorized_capital', 'address',
+                           'status_id', 'bylaw_id', 'registration_date', 'registration_info',
+                           'contact_info', 'authority_id', 'country_id'),
+            run_field='last_seen_run',
+        )
+        self.fingerprint_manager = FingerprintManager('business_ukr_company')
+        # stored branches found in the records of the chunk, stamped with the run at the end of the chunk
+        self.seen_branches = []
         self.invalid_data_counter = 0
+        self.records_skipped = 0
+        self.records_processed = 0
+        self.records_deleted = 0
         super().__init__()
 
     def save_or_get_bylaw(self, bylaw_from_record):
         if bylaw_from_record not in self.all_bylaw_dict:
-            new_bylaw = Bylaw.objects.create(name=bylaw_from_record)
+            new_bylaw, created = self.get_or_create_reference(Bylaw, name=bylaw_from_record)
             self.all_bylaw_dict[bylaw_from_record] = new_bylaw
             return new_bylaw
         return self.all_bylaw_dict[bylaw_from_record]
 
     def save_or_get_predecessor(self, item):
-        if item.xpath('NAME')[0].text not in self.all_predecessors_dict or \
-                (hasattr(self.all_predecessors_dict, item.xpath('NAME')[0].text) and item.xpath('CODE')[0].text != \
-                 self.all_predecessors_dict[item.xpath('NAME')[0].text].code):
+        if item.name not in self.all_predecessors_dict or \
+                (hasattr(self.all_predecessors_dict, item.name) and item.code != \
+                 self.all_predecessors_dict[item.name].code):
             new_predecessor = Predecessor.objects.create(
-                name=item.xpath('NAME')[0].text.lower(),
-                edrpou=item.xpath('CODE')[0].text
+                name=item.name.lower(),
+                edrpou=item.code
             )
-            self.all_predecessors_dict[item.xpath('NAME')[0].text] = new_predecessor
+            self.all_predecessors_dict[item.name] = new_predecessor
             return new_predecessor
-        return self.all_predecessors_dict[item.xpath('NAME')[0].text]
+        return self.all_predecessors_dict[item.name]
 
     def extract_detail_founder_data(self, founder_info):
         info_to_list = founder_info.split(',')
@@ -149,27 +173,28 @@ class UkrCompanyFullConverter(CompanyConverter):
 
     def add_founders(self, founders_from_record, beneficiaries_from_record, code):
         self.founder_to_dict[code] = []
-        for item in founders_from_record:
-            info = item.text
+        # matched beneficiaries are removed from the copy
+        beneficiaries_from_record = list(beneficiaries_from_record)
+        for info in founders_from_record:
             # checking if field contains data
             if not info or info.endswith('ВІДСУТНІЙ'):
                 continue
             # checking if there is additional data except name
-            if ',' in item.text:
-                name, edrpou, address, equity = self.extract_detail_founder_data(item.text)
+            if ',' in info:
+                name, edrpou, address, equity = self.extract_detail_founder_data(info)
                 name = name.lower()
             else:
-                name = item.text.lower()
+                name = info.lower()
                 edrpou, equity, address = None, None, None
             country = None
             is_beneficiary = False
             info_beneficiary = None
             for beneficiary in beneficiaries_from_record:
                 name_beneficiary, country_beneficiary, address_beneficiary, edrpou_beneficiary =\
-                    self.extract_beneficiary_data(beneficiary.text)
+                    self.extract_beneficiary_data(beneficiary)
                 name_beneficiary = name_beneficiary.lower()
                 if name_beneficiary == name:
-                    info_beneficiary = beneficiary.text
+                    info_beneficiary = beneficiary
                     country = country_beneficiary.lower()
                     address = address_beneficiary
                     edrpou = edrpou_beneficiary or edrpou
@@ -190,9 +215,9 @@ class UkrCompanyFullConverter(CompanyConverter):
             self.founder_to_dict[code].append(founder)
         for beneficiary in beneficiaries_from_record:
             name_beneficiary, country_beneficiary, address_beneficiary, edrpou_beneficiary = \
-                self.extract_beneficiary_data(beneficiary.text)
+                self.extract_beneficiary_data(beneficiary)
             name = name_beneficiary.lower()
-            info_beneficiary = beneficiary.text
+            info_beneficiary = beneficiary
             country = country_beneficiary.lower() if country_beneficiary else None
             address = address_beneficiary
             founder = Founder(
@@ -207,28 +232,28 @@ class UkrCompanyFullConverter(CompanyConverter):
             self.founder_to_dict[code].append(founder)
 
     def update_founders(self, founders_from_record, beneficiaries_from_record, company):
-        already_stored_founders = list(Founder.include_deleted_objects.filter(company_id=company.id))
-        for item in founders_from_record:
-            info = item.text
+        already_stored_founders = list(self.stored_founders[company.id])
+        beneficiaries_from_record = list(beneficiaries_from_record)
+        for info in founders_from_record:
             # checking if field contains data
             if not info or info.endswith('ВІДСУТНІЙ'):
                 continue
             # checking if there is additional data except name
-            if ',' in item.text:
-                name, edrpou, address, equity = self.extract_detail_founder_data(item.text)
+            if ',' in info:
+                name, edrpou, address, equity = self.extract_detail_founder_data(info)
                 name = name.lower()
             else:
-                name = item.text.lower()
+                name = info.lower()
                 edrpou, equity, address = None, None, None
             country = None
             is_beneficiary = False
             info_beneficiary = None
             for beneficiary in beneficiaries_from_record:
                 name_beneficiary, country_beneficiary, address_beneficiary, edrpou_beneficiary = \
-                    self.extract_beneficiary_data(beneficiary.text)
+                    self.extract_beneficiary_data(beneficiary)
                 name_beneficiary = name_beneficiary.lower()
                 if name_beneficiary == name:
-                    info_beneficiary = beneficiary.text
+                    info_beneficiary = beneficiary
                     country = country_beneficiary.lower()
                     address = address_beneficiary
                     edrpou = edrpou_beneficiary or edrpou
@@ -264,8 +289,7 @@ class UkrCompanyFullConverter(CompanyConverter):
                                 stored_founder.deleted_at = None
                                 update_fields.append('deleted_at')
                             if update_fields:
-                                update_fields.append('updated_at')
-                                stored_founder.save(update_fields=update_fields)
+                                self.update_manager.add(stored_founder, update_fields)
                         already_stored_founders.remove(stored_founder)
                         break
             if not already_stored:
@@ -284,9 +308,9 @@ class UkrCompanyFullConverter(CompanyConverter):
                 self.bulk_manager.add(founder)
         for beneficiary in beneficiaries_from_record:
             name_beneficiary, country_beneficiary, address_beneficiary, edrpou_beneficiary = \
-                self.extract_beneficiary_data(beneficiary.text)
+                self.extract_beneficiary_data(beneficiary)
             name = name_beneficiary.lower()
-            info_beneficiary = beneficiary.text
+            info_beneficiary = beneficiary
             if country_beneficiary:
                 country_beneficiary = country_beneficiary.lower()
             already_stored = False
@@ -306,8 +330,7 @@ class UkrCompanyFullConverter(CompanyConverter):
                             if stored_founder.deleted_at:
                                 stored_founder.deleted_at = None
                                 update_fields.append('deleted_at')
-                            update_fields.append('updated_at')
-                            stored_founder.save(update_fields=update_fields)
+                            self.update_manager.add(stored_founder, update_fields)
                         already_stored_founders.remove(stored_founder)
                         break
             if not already_stored:
@@ -327,7 +350,7 @@ class UkrCompanyFullConverter(CompanyConverter):
                 self.bulk_manager.add(founder)
         if len(already_stored_founders):
             for outdated_founder in already_stored_founders:
-                outdated_founder.soft_delete()
+                self.update_manager.soft_delete(outdated_founder)
 
     def add_company_detail(self, founding_document_number, executive_power, superior_management,
                            managing_paper, terminated_info, termination_cancel_info, vp_dates,
@@ -345,7 +368,7 @@ class UkrCompanyFullConverter(CompanyConverter):
     def update_company_detail(self, founding_document_number, executive_power, superior_management,
                               managing_paper, terminated_info, termination_cancel_info, vp_dates,
                               company):
-        company_detail = CompanyDetail.include_deleted_objects.filter(company_id=company.id).first()
+        company_detail = next(iter(self.stored_company_details[company.id]), None)
         if company_detail:
             update_fields = []
             if company_detail.founding_document_number != founding_document_number:
@@ -373,8 +396,7 @@ class UkrCompanyFullConverter(CompanyConverter):
                 company_detail.deleted_at = None
                 update_fields.append('deleted_at')
             if len(update_fields):
-                update_fields.append('updated_at')
-                company_detail.save(update_fields=update_fields)
+                self.update_manager.add(company_detail, update_fields)
         else:
             company_detail = CompanyDetail()
             company_detail.founding_document_number = founding_document_number
@@ -391,11 +413,11 @@ class UkrCompanyFullConverter(CompanyConverter):
         assignees = []
         for item in assignees_from_record:
             assignee = Assignee()
-            if item.xpath('NAME')[0].text:
-                assignee.name = item.xpath('NAME')[0].text.lower()
+            if item.name:
+                assignee.name = item.name.lower()
             else:
                 assignee.name = ''
-            assignee.edrpou = item.xpath('CODE')[0].text
+            assignee.edrpou = item.code
             if not assignee.edrpou:
                 assignee.edrpou = ''
             if assignee.name or assignee.edrpou:
@@ -403,14 +425,14 @@ class UkrCompanyFullConverter(CompanyConverter):
         self.assignee_to_dict[code] = assignees
 
     def update_assignees(self, assignees_from_record, company):
-        already_stored_assignees = list(Assignee.include_deleted_objects.filter(company_id=company.id))
+        already_stored_assignees = list(self.stored_assignees[company.id])
         for item in assignees_from_record:
-            name = item.xpath('NAME')[0].text
+            name = item.name
             if name:
                 name = name.lower()
             else:
                 name = ''
-            edrpou = item.xpath('CODE')[0].text
+            edrpou = item.code
             if not edrpou:
                 edrpou = ''
             if not name and not edrpou:
@@ -422,7 +444,7 @@ class UkrCompanyFullConverter(CompanyConverter):
                         already_stored = True
                         if stored_assignee.deleted_at:
                             stored_assignee.deleted_at = None
-                            stored_assignee.save(update_fields=['deleted_at', 'updated_at'])
+                            self.update_manager.add(stored_assignee, ['deleted_at'])
                         already_stored_assignees.remove(stored_assignee)
                         break
             if not already_stored:
@@ -433,113 +455,97 @@ class UkrCompanyFullConverter(CompanyConverter):
                 self.bulk_manager.add(assignee)
         if len(already_stored_assignees):
             for outdated_assignees in already_stored_assignees:
-                outdated_assignees.soft_delete()
+                self.update_manager.soft_delete(outdated_assignees)
 
     def add_branches(self, branches_from_record, code):
         branches = []
         for item in branches_from_record:
-            branch = Company()
-            if item.xpath('CODE'):
-                branch.edrpou = item.xpath('CODE')[0].text or ''
-            else:
-                branch.edrpou = ''
-            if item.xpath('NAME'):
-                branch.name = item.xpath('NAME')[0].text or ''
-            else:
+            if not item.name:
                 continue
-            branch.address = item.xpath('ADDRESS')[0].text
-            branch.registration_date = format_date_to_yymmdd(item.xpath('CREATE_DATE')[0].text)
-            if item.xpath('CONTACTS'):
-                branch.contact_info = item.xpath('CONTACTS')[0].text
+            branch = Company()
+            branch.edrpou = item.code or ''
+            branch.name = item.name
+            branch.address = item.address
+            branch.registration_date = format_date_to_yymmdd(item.create_date)
+            branch.contact_info = item.contacts
             branch.code = branch.edrpou + branch.name
+            branch.last_seen_run = self.import_run.id
             branches.append(branch)
-            if item.xpath('SIGNER'):
-                self.add_signers([item.xpath('SIGNER')[0]], branch.code)
-            if item.xpath('ACTIVITY_KINDS'):
-                self.add_company_to_kved(item.xpath('ACTIVITY_KINDS')[0], branch.code)
-            self.add_exchange_data(item.xpath('EXCHANGE_DATA')[0], branch.code)
+            if item.signer:
+                self.add_signers([item.signer], branch.code)
+            if item.activity_kinds:
+                self.add_company_to_kved(item.activity_kinds, branch.code)
+            self.add_exchange_data(item.exchange_data, branch.code)
         self.branches_to_dict[code] = branches
 
     def update_branches(self, branches_from_record, company):
-        already_stored_branches = list(Company.include_deleted_objects.filter(parent_id=company.id))
+        already_stored_branches = list(self.stored_branches[company.id])
         for item in branches_from_record:
             already_stored = False
             if len(already_stored_branches):
                 for branch in already_stored_branches:
-                    if branch.name == item.xpath('NAME')[0].text and \
-                            branch.edrpou == item.xpath('CODE')[0].text:
+                    if branch.name == item.name and branch.edrpou == item.code:
                         already_stored = True
-                        self.uptodated_companies.append(branch.id)
+                        self.seen_branches.append(branch.id)
                         update_fields = []
-                        if branch.address != item.xpath('ADDRESS')[0].text:
-                            branch.address = item.xpath('ADDRESS')[0].text
+                        if branch.address != item.address:
+                            branch.address = item.address
                             update_fields.append('address')
-                        if branch.registration_date != format_date_to_yymmdd(item.xpath('CREATE_DATE')[0].text):
-                            branch.address = format_date_to_yymmdd(item.xpath('CREATE_DATE')[0].text)
+                        registration_date = format_date_to_yymmdd(item.create_date)
+                        if to_lower_string_if_exists(branch.registration_date) != registration_date:
+                            branch.registration_date = registration_date
                             update_fields.append('registration_date')
-                        if item.xpath('CONTACTS') and branch.contact_info != item.xpath('CONTACTS')[0].text:
-                            branch.contact_info = item.xpath('CONTACTS')[0].text
+                        if item.contacts and branch.contact_info != item.contacts:
+                            branch.contact_info = item.contacts
                             update_fields.append('contact_info')
                         if branch.deleted_at:
                             branch.deleted_at = None
                             update_fields.append('deleted_at')
                         if len(update_fields):
-                            update_fields.append('updated_at')
-                            branch.save(update_fields=update_fields)
-                        if item.xpath('SIGNER'):
-                            self.update_signers([item.xpath('SIGNER')[0]], branch)
-                        if item.xpath('ACTIVITY_KINDS'):
-                            self.update_company_to_kved(item.xpath('ACTIVITY_KINDS')[0], branch)
-                        self.update_exchange_data(item.xpath('EXCHANGE_DATA')[0], branch)
+                            self.update_manager.add(branch, update_fields)
+                        if item.signer:
+                            self.update_signers([item.signer], branch)
+                        if item.activity_kinds:
+                            self.update_company_to_kved(item.activity_kinds, branch)
+                        self.update_exchange_data(item.exchange_data, branch)
             if not already_stored:
-                branch = Company()
-                if item.xpath('CODE'):
-                    branch.edrpou = item.xpath('CODE')[0].text or ''
-                else:
-                    branch.edrpou = ''
-                if item.xpath('NAME'):
-                    branch.name = item.xpath('NAME')[0].text or ''
-                else:
+                if not item.name:
                     continue
-                branch.address = item.xpath('ADDRESS')[0].text
-                branch.registration_date = format_date_to_yymmdd(item.xpath('CREATE_DATE')[0].text)
-                if item.xpath('CONTACTS'):
-                    branch.contact_info = item.xpath('CONTACTS')[0].text
+                branch = Company()
+                branch.edrpou = item.code or ''
+                branch.name = item.name
+                branch.address = item.address
+                branch.registration_date = format_date_to_yymmdd(item.create_date)
+                branch.contact_info = item.contacts
                 branch.code = branch.edrpou + branch.name
+                branch.last_seen_run = self.import_run.id
+                branch.parent = company
                 self.bulk_manager.add(branch)
-                if item.xpath('SIGNER'):
-                    self.add_signers([item.xpath('SIGNER')[0]], branch.code)
-                if item.xpath('ACTIVITY_KINDS'):
-                    self.add_company_to_kved(item.xpath('ACTIVITY_KINDS')[0], branch.code)
-                self.add_exchange_data(item.xpath('EXCHANGE_DATA')[0], branch.code)
+                if item.signer:
+                    self.add_signers([item.signer], branch.code)
+                if item.activity_kinds:
+                    self.add_company_to_kved(item.activity_kinds, branch.code)
+                self.add_exchange_data(item.exchange_data, branch.code)
 
-    def add_bancruptcy_readjustment(self, record, code):
+    def add_bancruptcy_readjustment(self, info, code):
         bancruptcy_readjustment = BancruptcyReadjustment()
-        bancruptcy_readjustment.op_date = format_date_to_yymmdd(
-            record.xpath('BANKRUPTCY_READJUSTMENT_INFO/OP_DATE')[0].text) or None
-        bancruptcy_readjustment.reason = record.xpath(
-            'BANKRUPTCY_READJUSTMENT_INFO/REASON')[0].text.lower()
-        bancruptcy_readjustment.sbj_state = record.xpath(
-            'BANKRUPTCY_READJUSTMENT_INFO/SBJ_STATE')[0].text.lower()
-        if record.xpath('BANKRUPTCY_READJUSTMENT_INFO/BANKRUPTCY_READJUSTMENT_HEAD_NAME'):
-            head_name = record.xpath('BANKRUPTCY_READJUSTMENT_INFO/BANKRUPTCY_READJUSTMENT_HEAD_NAME')[0].text
-            if head_name:
-                bancruptcy_readjustment.head_name = head_name.lower()
+        bancruptcy_readjustment.op_date = format_date_to_yymmdd(info.op_date) or None
+        bancruptcy_readjustment.reason = info.reason.lower()
+        bancruptcy_readjustment.sbj_state = info.sbj_state.lower()
+        if info.bankruptcy_readjustment_head_name:
+            bancruptcy_readjustment.head_name = info.bankruptcy_readjustment_head_name.lower()
         self.bancruptcy_readjustment_to_dict[code] = bancruptcy_readjustment
 
-    def update_bancruptcy_readjustment(self, record, company):
+    def update_bancruptcy_readjustment(self, info, company):
         already_stored_bancruptcy_readjustment = \
-            BancruptcyReadjustment.include_deleted_objects.filter(company_id=company.id).first()
-        if record.xpath('BANKRUPTCY_READJUSTMENT_INFO/OP_DATE'):
-            op_date = format_date_to_yymmdd(record.xpath('BANKRUPTCY_READJUSTMENT_INFO/OP_DATE')[0].text) or None
-            reason = record.xpath('BANKRUPTCY_READJUSTMENT_INFO/REASON')[0].text.lower()
-            sbj_state = record.xpath('BANKRUPTCY_READJUSTMENT_INFO/SBJ_STATE')[0].text.lower()
-            if record.xpath('BANKRUPTCY_READJUSTMENT_INFO/BANKRUPTCY_READJUSTMENT_HEAD_NAME'):
-                head_name = record.xpath('BANKRUPTCY_READJUSTMENT_INFO/BANKRUPTCY_READJUSTMENT_HEAD_NAME')[0].text
-                if head_name:
-                    head_name = head_name.lower()
-            else:
-                head_name = None
+            next(iter(self.stored_bancruptcy_readjustments[company.id]), None)
+        if info and info.op_date:
+            op_date = format_date_to_yymmdd(info.op_date) or None
+            reason = info.reason.lower()
+            sbj_state = info.sbj_state.lower()
+            head_name = info.bankruptcy_readjustment_head_name
+            if head_name:
+                head_name = head_name.lower()
             if not already_stored_bancruptcy_readjustment:
                 bancruptcy_readjustment = BancruptcyReadjustment()
                 bancruptcy_readjustment.company = company
@@ -567,40 +573,31 @@ class UkrCompanyFullConverter(CompanyConverter):
                     already_stored_bancruptcy_readjustment.deleted_at = None
                     update_fields.append('deleted_at')
                 if len(update_fields):
-                    update_fields.append('updated_at')
-                    already_stored_bancruptcy_readjustment.save(update_fields=update_fields)
+                    self.update_manager.add(already_stored_bancruptcy_readjustment, update_fields)
         elif already_stored_bancruptcy_readjustment:
-            already_stored_bancruptcy_readjustment.soft_delete()
+            self.update_manager.soft_delete(already_stored_bancruptcy_readjustment)
 
     def add_company_to_kved(self, kveds_from_record, code):
         company_to_kveds = []
         for item in kveds_from_record:
-            if not item.xpath('NAME'):
-                continue
-            kved_code = item.xpath('CODE')[0].text
-            kved_name = item.xpath('NAME')[0].text
+            kved_name = item.name
             if not kved_name:
                 continue
-            if not kved_code:
-                kved_code = ''
+            kved_code = item.code or ''
             company_to_kved = CompanyToKved()
             company_to_kved.kved = self.get_kved_from_DB(kved_code, kved_name)
-            if item.xpath('PRIMARY'):
-                company_to_kved.primary_kved = item.xpath('PRIMARY')[0].text == "так"
+            company_to_kved.primary_kved = item.primary == "так"
             company_to_kveds.append(company_to_kved)
         self.company_to_kved_to_dict[code] = company_to_kveds
 
     def update_company_to_kved(self, kveds_from_record, company):
-        already_stored_company_to_kved = list(CompanyToKved.include_deleted_objects.filter(company_id=company.id))
+        already_stored_company_to_kved = list(self.stored_company_to_kveds[company.id])
         for item in kveds_from_record:
-            if not item.xpath('NAME'):
-                continue
-            kved_code = item.xpath('CODE')[0].text
-            kved_name = item.xpath('NAME')[0].text
+            kved_name = item.name
             if not kved_name:
                 continue
-            if not kved_code:
-                kved_code = ''
+            kved_code = item.code or ''
+            primary_kved = item.primary == "так"
             already_stored = False
             kved_from_db = self.get_kved_from_DB(kved_code, kved_name)
             if len(already_stored_company_to_kved):
@@ -608,68 +605,55 @@ class UkrCompanyFullConverter(CompanyConverter):
                     if stored_company_to_kved.kved_id == kved_from_db.id:
                         already_stored = True
                         update_fields = []
-                        if item.xpath('PRIMARY'):
-                            if stored_company_to_kved.primary_kved != (item.xpath('PRIMARY')[0].text == "так"):
-                                stored_company_to_kved.primary_kved = item.xpath('PRIMARY')[0].text == "так"
-                                update_fields.append('primary_kved')
+                        if stored_company_to_kved.primary_kved != primary_kved:
+                            stored_company_to_kved.primary_kved = primary_kved
+                            update_fields.append('primary_kved')
                         if stored_company_to_kved.deleted_at:
                             stored_company_to_kved.deleted_at = None
                             update_fields.append('deleted_at')
                         if len(update_fields):
-                            update_fields.append('updated_at')
-                            stored_company_to_kved.save(update_fields=update_fields)
+                            self.update_manager.add(stored_company_to_kved, update_fields)
                         already_stored_company_to_kved.remove(stored_company_to_kved)
                         break
             if not already_stored:
                 company_to_kved = CompanyToKved()
                 company_to_kved.company = company
                 company_to_kved.kved = kved_from_db
-                if item.xpath('PRIMARY'):
-                    company_to_kved.primary_kved = item.xpath('PRIMARY')[0].text == "так"
+                company_to_kved.primary_kved = primary_kved
                 self.bulk_manager.add(company_to_kved)
         if len(already_stored_company_to_kved):
             for outdated_company_to_kved in already_stored_company_to_kved:
-                outdated_company_to_kved.soft_delete()
+                self.update_manager.soft_delete(outdated_company_to_kved)
 
     def add_exchange_data(self, exchange_data_from_record, code):
         exchange_datas = []
         for item in exchange_data_from_record:
-            if item.xpath('AUTHORITY_NAME') and item.xpath('AUTHORITY_NAME')[0].text:
+            if item.authority_name:
                 exchange_data = ExchangeDataCompany()
-                exchange_data.authority = self.save_or_get_authority(item.xpath(
-                    'AUTHORITY_NAME')[0].text)
-                if item.xpath('TAX_PAYER_TYPE'):
-                    taxpayer_type = item.xpath('TAX_PAYER_TYPE')[0].text
-                    exchange_data.taxpayer_type = self.save_or_get_taxpayer_type(taxpayer_type)
-                if item.xpath('START_DATE'):
-                    exchange_data.start_date = format_date_to_yymmdd(
-                        item.xpath('START_DATE')[0].text) or None
-                if item.xpath('START_NUM'):
-                    exchange_data.start_number = item.xpath('START_NUM')[0].text
-                if item.xpath('END_DATE'):
-                    exchange_data.end_date = format_date_to_yymmdd(
-                        item.xpath('END_DATE')[0].text) or None
-                if item.xpath('END_NUM'):
-                    exchange_data.end_number = item.xpath('END_NUM')[0].text
+                exchange_data.authority = self.save_or_get_authority(item.authority_name)
+                if item.tax_payer_type:
+                    exchange_data.taxpayer_type = self.save_or_get_taxpayer_type(item.tax_payer_type)
+                exchange_data.start_date = format_date_to_yymmdd(item.start_date) or None
+                exchange_data.start_number = item.start_num
+                exchange_data.end_date = format_date_to_yymmdd(item.end_date) or None
+                exchange_data.end_number = item.end_num
                 exchange_datas.append(exchange_data)
             self.exchange_data_to_dict[code] = exchange_datas
 
     def update_exchange_data(self, exchange_data_from_record, company):
-        already_stored_exchange_data = list(ExchangeDataCompany.include_deleted_objects.filter(company_id=company.id))
+        already_stored_exchange_data = list(self.stored_exchange_data[company.id])
         for item in exchange_data_from_record:
-            if not item.xpath('NAME'):
+            # the same check as in add_exchange_data, there is no NAME in EXCHANGE_ANSWER
+            if not item.authority_name:
                 continue
-            authority = self.save_or_get_authority(item.xpath('AUTHORITY_NAME')[0].text)
-            taxpayer_type = item.xpath('TAX_PAYER_TYPE')[0].text
-            start_date, end_date = None, None
-            if taxpayer_type:
-                taxpayer_type = self.save_or_get_taxpayer_type(taxpayer_type)
-            if item.xpath('START_DATE')[0].text:
-                start_date = format_date_to_yymmdd(item.xpath('START_DATE')[0].text) or None
-            start_number = item.xpath('START_NUM')[0].text
-            if item.xpath('END_DATE')[0].text:
-                end_date = format_date_to_yymmdd(item.xpath('END_DATE')[0].text) or None
-            end_number = item.xpath('END_NUM')[0].text
+            authority = self.save_or_get_authority(item.authority_name)
+            taxpayer_type = None
+            if item.tax_payer_type:
+                taxpayer_type = self.save_or_get_taxpayer_type(item.tax_payer_type)
+            start_date = format_date_to_yymmdd(item.start_date) or None
+            start_number = item.start_num
+            end_date = format_date_to_yymmdd(item.end_date) or None
+            end_number = item.end_num
             already_stored = False
             if len(already_stored_exchange_data):
                 for stored_exchange_data in already_stored_exchange_data:
@@ -680,7 +664,7 @@ class UkrCompanyFullConverter(CompanyConverter):
                         if stored_exchange_data.start_number != start_number:
                             stored_exchange_data.start_number = start_number
                             update_fields.append('start_number')
-                        if stored_exchange_data.taxpayer_type_id != taxpayer_type.id:
+                        if stored_exchange_data.taxpayer_type_id != (taxpayer_type.id if taxpayer_type else None):
                             stored_exchange_data.taxpayer_type = taxpayer_type
                             update_fields.append('taxpayer_type')
                         if stored_exchange_data.end_date != end_date:
@@ -693,9 +677,9 @@ class UkrCompanyFullConverter(CompanyConverter):
                             stored_exchange_data.deleted_at = None
                             update_fields.append('deleted_at')
                         if len(update_fields):
-                            update_fields.append('updated_at')
-                            stored_exchange_data.save(update_fields=update_fields)
+                            self.update_manager.add(stored_exchange_data, update_fields)
                         already_stored_exchange_data.remove(stored_exchange_data)
+                        break
             if not already_stored:
                 exchange_data = ExchangeDataCompany()
                 exchange_data.authority = authority
@@ -708,12 +692,12 @@ class UkrCompanyFullConverter(CompanyConverter):
                 self.bulk_manager.add(exchange_data)
         if len(already_stored_exchange_data):
             for outdated_exchange_data in already_stored_exchange_data:
-                outdated_exchange_data.soft_delete()
+                self.update_manager.soft_delete(outdated_exchange_data)
 
     def add_company_to_predecessors(self, predecessors_from_record, code):
         company_to_predecessors = []
         for item in predecessors_from_record:
-            if item.xpath('NAME')[0].text:
+            if item.name:
                 company_to_predecessor = CompanyToPredecessor()
                 company_to_predecessor.predecessor = self.save_or_get_predecessor(item)
                 company_to_predecessors.append(company_to_predecessor)
@@ -721,9 +705,9 @@ class UkrCompanyFullConverter(CompanyConverter):
 
     def update_company_to_predecessors(self, predecessors_from_record, company):
         already_stored_company_to_predecessors = \
-            list(CompanyToPredecessor.include_deleted_objects.filter(company_id=company.id))
+            list(self.stored_company_to_predecessors[company.id])
         for item in predecessors_from_record:
-            if item.xpath('NAME')[0].text:
+            if item.name:
                 already_stored = False
                 predecessor = self.save_or_get_predecessor(item)
                 if len(already_stored_company_to_predecessors):
@@ -732,7 +716,7 @@ class UkrCompanyFullConverter(CompanyConverter):
                             already_stored = True
                             if stored_predecessor.deleted_at:
                                 stored_predecessor.deleted_at = None
-                                stored_predecessor.save(update_fields=['deleted_at', 'updated_at'])
+                                self.update_manager.add(stored_predecessor, ['deleted_at'])
                             already_stored_company_to_predecessors.remove(stored_predecessor)
                             break
                 if not already_stored:
@@ -742,74 +726,59 @@ class UkrCompanyFullConverter(CompanyConverter):
                     self.bulk_manager.add(company_to_predecessor)
         if len(already_stored_company_to_predecessors):
             for outdated_company_to_predecessors in already_stored_company_to_predecessors:
-                outdated_company_to_predecessors.soft_delete()
+                self.update_manager.soft_delete(outdated_company_to_predecessors)
 
     def add_signers(self, signers_from_record, code):
         signers = []
         for item in signers_from_record:
             signer = Signer()
-            signer.name = item.text[:389].lower()
+            signer.name = item[:389].lower()
             signers.append(signer)
         self.signer_to_dict[code] = signers
 
     def update_signers(self, signers_from_record, company):
-        already_stored_signers = list(Signer.include_deleted_objects.filter(company_id=company.id))
+        already_stored_signers = list(self.stored_signers[company.id])
         for item in signers_from_record:
             already_stored = False
             if len(already_stored_signers):
                 for stored_signer in already_stored_signers:
-                    if stored_signer.name == item.text[:389].lower():
+                    if stored_signer.name == item[:389].lower():
                         already_stored = True
                         if stored_signer.deleted_at:
                             stored_signer.deleted_at = None
-                            stored_signer.save(update_fields=['deleted_at', 'updated_at'])
+                            self.update_manager.add(stored_signer, ['deleted_at'])
                         already_stored_signers.remove(stored_signer)
                         break
             if not already_stored:
                 signer = Signer()
-                signer.name = item.text[:389].lower()
+                signer.name = item[:389].lower()
                 signer.company = company
                 self.bulk_manager.add(signer)
         if len(already_stored_signers):
             for outdated_signers in already_stored_signers:
-                outdated_signers.soft_delete()
+                self.update_manager.soft_delete(outdated_signers)
 
-    def add_termination_started(self, record, code):
+    def add_termination_started(self, info, code):
         termination_started = TerminationStarted()
-        if record.xpath('TERMINATION_STARTED_INFO/OP_DATE')[0].text:
-            termination_started.op_date = format_date_to_yymmdd(
-                record.xpath('TERMINATION_STARTED_INFO/OP_DATE')[0].text) or None
-        termination_started.reason = record.xpath('TERMINATION_STARTED_INFO'
-                                                  '/REASON')[0].text.lower()
-        termination_started.sbj_state = record.xpath(
-            'TERMINATION_STARTED_INFO/SBJ_STATE')[0].text.lower()
-        if record.xpath('TERMINATION_STARTED_INFO/SIGNER_NAME'):
-            signer_name = record.xpath('TERMINATION_STARTED_INFO/SIGNER_NAME')[0].text
-            if signer_name:
-                termination_started.signer_name = signer_name.lower()
-        if record.xpath('TERMINATION_STARTED_INFO/CREDITOR_REQ_END_DATE'):
-            termination_started.creditor_reg_end_date = format_date_to_yymmdd(
-                record.xpath('TERMINATION_STARTED_INFO/CREDITOR_REQ_END_DATE')[0].text) or '1990-01-01'
+        termination_started.op_date = format_date_to_yymmdd(info.op_date) or None
+        termination_started.reason = info.reason.lower()
+        termination_started.sbj_state = info.sbj_state.lower()
+        if info.signer_name:
+            termination_started.signer_name = info.signer_name.lower()
+        termination_started.creditor_reg_end_date = format_date_to_yymmdd(info.creditor_req_end_date) or '1990-01-01'
         self.termination_started_to_dict[code] = termination_started
 
-    def update_termination_started(self, record, company):
+    def update_termination_started(self, info, company):
         already_stored_termination_started = \
-            TerminationStarted.include_deleted_objects.filter(company_id=company.id).first()
-        if record.xpath('TERMINATION_STARTED_INFO/OP_DATE'):
-            op_date = format_date_to_yymmdd(record.xpath('TERMINATION_STARTED_INFO/OP_DATE')[0].text) or None
-            reason = record.xpath('TERMINATION_STARTED_INFO/REASON')[0].text.lower()
-            sbj_state = record.xpath('TERMINATION_STARTED_INFO/SBJ_STATE')[0].text.lower()
-            if record.xpath('TERMINATION_STARTED_INFO/SIGNER_NAME'):
-                signer_name = record.xpath('TERMINATION_STARTED_INFO/SIGNER_NAME')[0].text
-                if signer_name:
-                    signer_name = signer_name.lower()
-            else:
-                signer_name = None
-            if record.xpath('TERMINATION_STARTED_INFO/CREDITOR_REQ_END_DATE'):
-                creditor_reg_end_date = format_date_to_yymmdd(
-                    record.xpath('TERMINATION_STARTED_INFO/CREDITOR_REQ_END_DATE')[0].text) or '1990-01-01'
-            else:
-                creditor_reg_end_date = '1990-01-01'
+            next(iter(self.stored_terminations_started[company.id]), None)
+        if info and info.op_date:
+            op_date = format_date_to_yymmdd(info.op_date) or None
+            reason = info.reason.lower()
+            sbj_state = info.sbj_state.lower()
+            signer_name = info.signer_name
+            if signer_name:
+                signer_name = signer_name.lower()
+            creditor_reg_end_date = format_date_to_yymmdd(info.creditor_req_end_date) or '1990-01-01'
             if not already_stored_termination_started:
                 termination_started = TerminationStarted()
                 termination_started.company = company
@@ -841,311 +810,337 @@ class UkrCompanyFullConverter(CompanyConverter):
                     already_stored_termination_started.deleted_at = None
                     update_fields.append('deleted_at')
                 if len(update_fields):
-                    update_fields.append('updated_at')
-                    already_stored_termination_started.save(update_fields=update_fields)
+                    self.update_manager.add(already_stored_termination_started, update_fields)
         elif already_stored_termination_started:
-            already_stored_termination_started.soft_delete()
+            self.update_manager.soft_delete(already_stored_termination_started)
+
+    def prefetch_stored_children(self, company_ids):
+        # one query per table for the whole chunk instead of a few queries per company
+        self.stored_branches = self.put_objects_to_dict_of_lists(
+            'parent_id', Company.include_deleted_objects.filter(parent_id__in=company_ids)
+        )
+        # signers, kveds and exchange data of the branches are updated as well
+        branch_ids = [branch.id for branches in self.stored_branches.values() for branch in branches]
+        ids = list(company_ids) + branch_ids
+        self.stored_founders = self.put_objects_to_dict_of_lists(
+            'company_id', Founder.include_deleted_objects.filter(company_id__in=company_ids)
+        )
+        self.stored_company_details = self.put_objects_to_dict_of_lists(
+            'company_id', CompanyDetail.include_deleted_objects.filter(company_id__in=company_ids).order_by('id')
+        )
+        self.stored_assignees = self.put_objects_to_dict_of_lists(
+            'company_id', Assignee.include_deleted_objects.filter(company_id__in=company_ids)
+        )
+        self.stored_bancruptcy_readjustments = self.put_objects_to_dict_of_lists(
+            'company_id',
+            BancruptcyReadjustment.include_deleted_objects.filter(company_id__in=company_ids).order_by('id')
+        )
+        self.stored_company_to_kveds = self.put_objects_to_dict_of_lists(
+            'company_id', CompanyToKved.include_deleted_objects.filter(company_id__in=ids)
+        )
+        self.stored_exchange_data = self.put_objects_to_dict_of_lists(
+            'company_id', ExchangeDataCompany.include_deleted_objects.filter(company_id__in=ids)
+        )
+        self.stored_company_to_predecessors = self.put_objects_to_dict_of_lists(
+            'company_id', CompanyToPredecessor.include_deleted_objects.filter(company_id__in=company_ids)
+        )
+        self.stored_signers = self.put_objects_to_dict_of_lists(
+            'company_id', Signer.include_deleted_objects.filter(company_id__in=ids)
+        )
+        self.stored_terminations_started = self.put_objects_to_dict_of_lists(
+            'company_id',
+            TerminationStarted.include_deleted_objects.filter(company_id__in=company_ids).order_by('id')
+        )
+
+    def save_references(self, record):
+        # names with a unique index are created before the transaction of the chunk, otherwise a worker
+        # creating the same name would wait for the commit while holding creation_lock
+        exchange_data = list(record.exchange_data or [])
+        for branch in record.branches or []:
+            exchange_data.extend(branch.exchange_data or [])
+        for item in exchange_data:
+            if item.authority_name:
+                self.save_or_get_authority(item.authority_name)
+                if item.tax_payer_type:
+                    self.save_or_get_taxpayer_type(item.tax_payer_type)
+
+    def add_company_children(self, record, company_detail, code):
+        self.add_company_detail(*company_detail, code)
+        if record.activity_kinds:
+            self.add_company_to_kved(record.activity_kinds, code)
+        if record.signers:
+            self.add_signers(record.signers, code)
+        if record.termination_started_info and record.termination_started_info.op_date:
+            self.add_termination_started(record.termination_started_info, code)
+        if record.bankruptcy_readjustment_info and record.bankruptcy_readjustment_info.op_date:
+            self.add_bancruptcy_readjustment(record.bankruptcy_readjustment_info, code)
+        if record.predecessors:
+            self.add_company_to_predecessors(record.predecessors, code)
+        if record.assignees:
+            self.add_assignees(record.assignees, code)
+        if record.exchange_data:
+            self.add_exchange_data(record.exchange_data, code)
+        self.add_founders(record.founders, record.beneficiaries, code)
+        if record.branches:
+            self.add_branches(record.branches, code)
+
+    def update_company_children(self, record, company_detail, company):
+        self.update_company_detail(*company_detail, company)
+        self.time_it('update company details\t')
+        self.update_founders(record.founders, record.beneficiaries, company)
+        self.time_it('update founders\t\t')
+        self.update_company_to_kved(record.activity_kinds, company)
+        self.time_it('update kveds\t\t')
+        self.update_signers(record.signers, company)
+        self.time_it('update signers\t\t')
+        self.update_termination_started(record.termination_started_info, company)
+        self.time_it('update termination\t')
+        self.update_bancruptcy_readjustment(record.bankruptcy_readjustment_info, company)
+        self.time_it('update bancruptcy\t')
+        self.update_company_to_predecessors(record.predecessors, company)
+        self.time_it('update predecessors\t')
+        self.update_assignees(record.assignees, company)
+        self.time_it('update assignes\t\t')
+        self.update_exchange_data(record.exchange_data, company)
+        self.time_it('update exchange data\t')
+        self.update_branches(record.branches, company)
+
+    def get_record_key(self, element):
+        name = element.findtext('NAME')
+        edrpou = element.findtext('EDRPOU')
+        if not name or not edrpou:
+            return None
+        return name.lower() + edrpou
 
     def save_to_db(self, records):
-        for record in records:
-            edrpou = record.xpath('EDRPOU')[0].text
+        records, unchanged_companies = self.fingerprint_manager.filter_changed(records, self.get_record_key)
+        self.records_skipped += len(unchanged_companies)
+        self.records_processed += len(records)
+        if len(unchanged_companies):
+            # unchanged companies and their branches are still in the register
+            unchanged_ids = [company_id for company_id in unchanged_companies.values() if company_id]
+            Company.include_deleted_objects.filter(
+                Q(id__in=unchanged_ids) | Q(parent_id__in=unchanged_ids)
+            ).update(last_seen_run=self.import_run.id)
+        self.time_it('filter unchanged\t')
+        company_rows = {}
+        company_records = {}
+        for element in records:
+            record = UKR_COMPANY_FULL.extract(element)
+            edrpou = record.edrpou
             if not edrpou:
                 self.invalid_data_counter += 1
-                log_records(record, self.LOCAL_FOLDER + 'invalid_companies.txt', self.invalid_data_counter)
+                log_records(element, self.LOCAL_FOLDER + 'invalid_companies.txt', self.invalid_data_counter)
                 continue
-            if record.xpath('NAME')[0].text:
-                name = record.xpath('NAME')[0].text.lower()
+            if record.name:
+                name = record.name.lower()
             else:
                 self.invalid_data_counter += 1
-                log_records(record, self.LOCAL_FOLDER + 'invalid_companies.txt', self.invalid_data_counter)
+                log_records(element, self.LOCAL_FOLDER + 'invalid_companies.txt', self.invalid_data_counter)
                 continue
             code = name + edrpou
-            address = record.xpath('ADDRESS')[0].text
-            founding_document_number = record.xpath('FOUNDING_DOCUMENT_NUM')[0].text
-            contact_info = record.xpath('CONTACTS')[0].text
-            vp_dates = record.xpath('VP_DATES')[0].text
-            short_name = record.xpath('SHORT_NAME')[0].text
+            address = record.address
+            founding_document_number = record.founding_document_num
+            contact_info = record.contacts
+            vp_dates = record.vp_dates
+            short_name = record.short_name
             if short_name:
                 short_name = short_name.lower()
-            executive_power = record.xpath('EXECUTIVE_POWER')[0].text
+            executive_power = record.executive_power
             if executive_power:
                 executive_power = executive_power.lower()
-            superior_management = record.xpath('SUPERIOR_MANAGEMENT')[0].text
+            superior_management = record.superior_management
             if superior_management:
                 superior_management = superior_management.lower()
-            managing_paper = record.xpath('MANAGING_PAPER')[0].text
+            managing_paper = record.managing_paper
             if managing_paper:
                 managing_paper = managing_paper.lower()
-            terminated_info = record.xpath('TERMINATED_INFO')[0].text
+            terminated_info = record.terminated_info
             if terminated_info:
                 terminated_info = terminated_info.lower()
-            termination_cancel_info = record.xpath('TERMINATION_CANCEL_INFO')[0].text
+            termination_cancel_info = record.termination_cancel_info
             if termination_cancel_info:
                 termination_cancel_info = termination_cancel_info.lower()
-            authorized_capital = record.xpath('AUTHORIZED_CAPITAL')[0].text
+            authorized_capital = record.authorized_capital
             if authorized_capital:
                 authorized_capital = authorized_capital.replace(',', '.')
                 authorized_capital = float(authorized_capital)
             registration_date = None
             registration_info = None
-            registration = record.xpath('REGISTRATION')[0].text
+            registration = record.registration
             if registration:
                 registration_date = format_date_to_yymmdd(get_first_word(registration))
                 registration_info = cut_first_word(registration)
-            company_type = record.xpath('OPF')[0].text
+            company_type = record.opf
             if company_type:
                 company_type = self.save_or_get_company_type(company_type, 'uk')
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            bylaw = self.save_or_get_bylaw(record.xpath('STATUTE')[0].text)
-            authority = record.xpath('CURRENT_AUTHORITY')[0].text
+            status = self.save_or_get_status(record.stan)
+            bylaw = self.save_or_get_bylaw(record.statute)
+            authority = record.current_authority
             if authority:
                 authority = self.save_or_get_authority(authority)
             else:
                 authority = None
+            self.save_references(record)
             self.time_it('getting data from record')
+            # the last record of the company in the chunk wins
+            company_rows[code] = {
+                'name': name,
+                'short_name': short_name,
+                'company_type_id': company_type.id if company_type else None,
+                'edrpou': edrpou,
+                'country_id': self.company_country.id,
+                'address': address,
+                'authorized_capital': authorized_capital,
+                'status_id': status.id,
+                'bylaw_id': bylaw.id,
+                'registration_date': registration_date,
+                'registration_info': registration_info,
+                'contact_info': contact_info,
+                'authority_id': authority.id if authority else None,
+                'source': self.source,
+                'code': code,
+                'last_seen_run': self.import_run.id,
+            }
+            company_records[code] = (
+                record,
+                (founding_document_number, executive_power, superior_management, managing_paper,
+                 terminated_info, termination_cancel_info, vp_dates)
+            )
 
-            company = Company.include_deleted_objects.filter(code=code, source=Company.UKRAINE_REGISTER).first()
-            self.time_it('trying get companies\t')
+        # the companies are saved together with their children, a failed chunk leaves no company without them
+        with transaction.atomic():
+            upsert_result = self.company_upsert_manager.upsert(list(company_rows.values()))
+            self.time_it('upsert companies\t')
 
-            if not company:
-                company = Company(
-                    name=name,
-                    short_name=short_name,
-                    company_type=company_type,
-                    edrpou=edrpou,
-                    country=self.company_country,
-                    address=address,
-                    authorized_capital=authorized_capital,
-                    status=status,
-                    bylaw=bylaw,
-                    registration_date=registration_date,
-                    registration_info=registration_info,
-                    contact_info=contact_info,
-                    authority=authority,
-                    source=self.source,
-                    code=code
-                )
-                self.bulk_manager.add(company)
-                self.add_company_detail(founding_document_number, executive_power, superior_management, managing_paper,
-                                        terminated_info, termination_cancel_info, vp_dates, code)
-                if len(record.xpath('ACTIVITY_KINDS')[0]):
-                    self.add_company_to_kved(record.xpath('ACTIVITY_KINDS')[0], code)
-                if len(record.xpath('SIGNERS')[0]):
-                    self.add_signers(record.xpath('SIGNERS')[0], code)
-                if record.xpath('TERMINATION_STARTED_INFO/OP_DATE'):
-                    self.add_termination_started(record, code)
-                if record.xpath('BANKRUPTCY_READJUSTMENT_INFO/OP_DATE'):
-                    self.add_bancruptcy_readjustment(record, code)
-                if len(record.xpath('PREDECESSORS')[0]):
-                    self.add_company_to_predecessors(record.xpath('PREDECESSORS')[0], code)
-                if len(record.xpath('ASSIGNEES')[0]):
-                    self.add_assignees(record.xpath('ASSIGNEES')[0], code)
-                if len(record.xpath('EXCHANGE_DATA')[0]):
-                    self.add_exchange_data(record.xpath('EXCHANGE_DATA')[0], code)
-                self.add_founders(record.xpath('FOUNDERS')[0] if len(record.xpath('FOUNDERS')[0]) else [],
-                                  record.xpath('BENEFICIARIES')[0] if len(record.xpath('BENEFICIARIES')[0]) else [],
-                                  code)
-                if len(record.xpath('BRANCHES')[0]):
-                    self.add_branches(record.xpath('BRANCHES')[0], code)
-                self.time_it('save companies\t')
-            else:
-                self.uptodated_companies.append(company.id)
-                update_fields = []
-                if company.name != name:
-                    company.name = name
-                    update_fields.append('name')
-                if company.short_name != short_name:
-                    company.short_name = short_name
-                    update_fields.append('short_name')
-                if company_type:
-                    if company.company_type_id != company_type.id:
-                        company.company_type = company_type
-                        update_fields.append('company_type')
-                elif company.company_type_id:
-                    company.company_type = None
-                    update_fields.append('company_type')
-                if company.authorized_capital != authorized_capital:
-                    company.authorized_capital = authorized_capital
-                    update_fields.append('authorized_capital')
-                if company.address != address:
-                    company.address = address
-                    update_fields.append('address')
-                if company.status_id != status.id:
-                    company.status = status
-                    update_fields.append('status')
-                if company.bylaw_id != bylaw.id:
-                    company.bylaw = bylaw
-                    update_fields.append('bylaw')
-                if to_lower_string_if_exists(company.registration_date) != registration_date:
-                    company.registration_date = registration_date
-                    update_fields.append('registration_date')
-                if company.registration_info != registration_info:
-                    company.registration_info = registration_info
-                    update_fields.append('registration_info')
-                if company.contact_info != contact_info:
-                    company.contact_info = contact_info
-                    update_fields.append('contact_info')
-                if authority:
-                    if company.authority_id != authority.id:
-                        company.authority = authority
-                        update_fields.append('authority')
-                else:
-                    if company.authority_id:
-                        company.authority = None
-                        update_fields.append('authority')
-                if company.country_id != self.company_country.id:
-                    company.country = self.company_country
-                    update_fields.append('country')
-                if company.deleted_at:
-                    company.deleted_at = None
-                    update_fields.append('deleted_at')
-                if update_fields:
-                    update_fields.append('updated_at')
-                    company.save(update_fields=update_fields)
-                self.time_it('update companies\t')
-                self.update_company_detail(founding_document_number, executive_power, superior_management,
-                                           managing_paper, terminated_info, termination_cancel_info, vp_dates, company)
-                self.time_it('update company details\t')
-                self.update_founders(
-                    record.xpath('FOUNDERS')[0] if len(record.xpath('FOUNDERS')[0]) else [],
-                    record.xpath('BENEFICIARIES')[0] if len(record.xpath('BENEFICIARIES')[0]) else [],
-                    company
-                )
-                self.time_it('update founders\t\t')
-                self.update_company_to_kved(record.xpath('ACTIVITY_KINDS')[0], company)
-                self.time_it('update kveds\t\t')
-                self.update_signers(record.xpath('SIGNERS')[0], company)
-                self.time_it('update signers\t\t')
-                self.update_termination_started(record, company)
-                self.time_it('update termination\t')
-                self.update_bancruptcy_readjustment(record, company)
-                self.time_it('update bancruptcy\t')
-                self.update_company_to_predecessors(record.xpath('PREDECESSORS')[0], company)
-                self.time_it('update predecessors\t')
-                self.update_assignees(record.xpath('ASSIGNEES')[0], company)
-                self.time_it('update assignes\t\t')
-                self.update_exchange_data(record.xpath('EXCHANGE_DATA')[0], company)
-                self.time_it('update exchange data\t')
-                self.update_branches(record.xpath('BRANCHES')[0], company)
+            new_companies = {}
+            for (code, source), company_id in upsert_result.inserted.items():
+                record, company_detail = company_records[code]
+                self.add_company_children(record, company_detail, code)
+                new_companies[code] = company_id
+                self.fingerprint_manager.add(code, company_id)
+            self.time_it('save companies\t')
 
-        if len(self.bulk_manager.queues['business_register.Company']):
-            self.bulk_manager.commit(Company)
-        saved_companies = self.bulk_manager.queues['business_register.Company']
-        self.bulk_manager.queues['business_register.Company'] = []
-        for company in saved_companies:
-            code = company.code
-            if code in self.branches_to_dict:
-                for branch in self.branches_to_dict[code]:
-                    branch.parent = company
-                    self.bulk_manager.add(branch)
-        if len(self.bulk_manager.queues['business_register.Company']):
-            self.bulk_manager.commit(Company)
-        saved_companies.extend(self.bulk_manager.queues['business_register.Company'])
-        for company in saved_companies:
-            code = company.code
-            if code in self.founder_to_dict:
-                for founder in self.founder_to_dict[code]:
-                    founder.company = company
-                    self.bulk_manager.add(founder)
-            if code in self.signer_to_dict:
-                for signer in self.signer_to_dict[code]:
-                    signer.company = company
-                    self.bulk_manager.add(signer)
-            if code in self.assignee_to_dict:
-                for assignee in self.assignee_to_dict[code]:
-                    assignee.company = company
-                    self.bulk_manager.add(assignee)
-            if code in self.company_to_predecessor_to_dict:
-                for company_to_predecessor in self.company_to_predecessor_to_dict[code]:
-                    company_to_predecessor.company = company
-                    self.bulk_manager.add(company_to_predecessor)
-            if code in self.exchange_data_to_dict:
-                for exchange_data in self.exchange_data_to_dict[code]:
-                    exchange_data.company = company
-                    self.bulk_manager.add(exchange_data)
-            if code in self.company_to_kved_to_dict:
-                for company_to_kved in self.company_to_kved_to_dict[code]:
-                    company_to_kved.company = company
-                    self.bulk_manager.add(company_to_kved)
-            if code in self.company_detail_to_dict:
-                self.company_detail_to_dict[code].company = company
-                self.bulk_manager.add(self.company_detail_to_dict[code])
-            if code in self.termination_started_to_dict:
-                self.termination_started_to_dict[code].company = company
-                self.bulk_manager.add(self.termination_started_to_dict[code])
-            if code in self.bancruptcy_readjustment_to_dict:
-                self.bancruptcy_readjustment_to_dict[code].company = company
-                self.bulk_manager.add(self.bancruptcy_readjustment_to_dict[code])
-        self.bulk_manager.commit(Founder)
-        self.bulk_manager.commit(Signer)
-        self.bulk_manager.commit(Assignee)
-        self.bulk_manager.commit(CompanyToPredecessor)
-        self.bulk_manager.commit(ExchangeDataCompany)
-        self.bulk_manager.commit(CompanyToKved)
-        self.bulk_manager.commit(CompanyDetail)
-        self.bulk_manager.commit(TerminationStarted)
-        self.bulk_manager.commit(BancruptcyReadjustment)
-        self.bulk_manager.queues['business_register.Company'] = []
-        self.bulk_manager.queues['business_register.Founder'] = []
-        self.bulk_manager.queues['business_register.Signer'] = []
-        self.bulk_manager.queues['business_register.Assignee'] = []
-        self.bulk_manager.queues['business_register.CompanyToPredecessor'] = []
-        self.bulk_manager.queues['business_register.ExchangeDataCompany'] = []
-        self.bulk_manager.queues['business_register.CompanyToKved'] = []
-        self.bulk_manager.queues['business_register.CompanyDetail'] = []
-        self.bulk_manager.queues['business_register.TerminationStarted'] = []
-        self.bulk_manager.queues['business_register.BancruptcyReadjustment'] = []
-        self.founder_to_dict = {}
-        self.company_detail_to_dict = {}
-        self.company_to_kved_to_dict = {}
-        self.signer_to_dict = {}
-        self.termination_started_to_dict = {}
-        self.bancruptcy_readjustment_to_dict = {}
-        self.company_to_predecessor_to_dict = {}
-        self.assignee_to_dict = {}
-        self.exchange_data_to_dict = {}
-        self.branches_to_dict = {}
+            stored_companies = {**upsert_result.updated, **upsert_result.unchanged}
+            companies = Company.include_deleted_objects.in_bulk(list(stored_companies.values()))
+            self.prefetch_stored_children(list(companies))
+            self.time_it('prefetch children\t')
+            for (code, source), company_id in stored_companies.items():
+                record, company_detail = company_records[code]
+                self.update_company_children(record, company_detail, companies[company_id])
+                self.fingerprint_manager.add(code, company_id)
+
+            self.update_manager.commit()
+            # new branches of the stored companies are already in the queue
+            for code, company_id in new_companies.items():
+                if code in self.branches_to_dict:
+                    for branch in self.branches_to_dict[code]:
+                        branch.parent_id = company_id
+                        self.bulk_manager.add(branch)
+            if len(self.bulk_manager.queues['business_register.Company']):
+                self.bulk_manager.commit(Company)
+            for branch in self.bulk_manager.queues['business_register.Company']:
+                new_companies[branch.code] = branch.id
+            for code, company_id in new_companies.items():
+                if code in self.founder_to_dict:
+                    for founder in self.founder_to_dict[code]:
+                        founder.company_id = company_id
+                        self.bulk_manager.add(founder)
+                if code in self.signer_to_dict:
+                    for signer in self.signer_to_dict[code]:
+                        signer.company_id = company_id
+                        self.bulk_manager.add(signer)
+                if code in self.assignee_to_dict:
+                    for assignee in self.assignee_to_dict[code]:
+                        assignee.company_id = company_id
+                        self.bulk_manager.add(assignee)
+                if code in self.company_to_predecessor_to_dict:
+                    for company_to_predecessor in self.company_to_predecessor_to_dict[code]:
+                        company_to_predecessor.company_id = company_id
+                        self.bulk_manager.add(company_to_predecessor)
+                if code in self.exchange_data_to_dict:
+                    for exchange_data in self.exchange_data_to_dict[code]:
+                        exchange_data.company_id = company_id
+                        self.bulk_manager.add(exchange_data)
+                if code in self.company_to_kved_to_dict:
+                    for company_to_kved in self.company_to_kved_to_dict[code]:
+                        company_to_kved.company_id = company_id
+                        self.bulk_manager.add(company_to_kved)
+                if code in self.company_detail_to_dict:
+                    self.company_detail_to_dict[code].company_id = company_id
+                    self.bulk_manager.add(self.company_detail_to_dict[code])
+                if code in self.termination_started_to_dict:
+                    self.termination_started_to_dict[code].company_id = company_id
+                    self.bulk_manager.add(self.termination_started_to_dict[code])
+                if code in self.bancruptcy_readjustment_to_dict:
+                    self.bancruptcy_readjustment_to_dict[code].company_id = company_id
+                    self.bulk_manager.add(self.bancruptcy_readjustment_to_dict[code])
+            self.bulk_manager.commit(Founder)
+            self.bulk_manager.commit(Signer)
+            self.bulk_manager.commit(Assignee)
+            self.bulk_manager.commit(CompanyToPredecessor)
+            self.bulk_manager.commit(ExchangeDataCompany)
+            self.bulk_manager.commit(CompanyToKved)
+            self.bulk_manager.commit(CompanyDetail)
+            self.bulk_manager.commit(TerminationStarted)
+            self.bulk_manager.commit(BancruptcyReadjustment)
+            self.bulk_manager.queues['business_register.Company'] = []
+            self.bulk_manager.queues['business_register.Founder'] = []
+            self.bulk_manager.queues['business_register.Signer'] = []
+            self.bulk_manager.queues['business_register.Assignee'] = []
+            self.bulk_manager.queues['business_register.CompanyToPredecessor'] = []
+            self.bulk_manager.queues['business_register.ExchangeDataCompany'] = []
+            self.bulk_manager.queues['business_register.CompanyToKved'] = []
+            self.bulk_manager.queues['business_register.CompanyDetail'] = []
+            self.bulk_manager.queues['business_register.TerminationStarted'] = []
+            self.bulk_manager.queues['business_register.BancruptcyReadjustment'] = []
+            self.founder_to_dict = {}
+            self.company_detail_to_dict = {}
+            self.company_to_kved_to_dict = {}
+            self.signer_to_dict = {}
+            self.termination_started_to_dict = {}
+            self.bancruptcy_readjustment_to_dict = {}
+            self.company_to_predecessor_to_dict = {}
+            self.assignee_to_dict = {}
+            self.exchange_data_to_dict = {}
+            self.branches_to_dict = {}
+            if self.seen_branches:
+                Company.include_deleted_objects.filter(id__in=self.seen_branches).update(last_seen_run=self.import_run.id)
+                self.seen_branches = []
+            self.fingerprint_manager.commit()
         self.time_it('save others\t\t')
 
     def delete_outdated(self):
-        outdated_companies = list(set(self.already_stored_companies) - set(self.uptodated_companies))
-        for company_id in outdated_companies:
-            if CompanyDetail.objects.filter(company_id=company_id).first():
-                CompanyDetail.objects.filter(company_id=company_id).first().soft_delete()
-            if CompanyToPredecessor.objects.filter(company_id=company_id).first():
-                CompanyToPredecessor.objects.filter(company_id=company_id).first().soft_delete()
-            if TerminationStarted.objects.filter(company_id=company_id).first():
-                TerminationStarted.objects.filter(company_id=company_id).first().soft_delete()
-            if BancruptcyReadjustment.objects.filter(company_id=company_id).first():
-                BancruptcyReadjustment.objects.filter(company_id=company_id).first().soft_delete()
-            outdated_founders = list(Founder.objects.filter(company_id=company_id))
-            if len(outdated_founders):
-                for founder in outdated_founders:
-                    founder.soft_delete()
-            outdated_signers = list(Signer.objects.filter(company_id=company_id))
-            if len(outdated_signers):
-                for signer in outdated_signers:
-                    signer.soft_delete()
-            outdated_assignees = list(Assignee.objects.filter(company_id=company_id))
-            if len(outdated_assignees):
-                for assignee in outdated_assignees:
-                    assignee.soft_delete()
-            outdated_exchange_data = list(ExchangeDataCompany.objects.filter(company_id=company_id))
-            if len(outdated_exchange_data):
-                for exchange_data in outdated_exchange_data:
-                    exchange_data.soft_delete()
-            outdated_company_to_kved = list(CompanyToKved.objects.filter(company_id=company_id))
-            if len(outdated_company_to_kved):
-                for company_to_kved in outdated_company_to_kved:
-                    company_to_kved.soft_delete()
-            Company.objects.get(id=company_id).soft_delete()
+        if not self.import_run:
+            return
+        # companies that were not stamped with the current run, selected by the DB only
+        outdated_companies = Company.objects.filter(
+            source=Company.UKRAINE_REGISTER
+        ).exclude(last_seen_run=self.import_run.id).values_list('id', flat=True)
+        self.fingerprint_manager.forget(outdated_companies)
+        deleted = soft_delete_by_ids(outdated_companies, [
+            (CompanyDetail, 'company_id'),
+            (CompanyToPredecessor, 'company_id'),
+            (TerminationStarted, 'company_id'),
+            (BancruptcyReadjustment, 'company_id'),
+            (Founder, 'company_id'),
+            (Signer, 'company_id'),
+            (Assignee, 'company_id'),
+            (ExchangeDataCompany, 'company_id'),
+            (CompanyToKved, 'company_id'),
+            (Company, 'id'),
+        ])
+        for model_label, count in deleted.items():
+            logger.info(f'{model_label}: {count} outdated records deleted')
+        self.records_deleted = deleted.get(Company._meta.label, 0)
 
 
 class UkrCompanyFullDownloader(Downloader):
     reg_name = 'business_ukr_company'
     zip_required_file_sign = 'ufop_full'
     unzip_required_file_sign = 'EDR_UO_FULL'
-    unzip_after_download = True
+    stream_from_zip = True
+    download_segments = 4
     source_dataset_url = settings.BUSINESS_UKR_COMPANY_SOURCE_PACKAGE
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_FULL
 
@@ -1163,27 +1158,36 @@ class UkrCompanyFullDownloader(Downloader):
     def get_source_file_name(self):
         return self.url.split('/')[-1]
 
-    def update(self):
+    def update(self, ignore_fingerprints=False):
+        """ ignore_fingerprints - save all the records of a new dump, also the ones not changed since the last one """
 
         logger.info(f'{self.reg_name}: Update started...')
 
-        self.report_init()
-        self.report.long_time_converter = True
-        self.report.save()
-        self.download()
-
-        self.LOCAL_FILE_NAME = self.file_name
-        self.remove_unreadable_characters()
+        self.report = self.get_unfinished_report()
+        if self.report:
+            checkpoint = (self.report.checkpoint_offset, self.report.checkpoint_index)
+            logger.info(f'{self.reg_name}: resuming the interrupted update from the record {checkpoint[1]}')
+        else:
+            checkpoint = None
+            self.report_init()
+            self.report.long_time_converter = True
+            self.report.save()
+            if not self.download():
+                self.report_not_modified()
+                return
 
-        self.report.update_start = timezone.now()
-        self.report.save()
+            self.report.update_start = timezone.now()
+            self.report.save()
 
         logger.info(f'{self.reg_name}: process() with {self.file_path} started ...')
         ukr_company_full = UkrCompanyFullConverter()
-        ukr_company_full.LOCAL_FILE_NAME = self.file_name
+        ukr_company_full.source_opener = self.open_source_stream
+        ukr_company_full.report = self.report
+        if ignore_fingerprints and not checkpoint:
+            ukr_company_full.fingerprint_manager.clear()
 
         sleep(5)
-        if ukr_company_full.process():
+        if ukr_company_full.process(checkpoint=checkpoint):
             logger.info(f'{self.reg_name}: process() with {self.file_path} finished successfully.')
             self.report.update_status = True
             self.report.update_finish = timezone.now()
@@ -1202,7 +1206,12 @@ class UkrCompanyFullDownloader(Downloader):
             logger.info(f'{self.reg_name}: Update total records finished successfully.')
 
             self.report.invalid_data = ukr_company_full.invalid_data_counter
+            self.report.records_skipped = ukr_company_full.records_skipped
+            self.report.records_processed = ukr_company_full.records_processed
             self.measure_company_changes(Company.UKRAINE_REGISTER)
+            # companies soft-deleted by delete_outdated(), they are not in the dump anymore
+            self.report.records_deleted = ukr_company_full.records_deleted
+            self.report.save()
             logger.info(f'{self.reg_name}: Report created successfully.')
 
             logger.info(f'{self.reg_name}: Update finished successfully.')
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+
+from django.db import connection
+
+from business_register.models.company_models import Company
+
+
+class CompanyResolver:
+    """
+    Finds companies of our register by edrpou for the declarations. All the codes of a declaration
+    are selected by one query in prefetch(), results are kept in an LRU cache of MAX_SIZE codes
+    for the next declarations, because the same banks and employers are in thousands of declarations.
+    Companies that are not from our register are created with one bulk_create by save_companies().
+    """
+    MAX_SIZE = 100000
+    # keys of the declaration steps with codes of ukrainian companies
+    CODE_KEYS = {
+        'ua_company_code', 'reestrCode', 'emitent_ua_company_code', 'establishment_ua_company_code',
+        'organization_ua_company_code', 'source_ua_company_code', 'beneficial_owner_company_code',
+        'ua_company_code_beneficial_owner', 'company_code_beneficial_owner', 'corporate_rights_company_code',
+        'persons_ua_company_code',
+    }
+    # ids of the new companies are taken from the table sequence by blocks
+    ID_BLOCK_SIZE = 100
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.MAX_SIZE
+        # {edrpou: company or None if it is not in our register}
+        self.companies = OrderedDict()
+        self.new_companies = []
+        self.free_ids = []
+
+    def collect_codes(self, data, codes):
+        if isinstance(data, dict):
+            for key, value in data.items():
+                if key in self.CODE_KEYS and isinstance(value, str):
+                    codes.add(value)
+                    # most of the parsers add leading zeros
+                    codes.add(value.zfill(8))
+                else:
+                    self.collect_codes(value, codes)
+        elif isinstance(data, list):
+            for value in data:
+                self.collect_codes(value, codes)
+        return codes
+
+    def cache(self, edrpou, company):
+        self.companies[edrpou] = company
+        self.companies.move_to_end(edrpou)
+        while len(self.companies) > self.max_size:
+            self.companies.popitem(last=False)
+
+    def prefetch(self, data):
+        """ selects the companies of all the codes of the declaration data that are not cached """
+        codes = [code for code in self.collect_codes(data, set()) if code not in self.companies]
+        if not codes:
+            return
+        companies = {}
+        for company in Company.objects.filter(edrpou__in=codes, source=Company.UKRAINE_REGISTER).order_by('id'):
+            # the first one of the duplicates, like .first() does
+            companies.setdefault(company.edrpou, company)
+        for code in codes:
+            self.cache(code, companies.get(code))
+
+    def get(self, edrpou):
+        """ returns the company of our register with the edrpou or None """
+        if edrpou in self.companies:
+            self.companies.move_to_end(edrpou)
+            return self.companies[edrpou]
+        company = Company.objects.filter(edrpou=edrpou, source=Company.UKRAINE_REGISTER).first()
+        self.cache(edrpou, company)
+        return company
+
+    def get_new_id(self):
+        if not self.free_ids:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                    [Company._meta.db_table, Company._meta.pk.column, self.ID_BLOCK_SIZE]
+                )
+                self.free_ids = [row[0] for row in reversed(cursor.fetchall())]
+        return self.free_ids.pop()
+
+    def add_company(self, **fields):
+        """
+        Returns a new company from the declaration. It has the id already, so it can be linked with other objects,
+        but it is saved by save_companies() in the same transaction (foreign keys are checked on commit).
+        """
+        company = Company(id=self.get_new_id(), source=Company.DECLARATIONS, **fields)
+        self.new_companies.append(company)
+        return company
+
+    def save_companies(self):
+        if self.new_companies:
+            Company.objects.bulk_create(self.new_companies)
+            # bulk_create doesn't write history like Company.objects.create() does
+            Company.history.bulk_history_create(self.new_companies)
+        self.new_companies = []
+
+    def discard_companies(self):
+        self.new_companies = []
@@ -2,10 +2,13 @@ import logging
 from typing import Union
 
 from dateutil.parser import isoparse
-import requests
-from django.conf import settings
 from django.apps import apps
+from django.db import transaction
 from business_register.converter.business_converter import BusinessConverter
+from business_register.converter.company_resolver import CompanyResolver
+from business_register.converter.declaration_fetcher import DeclarationFetcher
+from business_register.converter.declaration_store import DeclarationStore
+from business_register.converter.gazetteer import Gazetteer
 from business_register.models.declaration_models import (Declaration,
                                                          Property,
                                                          PropertyRight,
@@ -25,13 +28,13 @@ from business_register.models.declaration_models import (Declaration,
                                                          PartTimeJob,
                                                          NgoParticipation,
                                                          BaseRight,
-                                                         IntangibleAsset
+                                                         IntangibleAsset,
+                                                         IntangibleAssetRight
                                                          )
 from business_register.models.pep_models import Pep, RelatedPersonsLink
 from location_register.models.address_models import Country
-from business_register.models.company_models import Company
+from data_ocean.converter import BulkCreateManager
 from data_ocean.utils import simple_format_date_to_yymmdd
-from location_register.models.ratu_models import RatuRegion, RatuDistrict, RatuCity
 
 from business_register.management.commands.fetch_peps_nacp_id import is_same_full_name, InvalidRelativeData
 
@@ -40,6 +43,12 @@ logger.setLevel(logging.INFO)
 
 
 class DeclarationConverter(BusinessConverter):
+    # objects of the declaration steps are saved in this order, the rights after the objects they belong to
+    STEP_MODELS = (
+        Property, LuxuryItem, Vehicle, Securities, CorporateRights, Beneficiary, IntangibleAsset,
+        Income, Money, Liability, Transaction, PartTimeJob, NgoParticipation,
+        PropertyRight, LuxuryItemRight, VehicleRight, SecuritiesRight, CorporateRightsRight, IntangibleAssetRight,
+    )
 
     def __init__(self):
         self.only_peps = {nacp_id: pep for pep in Pep.objects.filter(
@@ -83,6 +92,11 @@ class DeclarationConverter(BusinessConverter):
         self.keys = set()
         self.current_declaration = None
         self.relatives_data = None
+        self.fetcher = DeclarationFetcher()
+        self.store = DeclarationStore()
+        self.companies = CompanyResolver()
+        self.bulk_manager = BulkCreateManager()
+        self.gazetteer = Gazetteer()
 
     def log_error(self, message):
         logger.warning(f'Declaration id {self.current_declaration.nacp_declaration_id} : {message}')
@@ -163,10 +177,7 @@ class DeclarationConverter(BusinessConverter):
                 company_name = ''
             company_code = right_data.get('ua_company_code')
             if company_code not in self.NO_DATA:
-                company = Company.objects.filter(
-                    edrpou=company_code,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                company = self.companies.get(company_code)
                 if not company:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {company_code}.'
@@ -185,12 +196,11 @@ class DeclarationConverter(BusinessConverter):
                 address = right_data.get('ukr_company_address')
                 if address in self.NO_DATA:
                     address = ''
-                company = Company.objects.create(
+                company = self.companies.add_company(
                     name=company_name,
                     name_en=eng_name,
                     edrpou=company_code,
                     address=address,
-                    source=Company.DECLARATIONS,
                 )
         return owner_type, full_name, company, company_name
 
@@ -275,9 +285,7 @@ class DeclarationConverter(BusinessConverter):
                                 'company_name': company_name,
                                 'owner_type': owner_type,
                             }
-                            apps.get_model('business_register', model_name).objects.create(
-                                **field_dict
-                            )
+                            self.bulk_manager.add(apps.get_model('business_register', model_name)(**field_dict))
         else:
             owner_info = corporate_rights_data.get('person')
             if owner_info not in self.NO_DATA:
@@ -312,9 +320,7 @@ class DeclarationConverter(BusinessConverter):
                             'company_name': company_name,
                             'owner_type': owner_type,
                         }
-                        apps.get_model('business_register', model_name).objects.create(
-                            **field_dict
-                        )
+                        self.bulk_manager.add(apps.get_model('business_register', model_name)(**field_dict))
 
     def save_intangible_assets(self, intangible_assets_data, declaration):
         types = {
@@ -361,7 +367,7 @@ class DeclarationConverter(BusinessConverter):
                 cryptocurrency = None
             additional_info = data.get('otherObjectType') if data.get('otherObjectType') not in self.NO_DATA else ''
             description = data.get('descriptionObject') if data.get('descriptionObject') not in self.NO_DATA else ''
-            intangible_assets = IntangibleAsset.objects.create(
+            intangible_assets = IntangibleAsset(
                 declaration=declaration,
                 type=type_asset,
                 valuation=valuation,
@@ -370,6 +376,7 @@ class DeclarationConverter(BusinessConverter):
                 description=description,
                 cryptocurrency_type=cryptocurrency,
             )
+            self.bulk_manager.add(intangible_assets)
             self.save_right(intangible_assets, data)
 
     def create_ngo_participation(self, data, participation_type, declaration):
@@ -391,10 +398,7 @@ class DeclarationConverter(BusinessConverter):
         ngo_registration_number = data.get('reestrCode')
         ngo = None
         if ngo_registration_number not in self.NO_DATA:
-            ngo = Company.objects.filter(
-                edrpou=ngo_registration_number,
-                source=Company.UKRAINE_REGISTER
-            ).first()
+            ngo = self.companies.get(ngo_registration_number)
             if not ngo:
                 self.log_error(
                     f'Cannot identify ukrainian NGO with edrpou {ngo_registration_number}.'
@@ -402,7 +406,7 @@ class DeclarationConverter(BusinessConverter):
                 )
         else:
             ngo_registration_number = ''
-        NgoParticipation.objects.create(
+        self.bulk_manager.add(NgoParticipation(
             declaration=declaration,
             participation_type=participation_type,
             ngo_type=ngo_type,
@@ -412,7 +416,7 @@ class DeclarationConverter(BusinessConverter):
             ngo_body_name=ngo_body_name,
             ngo=ngo,
             pep=declaration.pep
-        )
+        ))
 
     def save_ngo_participation(self, ngo_data, declaration):
         # possible_keys = {'iteration', 'objectType', 'subObjectType', 'objectName', 'reestrCode'}
@@ -459,10 +463,7 @@ class DeclarationConverter(BusinessConverter):
             employer_registration_number = data.get('emitent_ua_company_code')
             if employer_registration_number not in self.NO_DATA:
                 employer_registration_number = employer_registration_number.zfill(8)
-                employer = Company.objects.filter(
-                    edrpou=employer_registration_number,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                employer = self.companies.get(employer_registration_number)
                 if not employer:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {employer_registration_number}.'
@@ -472,11 +473,10 @@ class DeclarationConverter(BusinessConverter):
                 employer_registration_number = ''
             employer_foreign_registration_number = data.get('emitent_eng_company_code')
             if employer_foreign_registration_number not in self.NO_DATA:
-                employer = Company.objects.create(
+                employer = self.companies.add_company(
                     name=employer_name_eng,
                     edrpou=employer_foreign_registration_number,
-                    address=employer_address,
-                    source=Company.DECLARATIONS
+                    address=employer_address
                 )
                 employer_registration_number = employer_foreign_registration_number
 
@@ -489,7 +489,7 @@ class DeclarationConverter(BusinessConverter):
                 if employer_middle_name:
                     employer_full_name = f'{employer_full_name} {employer_middle_name}'
 
-            PartTimeJob.objects.create(
+            self.bulk_manager.add(PartTimeJob(
                 declaration=declaration,
                 is_paid=is_paid,
                 description=description,
@@ -500,7 +500,7 @@ class DeclarationConverter(BusinessConverter):
                 employer_registration_number=employer_registration_number,
                 employer=employer,
                 employer_full_name=employer_full_name
-            )
+            ))
 
     # possible_keys = {
     #     'specExpensesMovableSubject', 'specOtherExpensesSubject', 'specExpenses', 'country', 'date_costAmount',
@@ -553,7 +553,7 @@ class DeclarationConverter(BusinessConverter):
             if not participant:
                 self.log_error(f'Cannot identify participant of the transaction from data({data})')
 
-            Transaction.objects.create(
+            self.bulk_manager.add(Transaction(
                 declaration=declaration,
                 is_money_spent=is_money_spent,
                 amount=amount,
@@ -563,7 +563,7 @@ class DeclarationConverter(BusinessConverter):
                 date=date,
                 country=country,
                 participant=participant
-            )
+            ))
 
     # possible_keys = {
     #     'emitent_ua_company_code_extendedstatus', 'emitent_ua_company_code', 'guarantor_realty',
@@ -631,10 +631,7 @@ class DeclarationConverter(BusinessConverter):
             bank = None
             bank_registration_number = data.get('emitent_ua_company_code')
             if bank_registration_number not in self.NO_DATA:
-                bank = Company.objects.filter(
-                    edrpou=bank_registration_number,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                bank = self.companies.get(bank_registration_number)
                 if not bank:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {bank_registration_number}.'
@@ -645,11 +642,10 @@ class DeclarationConverter(BusinessConverter):
                 bank_registration_number = ''
             bank_foreign_registration_number = data.get('emitent_eng_company_code')
             if bank_foreign_registration_number not in self.NO_DATA:
-                bank = Company.objects.create(
+                bank = self.companies.add_company(
                     name=bank_name_eng,
                     edrpou=bank_foreign_registration_number,
-                    address=bank_address,
-                    source=Company.DECLARATIONS
+                    address=bank_address
                 )
                 bank_registration_number = bank_foreign_registration_number
 
@@ -706,7 +702,7 @@ class DeclarationConverter(BusinessConverter):
             if not owner:
                 self.log_error(f'Cannot identify owner of the liability from data({data})')
             else:
-                Liability.objects.create(
+                self.bulk_manager.add(Liability(
                     declaration=declaration,
                     type=liability_type,
                     additional_info=additional_info,
@@ -729,12 +725,17 @@ class DeclarationConverter(BusinessConverter):
                     creditor_full_name=creditor_full_name,
                     creditor_full_name_eng=creditor_full_name_eng,
                     owner=owner
-                )
+                ))
 
     def save_bank_account(self, account_data, declaration, pep):
         all_banks = list(Money.objects.filter(declaration__pep=pep, type=Money.BANK_ACCOUNT).values_list(
             'bank_registration_number',
             flat=True))
+        # accounts from the step 12 of this declaration are not saved yet
+        all_banks.extend(
+            money.bank_registration_number for money in self.bulk_manager.queues['business_register.Money']
+            if money.type == Money.BANK_ACCOUNT
+        )
         for data in account_data:
             bank_code_ua = data.get('establishment_ua_company_code')
             if bank_code_ua in self.NO_DATA:
@@ -751,17 +752,13 @@ class DeclarationConverter(BusinessConverter):
             bank_info = data.get('establishment_type', '')
             if bank_code_ua:
                 registration_number = bank_code_ua
-                company = Company.objects.filter(
-                    edrpou=registration_number,
-                    source=Company.UKRAINE_REGISTER,
-                ).first()
+                company = self.companies.get(registration_number)
             elif bank_code_en:
                 registration_number = bank_code_en
-                company = Company.objects.create(
+                company = self.companies.add_company(
                     name=bank_name_ukr,
                     name_en=bank_name_en,
                     edrpou=registration_number,
-                    source=Company.DECLARATIONS,
                 )
             else:
                 continue
@@ -785,7 +782,7 @@ class DeclarationConverter(BusinessConverter):
                 if not owner:
                     self.log_error(f'Cannot find owner of account ({data})')
                     continue
-                Money.objects.create(
+                self.bulk_manager.add(Money(
                     type=Money.BANK_ACCOUNT,
                     bank_name_eng=bank_name_en,
                     bank_name=bank_name_ukr,
@@ -794,7 +791,7 @@ class DeclarationConverter(BusinessConverter):
                     owner=owner,
                     declaration=declaration,
                     bank_from_info=bank_info,
-                )
+                ))
             all_banks.append(registration_number)
 
     # TODO: discover what are 'guarantor' and 'margin-emitent' (can be 'j') fields
@@ -858,10 +855,7 @@ class DeclarationConverter(BusinessConverter):
                 bank = None
                 bank_registration_number = data.get('organization_ua_company_code')
                 if bank_registration_number not in self.NO_DATA:
-                    bank = Company.objects.filter(
-                        edrpou=bank_registration_number,
-                        source=Company.UKRAINE_REGISTER
-                    ).first()
+                    bank = self.companies.get(bank_registration_number)
                     if not bank:
                         self.log_error(
                             f'Cannot identify ukrainian company with edrpou {bank_registration_number}.'
@@ -872,11 +866,10 @@ class DeclarationConverter(BusinessConverter):
                     bank_registration_number = ''
                 bank_foreign_registration_number = data.get('organization_eng_company_code')
                 if bank_foreign_registration_number not in self.NO_DATA:
-                    bank = Company.objects.create(
+                    bank = self.companies.add_company(
                         name=bank_name_eng,
                         edrpou=bank_foreign_registration_number,
-                        address=bank_address,
-                        source=Company.DECLARATIONS
+                        address=bank_address
                     )
                     bank_registration_number = bank_foreign_registration_number
 
@@ -911,7 +904,7 @@ class DeclarationConverter(BusinessConverter):
                 self.log_error(f'Cannot identify owner of the money from data ({data})')
                 continue
             else:
-                Money.objects.create(
+                self.bulk_manager.add(Money(
                     declaration=declaration,
                     type=money_type,
                     additional_info=additional_info,
@@ -924,7 +917,7 @@ class DeclarationConverter(BusinessConverter):
                     bank_registration_number=bank_registration_number,
                     bank=bank,
                     owner=owner
-                )
+                ))
 
     # possible_keys = {
     #     'source_eng_company_code', 'source_ukr_regAddress', 'incomeSource', 'source_ukr_fullname', 'source_citizen',
@@ -993,10 +986,7 @@ class DeclarationConverter(BusinessConverter):
             company_code = data.get('source_ua_company_code')
             if company_code not in self.NO_DATA and company_code not in self.ENIGMA:
                 company_code = company_code.zfill(8)
-                company = Company.objects.filter(
-                    edrpou=company_code,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                company = self.companies.get(company_code)
                 if not company:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {company_code}.'
@@ -1005,11 +995,10 @@ class DeclarationConverter(BusinessConverter):
             foreign_company_code = data.get('source_eng_company_code')
             if company_code not in self.NO_DATA and foreign_company_code not in self.ENIGMA:
                 if not company:
-                    Company.objects.create(
+                    self.companies.add_company(
                         name=data.get('source_eng_company_name'),
                         edrpou=foreign_company_code,
-                        address=data.get('source_eng_company_address'),
-                        source=Company.DECLARATIONS
+                        address=data.get('source_eng_company_address')
                     )
 
             full_name = data.get('source_ukr_fullname')
@@ -1064,7 +1053,7 @@ class DeclarationConverter(BusinessConverter):
                 )
                 continue
 
-            Income.objects.create(
+            self.bulk_manager.add(Income(
                 declaration=declaration,
                 type=income_type,
                 additional_info=additional_info,
@@ -1073,7 +1062,7 @@ class DeclarationConverter(BusinessConverter):
                 paid_by_person=full_name,
                 from_info=from_info,
                 recipient=recipient
-            )
+            ))
 
             # TODO: discover  'iteration'. Example of the value '1614443380219'
             iteration = data.get('iteration')
@@ -1148,21 +1137,17 @@ class DeclarationConverter(BusinessConverter):
             if company_registration_number not in self.NO_DATA:
                 if country == self.UKRAINE:
                     company_registration_number = company_registration_number.zfill(8)
-                    company = Company.objects.filter(
-                        edrpou=company_registration_number,
-                        source=Company.UKRAINE_REGISTER
-                    ).first()
+                    company = self.companies.get(company_registration_number)
                     if not company:
                         self.log_error(
                             f'Cannot identify ukrainian company with edrpou {company_registration_number}.'
                             f'Check corporate rights data({data})'
                         )
                 else:
-                    company = Company.objects.create(
+                    company = self.companies.add_company(
                         name=company_name,
                         name_en=company_name_eng,
-                        edrpou=company_registration_number,
-                        source=Company.DECLARATIONS
+                        edrpou=company_registration_number
                     )
             else:
                 company_registration_number = ''
@@ -1180,7 +1165,7 @@ class DeclarationConverter(BusinessConverter):
                     if beneficiary_info not in self.NO_DATA:
                         beneficiary = self.extract_beneficiary(beneficiary_info, declaration.pep, data)
 
-            Beneficiary.objects.create(
+            self.bulk_manager.add(Beneficiary(
                 declaration=declaration,
                 company_name=company_name,
                 company_name_eng=company_name_eng,
@@ -1193,7 +1178,7 @@ class DeclarationConverter(BusinessConverter):
                 company_address=company_address,
                 company=company,
                 beneficiary=beneficiary
-            )
+            ))
 
     # possible_keys = {
     #     'corporate_rights_company_code', 'person', 'country', 'is_transferred', 'regNumber', 'cost',
@@ -1224,21 +1209,17 @@ class DeclarationConverter(BusinessConverter):
             if company_registration_number not in self.NO_DATA:
                 if country == self.UKRAINE:
                     company_registration_number = company_registration_number.zfill(8)
-                    company = Company.objects.filter(
-                        edrpou=company_registration_number,
-                        source=Company.UKRAINE_REGISTER
-                    ).first()
+                    company = self.companies.get(company_registration_number)
                     if not company:
                         self.log_error(
                             f'Cannot identify ukrainian company with edrpou {company_registration_number}.'
                             f'Check corporate rights data({data})'
                         )
                 else:
-                    company = Company.objects.create(
+                    company = self.companies.add_company(
                         name=company_name,
                         name_en=company_name_eng,
-                        edrpou=company_registration_number,
-                        source=Company.DECLARATIONS
+                        edrpou=company_registration_number
                     )
             else:
                 company_registration_number = ''
@@ -1247,7 +1228,7 @@ class DeclarationConverter(BusinessConverter):
             share = self.to_float(data.get('cost_percent'), data)
             is_transferred = is_transferred_booleans.get(data.get('is_transferred'))
 
-            corporate_rights = CorporateRights.objects.create(
+            corporate_rights = CorporateRights(
                 declaration=declaration,
                 company_name=company_name,
                 company_name_eng=company_name_eng,
@@ -1259,6 +1240,7 @@ class DeclarationConverter(BusinessConverter):
                 share=share,
                 is_transferred=is_transferred
             )
+            self.bulk_manager.add(corporate_rights)
             self.save_right(corporate_rights, data)
 
     # looks like data starts from 'emitent_ua_' is the owner of securities data
@@ -1323,10 +1305,7 @@ class DeclarationConverter(BusinessConverter):
             issuer_registration_number = data.get('emitent_ua_company_code')
             if issuer_registration_number not in self.NO_DATA:
                 issuer_registration_number = issuer_registration_number.zfill(8)
-                issuer = Company.objects.filter(
-                    edrpou=issuer_registration_number,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                issuer = self.companies.get(issuer_registration_number)
                 if not issuer:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {issuer_registration_number}.'
@@ -1336,11 +1315,10 @@ class DeclarationConverter(BusinessConverter):
                 issuer_registration_number = ''
             issuer_foreign_registration_number = data.get('emitent_eng_company_code')
             if issuer_foreign_registration_number not in self.NO_DATA:
-                issuer = Company.objects.create(
+                issuer = self.companies.add_company(
                     name=issuer_name_eng,
                     edrpou=issuer_foreign_registration_number,
-                    address=issuer_address,
-                    source=Company.DECLARATIONS
+                    address=issuer_address
                 )
                 issuer_registration_number = issuer_foreign_registration_number
 
@@ -1370,10 +1348,7 @@ class DeclarationConverter(BusinessConverter):
             trustee = None
             if trustee_registration_number not in self.NO_DATA:
                 trustee_registration_number = trustee_registration_number.zfill(8)
-                trustee = Company.objects.filter(
-                    edrpou=trustee_registration_number,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                trustee = self.companies.get(trustee_registration_number)
                 if not trustee:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {trustee_registration_number}.'
@@ -1384,17 +1359,16 @@ class DeclarationConverter(BusinessConverter):
 
             trustee_foreign_registration_number = data.get('persons_eng_company_code')
             if trustee_foreign_registration_number not in self.NO_DATA:
-                trustee = Company.objects.create(
+                trustee = self.companies.add_company(
                     name=trustee_name_eng,
                     edrpou=trustee_foreign_registration_number,
-                    address=trustee_address,
-                    source=Company.DECLARATIONS
+                    address=trustee_address
                 )
                 trustee_registration_number = trustee_foreign_registration_number
 
             quantity = self.to_float(data.get('amount'), data)
             nominal_value = self.to_float(data.get('cost'), data)
-            securities = Securities.objects.create(
+            securities = Securities(
                 declaration=declaration,
                 type=securities_type,
                 additional_info=additional_info,
@@ -1413,6 +1387,7 @@ class DeclarationConverter(BusinessConverter):
                 quantity=quantity,
                 nominal_value=nominal_value
             )
+            self.bulk_manager.add(securities)
             self.save_right(securities, data)
 
     # TODO: implement
@@ -1450,7 +1425,7 @@ class DeclarationConverter(BusinessConverter):
             else:
                 valuation = None
             is_luxury = self.is_vehicle_luxury(brand, model, year)
-            vehicle = Vehicle.objects.create(
+            vehicle = Vehicle(
                 declaration=declaration,
                 type=vehicle_type,
                 additional_info=additional_info,
@@ -1460,6 +1435,7 @@ class DeclarationConverter(BusinessConverter):
                 is_luxury=is_luxury,
                 valuation=valuation,
             )
+            self.bulk_manager.add(vehicle)
             self.save_right(vehicle, data)
 
     # possible_keys = {
@@ -1492,7 +1468,7 @@ class DeclarationConverter(BusinessConverter):
                 valuation = int(valuation)
             else:
                 valuation = None
-            luxury_item = LuxuryItem.objects.create(
+            luxury_item = LuxuryItem(
                 declaration=declaration,
                 type=luxury_type,
                 additional_info=additional_info,
@@ -1502,6 +1478,7 @@ class DeclarationConverter(BusinessConverter):
                 description=description,
                 valuation=valuation
             )
+            self.bulk_manager.add(luxury_item)
             self.save_right(luxury_item, data)
 
     # TODO: implement as save_property()
@@ -1516,7 +1493,7 @@ class DeclarationConverter(BusinessConverter):
             if property_location:
                 city = self.find_city(property_location)
             area = self.to_float(data.get('totalArea'), data)
-            unfinished_construction_property = Property.objects.create(
+            unfinished_construction_property = Property(
                 declaration=declaration,
                 type=Property.UNFINISHED_CONSTRUCTION,
                 additional_info=additional_info,
@@ -1524,6 +1501,7 @@ class DeclarationConverter(BusinessConverter):
                 country=country,
                 city=city,
             )
+            self.bulk_manager.add(unfinished_construction_property)
             self.save_right(unfinished_construction_property, data)
 
     # possible_keys = [
@@ -1585,7 +1563,7 @@ class DeclarationConverter(BusinessConverter):
                     valuation = data.get('cost_date_assessment')
             valuation = self.to_float(valuation, data)
             area = self.to_float(data.get('totalArea'), data)
-            property = Property.objects.create(
+            property = Property(
                 declaration=declaration,
                 type=property_type,
                 additional_info=additional_info,
@@ -1594,12 +1572,13 @@ class DeclarationConverter(BusinessConverter):
                 city=city,
                 valuation=valuation,
             )
+            self.bulk_manager.add(property)
             self.save_right(property, data)
 
     # TODO: retrieve country from Country DB
     def find_country(self, property_country_data):
         if property_country_data.isdigit():
-            country = Country.objects.filter(nacp_id=property_country_data).first()
+            country = self.gazetteer.get_country(property_country_data)
             if country:
                 return country
             else:
@@ -1628,18 +1607,14 @@ class DeclarationConverter(BusinessConverter):
 
     def find_city(self, address_data):
         city, region, district = self.split_address_data(address_data)
-        ratu_region = RatuRegion.objects.filter(name=region).first()
-        ratu_district = RatuDistrict.objects.filter(name=district, region=ratu_region).first()
+        ratu_region = self.gazetteer.get_region(region)
+        ratu_district = self.gazetteer.get_district(district, ratu_region)
         if region and not ratu_region:
             self.log_error(f'Cannot find region {region}')
         if district and not ratu_district:
             self.log_error(f'Cannot find district {district}')
         else:
-            city_of_registration = RatuCity.objects.filter(
-                name=city,
-                region=ratu_region,
-                district=ratu_district
-            ).first()
+            city_of_registration = self.gazetteer.get_city(city, ratu_region, ratu_district)
             return city_of_registration
         self.log_error(f'Cannot find city')
 
@@ -1690,7 +1665,6 @@ class DeclarationConverter(BusinessConverter):
                     related_person.save()
                 if to_person_relationship_type in SPOUSE_TYPES:
                     declaration.spouse = related_person
-                    declaration.save()
 
     # possible_keys = [
     #     'actual_streetType', 'actual_apartmentsNum_extendedstatus', 'actual_apartmentsNum', 'country',
@@ -1725,7 +1699,6 @@ class DeclarationConverter(BusinessConverter):
         declaration.city_of_residence = city_of_residence
         # TODO: investigate the date of birth data
         declaration.last_job_title = declarant_data.get('workPost')
-        declaration.save()
 
     def save_all_steps(self, data: dict, pep: Pep, declaration: Declaration):
         # 'Step_1' - declarant`s personal data
@@ -1805,60 +1778,110 @@ class DeclarationConverter(BusinessConverter):
         if has_step_data('step_17'):
             self.save_bank_account(data['step_17']['data'], declaration, pep)
 
-    def save_declarations_for_pep(self, nacp_declarant_id):
-        # getting general info including declaration id
-        response = requests.get(
-            f'{settings.NACP_DECLARATION_LIST}?user_declarant_id={nacp_declarant_id}'
-        )
-        declarations_data = response.json().get('data')
-        if response.status_code != 200 or not declarations_data:
-            logger.warning(
-                f'cannot find declarations of the PEP with nacp_declarant_id: {nacp_declarant_id}'
-            )
+    def is_new_declaration(self, declaration_data):
+        # possible_keys = {
+        #     'post_type', 'corruption_affected', 'id', 'options', 'type', 'declaration_type',
+        #     'responsible_position', 'declaration_year', 'schema_version', 'data', 'post_category',
+        #     'date', 'user_declarant_id'
+        # }
+        # TODO: predict storing changes from the declarant
+        if declaration_data['declaration_type'] not in [1, 2, 3, 4]:
+            return False
+        return declaration_data['id'] not in self.all_declarations
+
+    def save_objects(self, declaration):
+        # new companies have reserved ids, so they are saved in the same transaction with the links to them
+        self.companies.save_companies()
+        declaration.save()
+        for model in self.STEP_MODELS:
+            objs = self.bulk_manager.queues[model._meta.label]
+            # the objects were linked with their parents before the parents got ids
+            for obj in objs:
+                for field in model._meta.concrete_fields:
+                    if field.is_relation and field.is_cached(obj):
+                        parent = field.get_cached_value(obj)
+                        setattr(obj, field.attname, parent.pk if parent else None)
+            self.bulk_manager.commit(model)
+
+    def save_declaration_data(self, nacp_declarant_id, declaration_data, data):
+        declaration_id = declaration_data['id']
+        # the same declaration can be in the lists of two declarants
+        if declaration_id in self.all_declarations:
             return
-
         pep = self.only_peps[nacp_declarant_id]
-        for declaration_data in declarations_data:
-            # possible_keys = {
-            #     'post_type', 'corruption_affected', 'id', 'options', 'type', 'declaration_type',
-            #     'responsible_position', 'declaration_year', 'schema_version', 'data', 'post_category',
-            #     'date', 'user_declarant_id'
-            # }
-            declaration_type = declaration_data['declaration_type']
-            # TODO: predict storing changes from the declarant
-            if declaration_type not in [1, 2, 3, 4]:
-                continue
-            declaration_id = declaration_data['id']
-            declaration = self.all_declarations.get(declaration_id)
-            if declaration:
+        # TODO: add date to the model and here
+        submission_date = isoparse(declaration_data['date']).date()
+        declaration = Declaration(
+            type=declaration_data['declaration_type'],
+            year=declaration_data['declaration_year'],
+            submission_date=submission_date,
+            nacp_declaration_id=declaration_id,
+            nacp_declarant_id=nacp_declarant_id,
+            pep=pep,
+        )
+        self.current_declaration = declaration
+        self.companies.prefetch(data)
+        try:
+            # nothing of the declaration is saved if it fails
+            with transaction.atomic():
+                self.save_all_steps(data, pep, declaration)
+                self.save_objects(declaration)
+        except (Exception, KeyboardInterrupt) as e:
+            message = f'Error at declaration {declaration.nacp_declaration_id}: {e}'
+            print(message)
+            logger.error(message)
+            raise
+        finally:
+            self.bulk_manager.queues.clear()
+            self.companies.discard_companies()
+        self.all_declarations[declaration_id] = declaration
+
+    def log_address_misses(self):
+        if self.gazetteer.misses:
+            logger.warning(f'Not found in RATU and countries: {dict(self.gazetteer.misses)}')
+
+    def save_declarations(self, nacp_declarant_ids, on_declarant_saved=None):
+        """
+        Declarations are fetched from NACP concurrently and saved one by one in the order of the declarants,
+        on_declarant_saved(nacp_declarant_id) is called when all the declarations of the declarant are saved.
+        """
+        for nacp_declarant_id, declarations in self.fetcher.iter_declarations(nacp_declarant_ids,
+                                                                              self.is_new_declaration):
+            for declaration_data, data in declarations:
+                if data is None:
+                    logger.warning(f'Declaration id {declaration_data["id"]} : cannot find declarations')
+                    continue
+                # the raw document is kept even if it can't be parsed now
+                self.store.save(nacp_declarant_id, declaration_data, data)
+                self.save_declaration_data(nacp_declarant_id, declaration_data, data)
+            if on_declarant_saved:
+                on_declarant_saved(nacp_declarant_id)
+        self.log_address_misses()
+
+    def replay_declarations(self, nacp_declarant_ids=None):
+        """
+        Parses again the declarations stored by DeclarationStore, without requests to NACP.
+        Stored declarations are destroyed and saved from the documents.
+        Declarations of different declarants can be replayed by parallel processes.
+        """
+        for nacp_declarant_id, declaration_data, data in self.store.iter_declarations(nacp_declarant_ids):
+            if nacp_declarant_id not in self.only_peps:
                 continue
-            # TODO: add date to the model and here
-            else:
-                submission_date = isoparse(declaration_data['date']).date()
-                declaration = Declaration.objects.create(
-                    type=declaration_type,
-                    year=declaration_data['declaration_year'],
-                    submission_date=submission_date,
-                    nacp_declaration_id=declaration_id,
-                    nacp_declarant_id=nacp_declarant_id,
-                    pep=pep,
-                )
-            self.current_declaration = declaration
+            declaration = self.all_declarations.pop(declaration_data['id'], None)
             try:
-                # getting full declaration data
-                response = requests.get(settings.NACP_DECLARATION_RETRIEVE + declaration_id)
-                if response.status_code != 200:
-                    declaration.destroy()
-                    self.log_error('cannot find declarations')
-                    continue
-                self.save_all_steps(response.json()['data'], pep, declaration)
-            except (Exception, KeyboardInterrupt) as e:
-                message = f'Error at declaration {declaration.nacp_declaration_id}: {e}'
-                print(message)
-                logger.error(message)
-                declaration.destroy()
+                # the stored declaration is kept if the document can't be parsed
+                with transaction.atomic():
+                    if declaration:
+                        declaration.destroy()
+                    self.save_declaration_data(nacp_declarant_id, declaration_data, data)
+            except (Exception, KeyboardInterrupt):
+                if declaration:
+                    self.all_declarations[declaration_data['id']] = declaration
                 raise
+        self.log_address_misses()
+
+    def save_declarations_for_pep(self, nacp_declarant_id):
+        self.save_declarations([nacp_declarant_id])
 
     def save_declaration(self):
-        for nacp_declarant_id in self.only_peps:
-            self.save_declarations_for_pep(nacp_declarant_id)
+        self.save_declarations(self.only_peps)
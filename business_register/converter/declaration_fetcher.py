@@ -0,0 +1,77 @@
+import logging
+
+from django.conf import settings
+
+from data_ocean.fetcher import RateLimiter, fetch_ordered, make_session
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class DeclarationFetcher:
+    """
+    Fetches declarations of the declarants from the NACP API by a pool of threads with one HTTP session,
+    that retries failed requests with backoff. All the requests share one requests per second limit.
+    """
+    WORKERS = 4
+    REQUESTS_PER_SECOND = 10
+    TIMEOUT = 60
+
+    def __init__(self, workers=None, requests_per_second=None, list_url=None, retrieve_url=None):
+        self.workers = workers or self.WORKERS
+        self.list_url = list_url or settings.NACP_DECLARATION_LIST
+        self.retrieve_url = retrieve_url or settings.NACP_DECLARATION_RETRIEVE
+        self.session = make_session(pool_size=self.workers * 2)
+        self.rate_limiter = RateLimiter(requests_per_second or self.REQUESTS_PER_SECOND)
+
+    def get_data(self, url):
+        # returns 'data' of the response or None if it is not found
+        self.rate_limiter.wait()
+        response = self.session.get(url, timeout=self.TIMEOUT)
+        if response.status_code != 200:
+            return None
+        return response.json().get('data')
+
+    def fetch_declarations_list(self, nacp_declarant_id):
+        return self.get_data(f'{self.list_url}?user_declarant_id={nacp_declarant_id}')
+
+    def fetch_declaration(self, item):
+        nacp_declarant_id, declaration_data = item
+        if not declaration_data:
+            # the end of the declarations of the declarant
+            return None
+        return self.get_data(self.retrieve_url + declaration_data['id'])
+
+    def iter_declarations_items(self, nacp_declarant_ids, is_needed):
+        for nacp_declarant_id, declarations_data in fetch_ordered(
+                self.fetch_declarations_list, nacp_declarant_ids, self.workers
+        ):
+            if not declarations_data:
+                logger.warning(
+                    f'cannot find declarations of the PEP with nacp_declarant_id: {nacp_declarant_id}'
+                )
+            for declaration_data in declarations_data or []:
+                if is_needed(declaration_data):
+                    yield nacp_declarant_id, declaration_data
+            yield nacp_declarant_id, None
+
+    def iter_declarations(self, nacp_declarant_ids, is_needed=lambda declaration_data: True):
+        """
+        Yields (nacp_declarant_id, [(declaration_data, document), ...]) for every declarant in the order of
+        nacp_declarant_ids, when all the documents of the declarant are fetched.
+        declaration_data - item of the declarations list, the documents are fetched only if is_needed(declaration_data)
+        document - 'data' of the full declaration or None if NACP doesn't return it.
+        Lists and documents of the next declarants are fetched while the documents are saved by the consumer.
+        """
+        declarations = []
+        for (nacp_declarant_id, declaration_data), document in fetch_ordered(
+                self.fetch_declaration, self.iter_declarations_items(nacp_declarant_ids, is_needed), self.workers
+        ):
+            if declaration_data:
+                declarations.append((declaration_data, document))
+            else:
+                yield nacp_declarant_id, declarations
+                declarations = []
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,86 @@
+import gzip
+import hashlib
+import json
+import os
+
+from django.conf import settings
+
+
+class DeclarationStore:
+    """
+    Local store of the raw NACP declaration documents, so declarations can be parsed again without NACP.
+    A document is saved to objects/<hash[:2]>/<hash>.json.gz, where hash is sha256 of the JSON,
+    so the same document is stored once. index/<nacp_declaration_id>.json points to the last document
+    of the declaration and keeps the declarant id and the item of the declarations list.
+    """
+
+    def __init__(self, folder=None):
+        self.folder = folder or settings.NACP_DECLARATION_CACHE_FOLDER
+        self.objects_folder = os.path.join(self.folder, 'objects')
+        self.index_folder = os.path.join(self.folder, 'index')
+
+    @staticmethod
+    def to_json(data):
+        return json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode()
+
+    def get_object_path(self, content_hash):
+        return os.path.join(self.objects_folder, content_hash[:2], f'{content_hash}.json.gz')
+
+    def get_index_path(self, nacp_declaration_id):
+        return os.path.join(self.index_folder, f'{nacp_declaration_id}.json')
+
+    def write_file(self, path, content):
+        # a file is never seen half-written, even if the process is killed
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(content)
+        os.replace(temp_path, path)
+
+    def save(self, nacp_declarant_id, declaration_data, data):
+        """ stores the document of the declaration and returns its hash """
+        content = self.to_json(data)
+        content_hash = hashlib.sha256(content).hexdigest()
+        object_path = self.get_object_path(content_hash)
+        if not os.path.exists(object_path):
+            self.write_file(object_path, gzip.compress(content))
+        self.write_file(self.get_index_path(declaration_data['id']), self.to_json({
+            'nacp_declarant_id': nacp_declarant_id,
+            'declaration': declaration_data,
+            'hash': content_hash,
+        }))
+        return content_hash
+
+    def load_index(self, nacp_declaration_id):
+        index_path = self.get_index_path(nacp_declaration_id)
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, 'rb') as file:
+            return json.load(file)
+
+    def load_document(self, nacp_declaration_id, index):
+        with open(self.get_object_path(index['hash']), 'rb') as file:
+            content = gzip.decompress(file.read())
+        if hashlib.sha256(content).hexdigest() != index['hash']:
+            raise Exception('Error!', f'Stored document of the declaration {nacp_declaration_id} is damaged')
+        return json.loads(content)
+
+    def load(self, nacp_declaration_id):
+        """ returns (nacp_declarant_id, item of the declarations list, document) or None if it is not stored """
+        index = self.load_index(nacp_declaration_id)
+        if not index:
+            return None
+        return index['nacp_declarant_id'], index['declaration'], self.load_document(nacp_declaration_id, index)
+
+    def get_declaration_ids(self):
+        if not os.path.exists(self.index_folder):
+            return []
+        return sorted(name[:-len('.json')] for name in os.listdir(self.index_folder) if name.endswith('.json'))
+
+    def iter_declarations(self, nacp_declarant_ids=None):
+        """ yields load() results of all the stored declarations or of the declarations of nacp_declarant_ids """
+        for nacp_declaration_id in self.get_declaration_ids():
+            index = self.load_index(nacp_declaration_id)
+            if nacp_declarant_ids is None or index['nacp_declarant_id'] in nacp_declarant_ids:
+                yield (index['nacp_declarant_id'], index['declaration'],
+                       self.load_document(nacp_declaration_id, index))
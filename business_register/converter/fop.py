@@ -5,10 +5,11 @@ import requests
 from django.utils import timezone
 from data_ocean.downloader import Downloader
 from business_register.converter.business_converter import BusinessConverter
+from business_register.converter.record_schemas import FOP, FOP_FULL
 from business_register.models.fop_models import (ExchangeDataFop, Fop,
                                                  FopToKved)
 from django.conf import settings
-from data_ocean.converter import BulkCreateManager
+from data_ocean.converter import BulkCreateManager, BulkUpdateManager, UpsertManager
 from data_ocean.models import Register
 from data_ocean.utils import get_first_word, cut_first_word, format_date_to_yymmdd
 from stats.tasks import endpoints_cache_warm_up
@@ -20,34 +21,34 @@ logger.setLevel(logging.INFO)
 class FopConverter(BusinessConverter):
 
     def __init__(self):
-        self.API_ADDRESS_FOR_DATASET = Register.objects.get(source_register_id=
-                                                            "1c7f3815-3259-45e0-bdf1-64dca07ddc10").source_api_address
+        # companies and FOPs are two registers of the same dataset, api_list tells them apart
+        self.API_ADDRESS_FOR_DATASET = Register.objects.get(
+            source_register_id=settings.BUSINESS_FOP_SOURCE_REGISTER_ID,
+            api_list=settings.FOP_REGISTER_LIST
+        ).source_api_address
         self.LOCAL_FOLDER = settings.LOCAL_FOLDER
         self.LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_FOP
         self.CHUNK_SIZE = settings.CHUNK_SIZE_FOP
         self.RECORD_TAG = 'RECORD'
         self.bulk_manager = BulkCreateManager()
+        self.update_manager = BulkUpdateManager()
+        self.fop_upsert_manager = UpsertManager(Fop, key_fields=('code',), update_fields=('status_id',))
         self.new_fops_foptokveds = {}
         self.new_fops_exchange_data = {}
+        self.stored_fops = {}
+        self.stored_foptokveds = {}
+        self.stored_exchange_data = {}
         super().__init__()
 
     def add_fop_kveds_to_dict(self, fop_kveds_from_record, code):
         all_fop_foptokveds = []
         for activity in fop_kveds_from_record:
-            code_info = activity.xpath('CODE')
-            if not code_info:
-                continue
-            kved_code = code_info[0].text
-            if not kved_code:
-                continue
-            name_info = activity.xpath('NAME')
-            if not name_info:
-                continue
-            kved_name = name_info[0].text
-            if not kved_name:
+            kved_code = activity.code
+            kved_name = activity.name
+            if not kved_code or not kved_name:
                 continue
             kved = self.get_kved_from_DB(kved_code, kved_name)
-            is_primary = activity.xpath('PRIMARY')[0].text == "так"
+            is_primary = activity.primary == "так"
             fop_to_kved = FopToKved(kved=kved, primary_kved=is_primary)
             all_fop_foptokveds.append(fop_to_kved)
         if len(all_fop_foptokveds):
@@ -55,31 +56,22 @@ class FopConverter(BusinessConverter):
 
     # putting all kveds into a list
     def update_fop_kveds(self, fop_kveds_from_record, fop):
-        already_stored_foptokveds = list(FopToKved.objects.filter(fop=fop))
+        already_stored_foptokveds = list(self.stored_foptokveds.get(fop.id, []))
         for activity in fop_kveds_from_record:
-            code_info = activity.xpath('CODE')
-            if not code_info:
-                continue
-            kved_code = code_info[0].text
-            if not kved_code:
-                continue
-            name_info = activity.xpath('NAME')
-            if not name_info:
-                continue
-            kved_name = name_info[0].text
-            if not kved_name:
+            kved_code = activity.code
+            kved_name = activity.name
+            if not kved_code or not kved_name:
                 continue
             kved = self.get_kved_from_DB(kved_code, kved_name)
-            is_primary = activity.xpath('PRIMARY')[0].text == "так"
+            is_primary = activity.primary == "так"
             alredy_stored = False
             if len(already_stored_foptokveds):
                 for stored_foptokved in already_stored_foptokveds:
-                    if (stored_foptokved.kved.code == kved.code
-                            and stored_foptokved.kved.name == kved.name):
+                    if stored_foptokved.kved_id == kved.id:
                         alredy_stored = True
                         if stored_foptokved.primary_kved != is_primary:
                             stored_foptokved.primary_kved = is_primary
-                            stored_foptokved.save(update_fields=['primary_kved', 'updated_at'])
+                            self.update_manager.add(stored_foptokved, ['primary_kved'])
                         already_stored_foptokveds.remove(stored_foptokved)
                         break
             if not alredy_stored:
@@ -87,34 +79,18 @@ class FopConverter(BusinessConverter):
                 self.bulk_manager.add(fop_to_kved)
         if len(already_stored_foptokveds):
             for outdated_foptokved in already_stored_foptokveds:
-                outdated_foptokved.soft_delete()
+                self.update_manager.soft_delete(outdated_foptokved)
 
     def extract_exchange_data(self, answer):
-        authority_info = answer.xpath('AUTHORITY_NAME')
         authority = None
-        if authority_info and authority_info[0].text:
-            authority = self.save_or_get_authority(authority_info[0].text)
-        taxpayer_info = answer.xpath('TAX_PAYER_TYPE')
+        if answer.authority_name:
+            authority = self.save_or_get_authority(answer.authority_name)
         taxpayer_type = None
-        if taxpayer_info and taxpayer_info[0].text:
-            taxpayer_type = self.save_or_get_taxpayer_type(taxpayer_info[0].text)
-        start_date_info = answer.xpath('START_DATE')
-        start_date = None
-        if start_date_info and start_date_info[0].text:
-            start_date = format_date_to_yymmdd(start_date_info[0].text)
-        start_number_info = answer.xpath('START_NUM')
-        start_number = None
-        if start_number_info:
-            start_number = start_number_info[0].text
-        end_date_info = answer.xpath('END_DATE')
-        end_date = None
-        if end_date_info and end_date_info[0].text:
-            end_date = format_date_to_yymmdd(end_date_info[0].text)
-        end_number_info = answer.xpath('END_NUM')
-        end_number = None
-        if end_number_info and end_number_info[0].text:
-            end_number = end_number_info[0].text
-        return authority, taxpayer_type, start_date, start_number, end_date, end_number
+        if answer.tax_payer_type:
+            taxpayer_type = self.save_or_get_taxpayer_type(answer.tax_payer_type)
+        start_date = format_date_to_yymmdd(answer.start_date)
+        end_date = format_date_to_yymmdd(answer.end_date)
+        return authority, taxpayer_type, start_date, answer.start_num, end_date, answer.end_num
 
     def add_fop_exchange_data_to_dict(self, exchange_data, code):
         all_fop_exchangedata = []
@@ -133,7 +109,7 @@ class FopConverter(BusinessConverter):
 
     # putting all exchange data into a list
     def update_fop_exchange_data(self, exchange_data, fop):
-        already_stored_exchange_data = ExchangeDataFop.objects.filter(fop=fop)
+        already_stored_exchange_data = self.stored_exchange_data.get(fop.id, [])
         for answer in exchange_data:
             authority, taxpayer_type, start_date, start_number, end_date, end_number \
                 = self.extract_exchange_data(answer)
@@ -143,8 +119,8 @@ class FopConverter(BusinessConverter):
             already_stored = False
             for stored_exchange_data in already_stored_exchange_data:
                 # ToDo: find way to check dates
-                if (stored_exchange_data.authority == authority
-                        and stored_exchange_data.taxpayer_type == taxpayer_type
+                if (stored_exchange_data.authority_id == (authority.id if authority else None)
+                        and stored_exchange_data.taxpayer_type_id == (taxpayer_type.id if taxpayer_type else None)
                         and stored_exchange_data.start_number == start_number
                         and stored_exchange_data.end_number == end_number):
                     already_stored = True
@@ -156,9 +132,26 @@ class FopConverter(BusinessConverter):
                                                 end_date=end_date, end_number=end_number)
                 self.bulk_manager.add(exchange_data)
 
+    def prefetch_stored_fops(self, records):
+        # one query per table for the whole chunk instead of queries per record
+        codes = [record.name.lower() + (record.address or 'EMPTY') for record in records if record.name]
+        self.stored_fops = {}
+        # the first stored FOP with the code wins, as .first() did before
+        for fop in Fop.objects.filter(code__in=codes).order_by('-id'):
+            self.stored_fops[fop.code] = fop
+        fop_ids = [fop.id for fop in self.stored_fops.values()]
+        self.stored_foptokveds = self.put_objects_to_dict_of_lists(
+            'fop_id', FopToKved.objects.filter(fop_id__in=fop_ids)
+        )
+        self.stored_exchange_data = self.put_objects_to_dict_of_lists(
+            'fop_id', ExchangeDataFop.objects.filter(fop_id__in=fop_ids)
+        )
+
     def save_detailed_fop_to_db(self, records):
+        records = [FOP_FULL.extract(element) for element in records]
+        self.prefetch_stored_fops(records)
         for record in records:
-            fullname = record.xpath('NAME')[0].text
+            fullname = record.name
             if not fullname:
                 logger.warning(f'ФОП без прізвища: {record}')
                 self.report.invalid_data += 1
@@ -168,32 +161,32 @@ class FopConverter(BusinessConverter):
                 continue
             if fullname:
                 fullname = fullname.lower()
-            address = record.xpath('ADDRESS')[0].text
+            address = record.address
             if not address:
                 address = 'EMPTY'
             code = fullname + address
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            registration_text = record.xpath('REGISTRATION')[0].text
+            status = self.save_or_get_status(record.stan)
+            registration_text = record.registration
             # first getting date, then registration info if REGISTRATION.text exists
             registration_date = None
             registration_info = None
             if registration_text:
                 registration_date = format_date_to_yymmdd(get_first_word(registration_text))
                 registration_info = cut_first_word(registration_text)
-            estate_manager = record.xpath('ESTATE_MANAGER')[0].text
-            termination_text = record.xpath('TERMINATED_INFO')[0].text
+            estate_manager = record.estate_manager
+            termination_text = record.terminated_info
             termination_date = None
             terminated_info = None
             if termination_text:
                 termination_date = format_date_to_yymmdd(get_first_word(termination_text))
                 terminated_info = cut_first_word(termination_text)
-            termination_cancel_info = record.xpath('TERMINATION_CANCEL_INFO')[0].text
-            contact_info = record.xpath('CONTACTS')[0].text
-            vp_dates = record.xpath('VP_DATES')[0].text
-            authority = self.save_or_get_authority(record.xpath('CURRENT_AUTHORITY')[0].text)
-            fop_kveds = record.xpath('ACTIVITY_KINDS')[0]
-            exchange_data = record.xpath('EXCHANGE_DATA')[0]
-            fop = Fop.objects.filter(code=code).first()
+            termination_cancel_info = record.termination_cancel_info
+            contact_info = record.contacts
+            vp_dates = record.vp_dates
+            authority = self.save_or_get_authority(record.current_authority)
+            fop_kveds = record.activity_kinds
+            exchange_data = record.exchange_data
+            fop = self.stored_fops.get(code)
             if not fop:
                 fop = Fop(
                     fullname=fullname,
@@ -217,7 +210,7 @@ class FopConverter(BusinessConverter):
             else:
                 # TODO: make a decision: our algorithm when Fop changes fullname or address?
                 update_fields = []
-                if fop.status != status:
+                if fop.status_id != status.id:
                     fop.status = status
                     update_fields.append('status')
                 if fop.registration_date and str(fop.registration_date) != registration_date:
@@ -244,16 +237,16 @@ class FopConverter(BusinessConverter):
                 if fop.vp_dates != vp_dates:
                     fop.vp_dates = vp_dates
                     update_fields.append('vp_dates')
-                if fop.authority != authority:
+                if fop.authority_id != authority.id:
                     fop.authority = authority
                     update_fields.append('authority')
                 if len(update_fields):
-                    update_fields.append('updated_at')
-                    fop.save(update_fields=update_fields)
+                    self.update_manager.add(fop, update_fields)
                 if len(fop_kveds):
                     self.update_fop_kveds(fop_kveds, fop)
                 if len(exchange_data):
                     self.update_fop_exchange_data(exchange_data, fop)
+        self.update_manager.commit()
         if len(self.bulk_manager.queues['business_register.Fop']):
             self.bulk_manager.commit(Fop)
         for fop in self.bulk_manager.queues['business_register.Fop']:
@@ -280,25 +273,21 @@ class FopConverter(BusinessConverter):
         self.bulk_manager.queues['business_register.FopToKved'] = []
         self.bulk_manager.queues['business_register.ExchangeDataFop'] = []
 
-    def save_or_update_kved(self, kved, fop):
-        current_fop_to_kved = FopToKved.objects.filter(
-            fop=fop,
-            kved=kved
-        ).first()
+    def save_or_update_kved(self, kved, fop_id, stored_fop_to_kveds):
+        current_fop_to_kved = stored_fop_to_kveds.get((fop_id, kved.id))
         if not current_fop_to_kved:
-            FopToKved.objects.create(
-                fop=fop,
-                kved=kved,
-                primary_kved=True
-            )
+            self.bulk_manager.add(FopToKved(fop_id=fop_id, kved=kved, primary_kved=True))
         else:
             if not current_fop_to_kved.primary_kved:
                 current_fop_to_kved.primary_kved = True
-                current_fop_to_kved.save(update_fields=['primary_kved', 'updated_at'])
+                self.update_manager.add(current_fop_to_kved, ['primary_kved'])
 
     def save_to_db(self, records):
-        for record in records:
-            fullname = record.xpath('FIO')[0].text
+        fop_rows = {}
+        fop_kveds = {}
+        for element in records:
+            record = FOP.extract(element)
+            fullname = record.fio
             if not fullname:
                 logger.warning(f'ФОП без прізвища: {record}')
                 self.report.invalid_data += 1
@@ -307,31 +296,39 @@ class FopConverter(BusinessConverter):
                 logger.warning(f'ФОП із задовгим прізвищем: {record}')
                 continue
             fullname = fullname.lower()
-            address = record.xpath('ADDRESS')[0].text
+            address = record.address
             if not address:
                 address = 'EMPTY'
             code = fullname + address
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            fop = Fop.objects.filter(code=code).first()
-            if not fop:
-                fop = Fop.objects.create(
-                    fullname=fullname,
-                    address=address,
-                    status=status,
-                    code=code)
-            else:
-                # TODO: make a decision: our algorithm when Fop changes fullname or address?
-                update_fields = []
-                if fop.status != status:
-                    fop.status = status
-                    update_fields.append('status')
-                if len(update_fields):
-                    update_fields.append('updated_at')
-                    fop.save(update_fields=update_fields)
-            kved_data = record.xpath('KVED')[0].text
+            status = self.save_or_get_status(record.stan)
+            # TODO: make a decision: our algorithm when Fop changes fullname or address?
+            fop_rows[code] = {
+                'fullname': fullname,
+                'address': address,
+                'status_id': status.id,
+                'code': code,
+            }
+            kved_data = record.kved
             if kved_data and ' ' in kved_data:
-                kved = self.extract_kved(kved_data)
-                self.save_or_update_kved(kved, fop)
+                fop_kveds[code] = self.extract_kved(kved_data)
+        upsert_result = self.fop_upsert_manager.upsert(list(fop_rows.values()))
+        for code, fop_id in upsert_result.inserted.items():
+            if code in fop_kveds:
+                self.bulk_manager.add(FopToKved(fop_id=fop_id, kved=fop_kveds[code], primary_kved=True))
+        stored_fops = {**upsert_result.updated, **upsert_result.unchanged}
+        stored_fop_to_kveds = {}
+        # the first stored row of each pair wins, as .first() did before
+        for fop_to_kved in FopToKved.objects.filter(
+                fop_id__in=[fop_id for code, fop_id in stored_fops.items() if code in fop_kveds]
+        ).order_by('-id'):
+            stored_fop_to_kveds[(fop_to_kved.fop_id, fop_to_kved.kved_id)] = fop_to_kved
+        for code, fop_id in stored_fops.items():
+            if code in fop_kveds:
+                self.save_or_update_kved(fop_kveds[code], fop_id, stored_fop_to_kveds)
+        self.update_manager.commit()
+        if len(self.bulk_manager.queues['business_register.FopToKved']):
+            self.bulk_manager.commit(FopToKved)
+        self.bulk_manager.queues['business_register.FopToKved'] = []
 
     print("For storing run FopConverter().process()")
 
@@ -365,7 +362,9 @@ class FopDownloader(Downloader):
         logger.info(f'{self.reg_name}: Update started...')
 
         self.report_init()
-        self.download()
+        if not self.download():
+            self.report_not_modified()
+            return
 
         self.report.update_start = timezone.now()
         self.report.save()
@@ -6,10 +6,11 @@ from django.conf import settings
 from django.utils import timezone
 
 from business_register.converter.business_converter import BusinessConverter
+from business_register.converter.record_schemas import FOP_FULL
 from business_register.models.fop_models import (ExchangeDataFop, Fop, FopToKved)
-from data_ocean.converter import BulkCreateManager
+from data_ocean.converter import BulkCreateManager, BulkUpdateManager, FingerprintManager, UpsertManager
 from data_ocean.downloader import Downloader
-from data_ocean.utils import get_first_word, cut_first_word, format_date_to_yymmdd, to_lower_string_if_exists
+from data_ocean.utils import get_first_word, cut_first_word, format_date_to_yymmdd
 from stats.tasks import endpoints_cache_warm_up
 
 logger = logging.getLogger(__name__)
@@ -19,64 +20,58 @@ logger.setLevel(logging.INFO)
 class FopFullConverter(BusinessConverter):
     # Uncomment for switch Timer ON.
     # timing = True
+    PARALLEL_COUNTERS = ('records_skipped', 'records_processed')
 
     def __init__(self):
         self.LOCAL_FOLDER = settings.LOCAL_FOLDER
         self.LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_FOP_FULL
         self.CHUNK_SIZE = settings.CHUNK_SIZE_FOP_FULL
         self.RECORD_TAG = 'SUBJECT'
-        self.bulk_manager = BulkCreateManager()
+        self.bulk_manager = BulkCreateManager(copy_models=(FopToKved, ExchangeDataFop))
+        # fullname and address are parts of the code, so they are not updated
+        # TODO: make a decision: our algorithm when Fop changes fullname or address?
+        self.fop_upsert_manager = UpsertManager(
+            Fop,
+            key_fields=('code',),
+            update_fields=('status_id', 'registration_date', 'registration_date_second', 'registration_number',
+                           'registration_info', 'estate_manager', 'termination_date', 'terminated_info',
+                           'termination_cancel_info', 'contact_info', 'vp_dates', 'authority_id'),
+        )
+        self.update_manager = BulkUpdateManager()
+        self.fingerprint_manager = FingerprintManager('business_fop')
+        self.records_skipped = 0
+        self.records_processed = 0
         self.new_fops_foptokveds = {}
         self.new_fops_exchange_data = {}
+        self.stored_foptokveds = {}
+        self.stored_exchange_data = {}
         super().__init__()
 
     def add_fop_kveds_to_dict(self, fop_kveds_from_record, code):
         all_fop_foptokveds = []
         for activity in fop_kveds_from_record:
-            code_info = activity.xpath('CODE')
-            if not code_info:
-                continue
-            kved_code = code_info[0].text
-            if not kved_code:
-                continue
-            name_info = activity.xpath('NAME')
-            if not name_info:
-                continue
-            kved_name = name_info[0].text
-            if not kved_name:
+            kved_code = activity.code
+            kved_name = activity.name
+            if not kved_code or not kved_name:
                 continue
             kved = self.get_kved_from_DB(kved_code, kved_name)
-            if activity.xpath('PRIMARY'):
-                is_primary = activity.xpath('PRIMARY')[0].text == "так"
-            else:
-                is_primary = False
+            is_primary = activity.primary == "так"
             fop_to_kved = FopToKved(kved=kved, primary_kved=is_primary)
             all_fop_foptokveds.append(fop_to_kved)
         if len(all_fop_foptokveds):
             self.new_fops_foptokveds[code] = all_fop_foptokveds
 
     # putting all kveds into a list
-    def update_fop_kveds(self, fop_kveds_from_record, fop):
-        already_stored_foptokveds = list(FopToKved.objects.filter(fop_id=fop.id))
+    def update_fop_kveds(self, fop_kveds_from_record, fop_id):
+        already_stored_foptokveds = list(self.stored_foptokveds.get(fop_id, []))
         self.time_it('trying get kveds\t')
         for activity in fop_kveds_from_record:
-            code_info = activity.xpath('CODE')
-            if not code_info:
-                continue
-            kved_code = code_info[0].text
-            if not kved_code:
-                continue
-            name_info = activity.xpath('NAME')
-            if not name_info:
-                continue
-            kved_name = name_info[0].text
-            if not kved_name:
+            kved_code = activity.code
+            kved_name = activity.name
+            if not kved_code or not kved_name:
                 continue
             kved = self.get_kved_from_DB(kved_code, kved_name)
-            if activity.xpath('PRIMARY'):
-                is_primary = activity.xpath('PRIMARY')[0].text == "так"
-            else:
-                is_primary = False
+            is_primary = activity.primary == "так"
             alredy_stored = False
             self.time_it('getting data kveds from record')
             if len(already_stored_foptokveds):
@@ -85,43 +80,27 @@ class FopFullConverter(BusinessConverter):
                         alredy_stored = True
                         if stored_foptokved.primary_kved != is_primary:
                             stored_foptokved.primary_kved = is_primary
-                            stored_foptokved.save(update_fields=['primary_kved', 'updated_at'])
+                            self.update_manager.add(stored_foptokved, ['primary_kved'])
                         already_stored_foptokveds.remove(stored_foptokved)
                         break
             if not alredy_stored:
-                fop_to_kved = FopToKved(fop=fop, kved=kved, primary_kved=is_primary)
+                fop_to_kved = FopToKved(fop_id=fop_id, kved=kved, primary_kved=is_primary)
                 self.bulk_manager.add(fop_to_kved)
             self.time_it('update kveds\t\t')
         if len(already_stored_foptokveds):
             for outdated_foptokved in already_stored_foptokveds:
-                outdated_foptokved.soft_delete()
+                self.update_manager.soft_delete(outdated_foptokved)
 
     def extract_exchange_data(self, answer):
-        authority_info = answer.xpath('AUTHORITY_NAME')
         authority = None
-        if authority_info and authority_info[0].text:
-            authority = self.save_or_get_authority(authority_info[0].text)
-        taxpayer_info = answer.xpath('TAX_PAYER_TYPE')
+        if answer.authority_name:
+            authority = self.save_or_get_authority(answer.authority_name)
         taxpayer_type = None
-        if taxpayer_info and taxpayer_info[0].text:
-            taxpayer_type = self.save_or_get_taxpayer_type(taxpayer_info[0].text)
-        start_date_info = answer.xpath('START_DATE')
-        start_date = None
-        if start_date_info and start_date_info[0].text:
-            start_date = format_date_to_yymmdd(start_date_info[0].text)
-        start_number_info = answer.xpath('START_NUM')
-        start_number = None
-        if start_number_info:
-            start_number = start_number_info[0].text
-        end_date_info = answer.xpath('END_DATE')
-        end_date = None
-        if end_date_info and end_date_info[0].text:
-            end_date = format_date_to_yymmdd(end_date_info[0].text)
-        end_number_info = answer.xpath('END_NUM')
-        end_number = None
-        if end_number_info and end_number_info[0].text:
-            end_number = end_number_info[0].text
-        return authority, taxpayer_type, start_date, start_number, end_date, end_number
+        if answer.tax_payer_type:
+            taxpayer_type = self.save_or_get_taxpayer_type(answer.tax_payer_type)
+        start_date = format_date_to_yymmdd(answer.start_date)
+        end_date = format_date_to_yymmdd(answer.end_date)
+        return authority, taxpayer_type, start_date, answer.start_num, end_date, answer.end_num
 
     def add_fop_exchange_data_to_dict(self, exchange_data, code):
         all_fop_exchangedata = []
@@ -142,8 +121,8 @@ class FopFullConverter(BusinessConverter):
             self.new_fops_exchange_data[code] = all_fop_exchangedata
 
     # putting all exchange data into a list
-    def update_fop_exchange_data(self, exchange_data, fop):
-        already_stored_exchange_data = ExchangeDataFop.objects.filter(fop_id=fop.id)
+    def update_fop_exchange_data(self, exchange_data, fop_id):
+        already_stored_exchange_data = self.stored_exchange_data.get(fop_id, [])
         self.time_it('trying get exchange_data')
         for answer in exchange_data:
             authority, taxpayer_type, start_date, start_number, end_date, end_number \
@@ -162,7 +141,7 @@ class FopFullConverter(BusinessConverter):
                     already_stored = True
                     break
             if not already_stored:
-                exchange_data = ExchangeDataFop(fop=fop,
+                exchange_data = ExchangeDataFop(fop_id=fop_id,
                                                 authority=authority,
                                                 taxpayer_type=taxpayer_type,
                                                 start_date=start_date,
@@ -172,9 +151,22 @@ class FopFullConverter(BusinessConverter):
                                                 )
                 self.bulk_manager.add(exchange_data)
 
+    def get_record_key(self, element):
+        fullname = element.findtext('NAME')
+        if not fullname:
+            return None
+        return fullname.lower() + (element.findtext('ADDRESS') or 'EMPTY')
+
     def save_to_db(self, records):
-        for record in records:
-            fullname = record.xpath('NAME')[0].text
+        records, unchanged_fops = self.fingerprint_manager.filter_changed(records, self.get_record_key)
+        self.records_skipped += len(unchanged_fops)
+        self.records_processed += len(records)
+        self.time_it('filter unchanged\t')
+        fop_rows = {}
+        fop_children = {}
+        for element in records:
+            record = FOP_FULL.extract(element)
+            fullname = record.name
             if not fullname:
                 logger.warning(f'ФОП без прізвища: {record}')
                 # self.report.invalid_data += 1
@@ -184,12 +176,12 @@ class FopFullConverter(BusinessConverter):
                 continue
             if fullname:
                 fullname = fullname.lower()
-            address = record.xpath('ADDRESS')[0].text
+            address = record.address
             if not address:
                 address = 'EMPTY'
             code = fullname + address
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            registration_text = record.xpath('REGISTRATION')[0].text
+            status = self.save_or_get_status(record.stan)
+            registration_text = record.registration
             # first getting date, then registration info if REGISTRATION.text exists
             registration_date = None
             registration_date_second = None
@@ -202,124 +194,86 @@ class FopFullConverter(BusinessConverter):
                 registration_date_second = format_date_to_yymmdd(registration_text[1])
                 if 3 <= len(registration_text):
                     registration_number = registration_text[2]
-            estate_manager = record.xpath('ESTATE_MANAGER')[0].text
-            termination_text = record.xpath('TERMINATED_INFO')[0].text
+            estate_manager = record.estate_manager
+            termination_text = record.terminated_info
             termination_date = None
             terminated_info = None
             if termination_text:
                 termination_date = format_date_to_yymmdd(get_first_word(termination_text))
                 terminated_info = cut_first_word(termination_text)
-            termination_cancel_info = record.xpath('TERMINATION_CANCEL_INFO')[0].text
-            contact_info = record.xpath('CONTACTS')[0].text
-            vp_dates = record.xpath('VP_DATES')[0].text
-            if record.xpath('CURRENT_AUTHORITY')[0].text:
-                authority = self.save_or_get_authority(record.xpath('CURRENT_AUTHORITY')[0].text)
+            termination_cancel_info = record.termination_cancel_info
+            contact_info = record.contacts
+            vp_dates = record.vp_dates
+            if record.current_authority:
+                authority = self.save_or_get_authority(record.current_authority)
             else:
                 authority = None
-            fop_kveds = record.xpath('ACTIVITY_KINDS')[0]
-            exchange_data = record.xpath('EXCHANGE_DATA')[0]
+            fop_kveds = record.activity_kinds
+            exchange_data = record.exchange_data
             self.time_it('getting data from record')
-            fop = Fop.objects.filter(code=code).first()
-            self.time_it('trying get fops\t\t')
-            if not fop:
-                fop = Fop(
-                    fullname=fullname,
-                    address=address,
-                    status=status,
-                    registration_date=registration_date,
-                    registration_date_second=registration_date_second,
-                    registration_number=registration_number,
-                    registration_info=registration_info,
-                    estate_manager=estate_manager,
-                    termination_date=termination_date,
-                    terminated_info=terminated_info,
-                    termination_cancel_info=termination_cancel_info,
-                    contact_info=contact_info,
-                    vp_dates=vp_dates,
-                    authority=authority,
-                    code=code
-                )
-                self.bulk_manager.add(fop)
-                if len(fop_kveds):
-                    self.add_fop_kveds_to_dict(fop_kveds, code)
-                if len(exchange_data):
-                    self.add_fop_exchange_data_to_dict(exchange_data, code)
-                self.time_it('save fops\t\t')
-            else:
-                # TODO: make a decision: our algorithm when Fop changes fullname or address?
-                update_fields = []
-                if fop.status_id != status.id:
-                    fop.status_id = status.id
-                    update_fields.append('status_id')
-                if to_lower_string_if_exists(fop.registration_date) != registration_date:
-                    fop.registration_date = registration_date
-                    update_fields.append('registration_date')
-                if to_lower_string_if_exists(fop.registration_date_second) != registration_date_second:
-                    fop.registration_date_second = registration_date_second
-                    update_fields.append('registration_date_second')
-                if fop.registration_number != registration_number:
-                    fop.registration_number = registration_number
-                    update_fields.append('registration_number')
-                if fop.registration_info != registration_info:
-                    fop.registration_info = registration_info
-                    update_fields.append('registration_info')
-                if fop.estate_manager != estate_manager:
-                    fop.estate_manager = estate_manager
-                    update_fields.append('estate_manager')
-                if fop.termination_date and str(fop.termination_date) != termination_date:
-                    fop.termination_date = termination_date
-                    update_fields.append('termination_date')
-                if fop.terminated_info != terminated_info:
-                    fop.terminated_info = terminated_info
-                    update_fields.append('terminated_info')
-                if fop.termination_cancel_info != termination_cancel_info:
-                    fop.termination_cancel_info = termination_cancel_info
-                    update_fields.append('termination_cancel_info')
-                if fop.contact_info != contact_info:
-                    fop.contact_info = contact_info
-                    update_fields.append('contact_info')
-                if fop.vp_dates != vp_dates:
-                    fop.vp_dates = vp_dates
-                    update_fields.append('vp_dates')
-                if fop.authority_id != authority.id:
-                    fop.authority_id = authority.id
-                    update_fields.append('authority_id')
-                self.time_it('compare fops\t\t')
-                if len(update_fields):
-                    update_fields.append('updated_at')
-                    fop.save(update_fields=update_fields)
-                self.time_it('update fops\t\t')
-                if len(fop_kveds):
-                    self.update_fop_kveds(fop_kveds, fop)
-                self.time_it('delete outdated kveds\t')
-                if len(exchange_data):
-                    self.update_fop_exchange_data(exchange_data, fop)
-                self.time_it('update exchange_data\t')
-        if len(self.bulk_manager.queues['business_register.Fop']):
-            self.bulk_manager.commit(Fop)
-        for fop in self.bulk_manager.queues['business_register.Fop']:
-            if fop.code not in self.new_fops_foptokveds:
-                continue
-            foptokveds = self.new_fops_foptokveds[fop.code]
-            for foptokved in foptokveds:
-                foptokved.fop = fop
-                self.bulk_manager.add(foptokved)
+            fop_rows[code] = {
+                'fullname': fullname,
+                'address': address,
+                'status_id': status.id,
+                'registration_date': registration_date,
+                'registration_date_second': registration_date_second,
+                'registration_number': registration_number,
+                'registration_info': registration_info,
+                'estate_manager': estate_manager,
+                'termination_date': termination_date,
+                'terminated_info': terminated_info,
+                'termination_cancel_info': termination_cancel_info,
+                'contact_info': contact_info,
+                'vp_dates': vp_dates,
+                'authority_id': authority.id if authority else None,
+                'code': code,
+            }
+            fop_children[code] = (fop_kveds, exchange_data)
+
+        upsert_result = self.fop_upsert_manager.upsert(list(fop_rows.values()))
+        self.time_it('upsert fops\t\t')
+        for code, fop_id in upsert_result.inserted.items():
+            self.fingerprint_manager.add(code, fop_id)
+            fop_kveds, exchange_data = fop_children[code]
+            if len(fop_kveds):
+                self.add_fop_kveds_to_dict(fop_kveds, code)
+                for foptokved in self.new_fops_foptokveds.get(code, []):
+                    foptokved.fop_id = fop_id
+                    self.bulk_manager.add(foptokved)
+            if len(exchange_data):
+                self.add_fop_exchange_data_to_dict(exchange_data, code)
+                for exchangedata in self.new_fops_exchange_data.get(code, []):
+                    exchangedata.fop_id = fop_id
+                    self.bulk_manager.add(exchangedata)
         self.new_fops_foptokveds = {}
-        for fop in self.bulk_manager.queues['business_register.Fop']:
-            if fop.code not in self.new_fops_exchange_data:
-                continue
-            fop_exchangedata = self.new_fops_exchange_data[fop.code]
-            for exchangedata in fop_exchangedata:
-                exchangedata.fop = fop
-                self.bulk_manager.add(exchangedata)
         self.new_fops_exchange_data = {}
-        self.bulk_manager.queues['business_register.Fop'] = []
+        self.time_it('save fops\t\t')
+        stored_fops = {**upsert_result.updated, **upsert_result.unchanged}
+        # one query per table for the whole chunk
+        self.stored_foptokveds = self.put_objects_to_dict_of_lists(
+            'fop_id', FopToKved.objects.filter(fop_id__in=stored_fops.values())
+        )
+        self.stored_exchange_data = self.put_objects_to_dict_of_lists(
+            'fop_id', ExchangeDataFop.objects.filter(fop_id__in=stored_fops.values())
+        )
+        self.time_it('prefetch kveds and exchange_data')
+        for code, fop_id in stored_fops.items():
+            self.fingerprint_manager.add(code, fop_id)
+            fop_kveds, exchange_data = fop_children[code]
+            if len(fop_kveds):
+                self.update_fop_kveds(fop_kveds, fop_id)
+            self.time_it('delete outdated kveds\t')
+            if len(exchange_data):
+                self.update_fop_exchange_data(exchange_data, fop_id)
+            self.time_it('update exchange_data\t')
+        self.update_manager.commit()
         if len(self.bulk_manager.queues['business_register.FopToKved']):
             self.bulk_manager.commit(FopToKved)
         if len(self.bulk_manager.queues['business_register.ExchangeDataFop']):
             self.bulk_manager.commit(ExchangeDataFop)
         self.bulk_manager.queues['business_register.FopToKved'] = []
         self.bulk_manager.queues['business_register.ExchangeDataFop'] = []
+        self.fingerprint_manager.commit()
         self.time_it('save others\t\t')
 
     print("For storing run FopFullConverter().process()")
@@ -330,7 +284,8 @@ class FopFullDownloader(Downloader):
     reg_name = 'business_fop'
     zip_required_file_sign = 'ufop_full'
     unzip_required_file_sign = 'EDR_FOP_FULL'
-    unzip_after_download = True
+    stream_from_zip = True
+    download_segments = 4
     source_dataset_url = settings.BUSINESS_FOP_SOURCE_PACKAGE
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_FOP_FULL
 
@@ -348,27 +303,36 @@ class FopFullDownloader(Downloader):
     def get_source_file_name(self):
         return self.url.split('/')[-1]
 
-    def update(self):
+    def update(self, ignore_fingerprints=False):
+        """ ignore_fingerprints - save all the records of a new dump, also the ones not changed since the last one """
 
         logger.info(f'{self.reg_name}: Update started...')
 
-        self.report_init()
-        self.report.long_time_converter = True
-        self.report.save()
-        self.download()
-
-        self.LOCAL_FILE_NAME = self.file_name
-        self.remove_unreadable_characters()
+        self.report = self.get_unfinished_report()
+        if self.report:
+            checkpoint = (self.report.checkpoint_offset, self.report.checkpoint_index)
+            logger.info(f'{self.reg_name}: resuming the interrupted update from the record {checkpoint[1]}')
+        else:
+            checkpoint = None
+            self.report_init()
+            self.report.long_time_converter = True
+            self.report.save()
+            if not self.download():
+                self.report_not_modified()
+                return
 
-        self.report.update_start = timezone.now()
-        self.report.save()
+            self.report.update_start = timezone.now()
+            self.report.save()
 
         logger.info(f'{self.reg_name}: process() with {self.file_path} started ...')
         fop_full = FopFullConverter()
-        fop_full.LOCAL_FILE_NAME = self.file_name
+        fop_full.source_opener = self.open_source_stream
+        fop_full.report = self.report
+        if ignore_fingerprints and not checkpoint:
+            fop_full.fingerprint_manager.clear()
 
         sleep(5)
-        if fop_full.process():
+        if fop_full.process(checkpoint=checkpoint):
             logger.info(f'{self.reg_name}: process() with {self.file_path} finished successfully.')
             self.report.update_status = True
 
@@ -381,6 +345,8 @@ class FopFullDownloader(Downloader):
             self.update_register_field(settings.FOP_REGISTER_LIST, 'total_records', new_total_records)
             logger.info(f'{self.reg_name}: Update total records finished successfully.')
 
+            self.report.records_skipped = fop_full.records_skipped
+            self.report.records_processed = fop_full.records_processed
             self.measure_changes('business_register', 'Fop')
             logger.info(f'{self.reg_name}: Report created successfully.')
 
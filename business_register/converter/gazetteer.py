@@ -0,0 +1,83 @@
+from collections import Counter
+
+from location_register.models.address_models import Country
+from location_register.models.ratu_models import RatuRegion, RatuDistrict, RatuCity
+
+
+class Gazetteer:
+    """
+    Finds countries by NACP id and regions, districts and cities of RATU by name in memory.
+    All of them are loaded by load() once, so addresses of declarations are found without queries.
+    Names are compared in the form of normalize_name(), the same as the declaration addresses.
+    Names that are not found are counted in misses for checking the data.
+    """
+
+    def __init__(self):
+        self.countries = None
+        # {name: region}
+        self.regions = {}
+        # {(name, region_id): district}
+        self.districts = {}
+        # {(name, region_id, district_id): city}
+        self.cities = {}
+        self.misses = Counter()
+
+    @staticmethod
+    def normalize_name(name):
+        return ' '.join((name or '').lower().split())
+
+    def add_region(self, region):
+        # the first one of the duplicates is found, like .first() does
+        self.regions.setdefault(self.normalize_name(region.name), region)
+
+    def add_district(self, district):
+        self.districts.setdefault((self.normalize_name(district.name), district.region_id), district)
+
+    def add_city(self, city):
+        self.cities.setdefault((self.normalize_name(city.name), city.region_id, city.district_id), city)
+
+    def load(self):
+        if self.countries is not None:
+            return
+        self.countries = {country.nacp_id: country for country in Country.objects.filter(nacp_id__isnull=False)}
+        for region in RatuRegion.objects.order_by('id'):
+            self.add_region(region)
+        for district in RatuDistrict.objects.only('id', 'name', 'region_id').order_by('id'):
+            self.add_district(district)
+        for city in RatuCity.objects.only('id', 'name', 'region_id', 'district_id').order_by('id').iterator():
+            self.add_city(city)
+
+    def find(self, kind, index, key):
+        obj = index.get(key)
+        if not obj:
+            self.misses[kind] += 1
+        return obj
+
+    def get_country(self, nacp_id):
+        self.load()
+        return self.find('country', self.countries, int(nacp_id))
+
+    def get_region(self, name):
+        self.load()
+        name = self.normalize_name(name)
+        if not name:
+            return None
+        return self.find('region', self.regions, name)
+
+    def get_district(self, name, region):
+        self.load()
+        name = self.normalize_name(name)
+        if not name:
+            return None
+        return self.find('district', self.districts, (name, region.id if region else None))
+
+    def get_city(self, name, region, district):
+        self.load()
+        name = self.normalize_name(name)
+        if not name:
+            return None
+        return self.find('city', self.cities, (
+            name,
+            region.id if region else None,
+            district.id if district else None,
+        ))
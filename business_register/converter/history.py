@@ -4,19 +4,56 @@ from django.conf import settings
 
 from business_register.constants import HistoryTypes
 from business_register.models.company_models import Company, CompanyDetail, Signer, Founder
-from data_ocean.converter import Converter
+from data_ocean.converter import BulkCreateManager, Converter
 
 
-class AddressHistorical(Converter):
-    LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_ADDRESS
+class HistoricalConverter(Converter):
+    """
+    Base of the converters of the history files. Companies of a chunk and their related rows
+    are found by one query per model, historical rows of a chunk are saved by one COPY.
+    """
     LOCAL_FOLDER = settings.LOCAL_FOLDER
     CHUNK_SIZE = 2000
     RECORD_TAG = 'DATA_RECORD'
+    history_model = None
+
+    def __init__(self):
+        self.bulk_manager = BulkCreateManager(copy_models=[self.history_model])
+        super().__init__()
+
+    def get_companies(self, records):
+        # {edrpou: company}, the first company of the code like .first() returns
+        edrpous = {record.findtext('EDRPOU') for record in records} - {None, ''}
+        companies = {}
+        for company in Company.objects.filter(edrpou__in=edrpous).order_by('-id').only('id', 'edrpou', 'name'):
+            companies[company.edrpou] = company
+        return companies
+
+    def get_first_ids(self, model_class, companies):
+        # {company id: id of the first row of the company}
+        first_ids = {}
+        for company_id, object_id in model_class.objects.filter(
+                company_id__in=[company.id for company in companies.values()]
+        ).order_by('-id').values_list('company_id', 'id'):
+            first_ids[company_id] = object_id
+        return first_ids
+
+    def add(self, historical_object):
+        self.bulk_manager.add(historical_object)
+
+    def commit(self):
+        self.bulk_manager.commit(self.history_model)
+        self.bulk_manager.queues[self.history_model._meta.label] = []
+
+
+class AddressHistorical(HistoricalConverter):
+    LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_ADDRESS
     HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    history_model = HistoricalCompany
     tables = [HistoricalCompany]
-    create_queues = []
 
     def save_to_db(self, records):
+        companies = self.get_companies(records)
         for record in records:
             company = self.HistoricalCompany()
             company.edrpou = record.xpath('EDRPOU')[0].text
@@ -27,28 +64,26 @@ class AddressHistorical(Converter):
                 "%Y/%m/%d %H:%M:%S"
             ).strftime("%Y-%m-%d %H:%M:%S")
             try:
-                company_exists = Company.objects.filter(edrpou=company.edrpou).first()
+                company_exists = companies.get(company.edrpou)
                 company.id = company_exists.id
             except AttributeError:
                 company.id = 0  # for changed records that can't be assigned to existing company
             company.history_type = HistoryTypes.UPDATE
             company.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
             company.created_at = datetime.datetime.now()
-            self.create_queues.append(company)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
+            self.add(company)
+        self.commit()
 
 
-class SignerHistorical(Converter):
+class SignerHistorical(HistoricalConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_SIGNER
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
     HistoricalSigner = apps.get_model('business_register', 'HistoricalSigner')
+    history_model = HistoricalSigner
     tables = [HistoricalSigner]
-    create_queues = []
 
     def save_to_db(self, records):
+        companies = self.get_companies(records)
+        signer_ids = self.get_first_ids(Signer, companies)
         for record in records:
             signer = self.HistoricalSigner()
             edrpou = record.xpath('EDRPOU')[0].text
@@ -58,48 +93,50 @@ class SignerHistorical(Converter):
                 "%Y/%m/%d %H:%M:%S"
             ).strftime("%Y-%m-%d %H:%M:%S")
             try:
-                company_exists = Company.objects.filter(edrpou=edrpou).first()
+                company_exists = companies.get(edrpou)
                 signer.company = company_exists
             except AttributeError:
                 continue
-            try:
-                signer.id = Signer.objects.filter(company=company_exists).first().id
-            except AttributeError:
-                signer.id = 0  # for changed records that can't be assigned to existing company
+            # for changed records that can't be assigned to existing company
+            signer.id = signer_ids.get(company_exists.id, 0) if company_exists else 0
             signer.history_type = HistoryTypes.UPDATE
             signer.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
             signer.created_at = datetime.datetime.now()
-            self.create_queues.append(signer)
-        self.HistoricalSigner.objects.bulk_create(self.create_queues)
-        self.create_queues = []
+            self.add(signer)
+        self.commit()
 
 
-class FounderHistorical(Converter):
+class FounderHistorical(HistoricalConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_FOUNDER
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 1
-    RECORD_TAG = 'DATA_RECORD'
     HistoricalFounder = apps.get_model('business_register', 'HistoricalFounder')
+    history_model = HistoricalFounder
     DATE_OF_DATA_PURCHASE = '2019-06-07 15:25:48.000000'
     tables = []
 
     def save_to_db(self, records):
+        companies = self.get_companies(records)
+        # {(company id, name): id of the first founder}
+        founder_ids = {}
+        for company_id, name, founder_id in Founder.objects.filter(
+                company_id__in=[company.id for company in companies.values()]
+        ).order_by('-id').values_list('company_id', 'name', 'id'):
+            founder_ids[(company_id, name)] = founder_id
         for record in records:
             company_edrpou_info = record.xpath('EDRPOU')
             if not company_edrpou_info:
-                return
+                continue
             company_edrpou = company_edrpou_info[0].text
             if not company_edrpou:
-                return
-            company = Company.objects.filter(edrpou=company_edrpou).first()
+                continue
+            company = companies.get(company_edrpou)
             if not company:
-                return
+                continue
             founder_name_info = record.xpath('FOUNDER_NAME')
             if not founder_name_info:
-                return
+                continue
             founder_name = founder_name_info[0].text
             if not founder_name:
-                return
+                continue
             founder_name = founder_name.lower()
             founder_code = None
             founder_code_info = record.xpath('FOUNDER_CODE')
@@ -115,30 +152,25 @@ class FounderHistorical(Converter):
                 founder_equity = founder_equity_info[0].text
             if founder_equity:
                 founder_equity = float(founder_equity.replace(',', '.'))
-            existed_founder = Founder.objects.filter(company=company, name=founder_name)
-            if existed_founder:
-                founder_id = existed_founder.id
-            else:
-                founder_id = 0
+            founder_id = founder_ids.get((company.id, founder_name), 0)
             history_date = self.DATE_OF_DATA_PURCHASE
-            self.HistoricalFounder.objects.create(id=founder_id,
-                                                  created_at=datetime.datetime.now(),
-                                                  history_date=history_date,
-                                                  history_type=HistoryTypes.UPDATE,
-                                                  name=founder_name, edrpou=founder_edrpou,
-                                                  equity=founder_equity, company=company)
+            self.add(self.HistoricalFounder(id=founder_id,
+                                            created_at=datetime.datetime.now(),
+                                            history_date=history_date,
+                                            history_type=HistoryTypes.UPDATE,
+                                            name=founder_name, edrpou=founder_edrpou,
+                                            equity=founder_equity, company=company))
+        self.commit()
 
 
-class NameHistorical(Converter):
+class NameHistorical(HistoricalConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_NAME
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
     HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    history_model = HistoricalCompany
     tables = [HistoricalCompany]
-    create_queues = []
 
     def save_to_db(self, records):
+        companies = self.get_companies(records)
         for record in records:
             company = self.HistoricalCompany()
             company.edrpou = record.xpath('EDRPOU')[0].text
@@ -148,28 +180,25 @@ class NameHistorical(Converter):
                 "%Y/%m/%d %H:%M:%S"
             ).strftime("%Y-%m-%d %H:%M:%S")
             try:
-                company_exists = Company.objects.filter(edrpou=company.edrpou).first()
+                company_exists = companies.get(company.edrpou)
                 company.id = company_exists.id
             except AttributeError:
                 company.id = 0  # for changed records that can't be assigned to existing company
             company.history_type = HistoryTypes.UPDATE
             company.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
             company.created_at = datetime.datetime.now()
-            self.create_queues.append(company)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
+            self.add(company)
+        self.commit()
 
 
-class ShortNameHistorical(Converter):
+class ShortNameHistorical(HistoricalConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_SHORTNAME
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
     HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    history_model = HistoricalCompany
     tables = [HistoricalCompany]
-    create_queues = []
 
     def save_to_db(self, records):
+        companies = self.get_companies(records)
         for record in records:
             company = self.HistoricalCompany()
             company.edrpou = record.xpath('EDRPOU')[0].text
@@ -183,7 +212,7 @@ class ShortNameHistorical(Converter):
             ).strftime("%Y-%m-%d %H:%M:%S")
             name = ''
             try:
-                company_exists = Company.objects.filter(edrpou=company.edrpou).first()
+                company_exists = companies.get(company.edrpou)
                 company.id = company_exists.id
                 name = company_exists.name
             except AttributeError:
@@ -191,21 +220,19 @@ class ShortNameHistorical(Converter):
             company.history_type = HistoryTypes.UPDATE
             company.code = name + record.xpath('EDRPOU')[0].text
             company.created_at = datetime.datetime.now()
-            self.create_queues.append(company)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
+            self.add(company)
+        self.commit()
 
 
-class CapitalHistorical(Converter):
+class CapitalHistorical(HistoricalConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_CAPITAL
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
     HistoricalCompanyDetail = apps.get_model('business_register', 'HistoricalCompanyDetail')
+    history_model = HistoricalCompanyDetail
     tables = [HistoricalCompanyDetail]
-    create_queues = []
 
     def save_to_db(self, records):
+        companies = self.get_companies(records)
+        company_detail_ids = self.get_first_ids(CompanyDetail, companies)
         for record in records:
             company_detail = self.HistoricalCompanyDetail()
             edrpou = record.xpath('EDRPOU')[0].text
@@ -218,32 +245,27 @@ class CapitalHistorical(Converter):
                 "%Y/%m/%d %H:%M:%S"
             ).strftime("%Y-%m-%d %H:%M:%S")
             try:
-                company_exists = Company.objects.filter(edrpou=edrpou).first()
+                company_exists = companies.get(edrpou)
                 company_detail.company = company_exists
             except AttributeError:
                 continue
-            try:
-                company_detail.id = CompanyDetail.objects.filter(company=company_exists).first().id
-            except AttributeError:
-                company_detail.id = 0  # for changed records that can't be assigned
+            # for changed records that can't be assigned
+            company_detail.id = company_detail_ids.get(company_exists.id, 0) if company_exists else 0
             company_detail.history_type = HistoryTypes.UPDATE
             company_detail.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
             company_detail.created_at = datetime.datetime.now()
-            self.create_queues.append(company_detail)
-        self.HistoricalCompanyDetail.objects.bulk_create(self.create_queues)
-        self.create_queues = []
+            self.add(company_detail)
+        self.commit()
 
 
-class BranchHistorical(Converter):
+class BranchHistorical(HistoricalConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_BRANCH
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
     HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    history_model = HistoricalCompany
     tables = [HistoricalCompany]
-    create_queues = []
 
     def save_to_db(self, records):
+        companies = self.get_companies(records)
         for record in records:
             branch = self.HistoricalCompany()
             # branch.edrpou = record.xpath('')[0].text
@@ -257,8 +279,7 @@ class BranchHistorical(Converter):
                 "%Y/%m/%d %H:%M:%S"
             ).strftime("%Y-%m-%d %H:%M:%S")
             try:
-                company_exists = Company.objects.filter(
-                    edrpou=record.xpath('EDRPOU')[0].text).first()
+                company_exists = companies.get(record.xpath('EDRPOU')[0].text)
                 branch.id = company_exists.id
                 branch.parent = company_exists
             except AttributeError:
@@ -267,21 +288,18 @@ class BranchHistorical(Converter):
             branch.code = record.xpath('BRANCH_NAME')[0].text + \
                           branch.short_name
             branch.created_at = datetime.datetime.now()
-            self.create_queues.append(branch)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
+            self.add(branch)
+        self.commit()
 
 
-class InfoHistorical(Converter):
+class InfoHistorical(HistoricalConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_INFO
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
     HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    history_model = HistoricalCompany
     tables = [HistoricalCompany]
-    create_queues = []
 
     def save_to_db(self, records):
+        companies = self.get_companies(records)
         for record in records:
             company = self.HistoricalCompany()
             company.edrpou = record.xpath('EDRPOU')[0].text
@@ -314,13 +332,12 @@ class InfoHistorical(Converter):
                 "%Y/%m/%d %H:%M:%S"
             ).strftime("%Y-%m-%d %H:%M:%S")
             try:
-                company_exists = Company.objects.filter(edrpou=company.edrpou).first()
+                company_exists = companies.get(company.edrpou)
                 company.id = company_exists.id
             except AttributeError:
                 company.id = 0  # for changed records that can't be assigned to existing company
             company.history_type = HistoryTypes.UPDATE
             company.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
             company.created_at = datetime.datetime.now()
-            self.create_queues.append(company)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
+            self.add(company)
+        self.commit()
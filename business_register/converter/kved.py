@@ -139,7 +139,9 @@ class KvedDownloader(Downloader):
         logger.info(f'{self.reg_name}: Update started...')
 
         self.report_init()
-        self.download()
+        if not self.download():
+            self.report_not_modified()
+            return
 
         self.report.update_start = timezone.now()
         self.report.save()
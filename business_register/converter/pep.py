@@ -1,16 +1,18 @@
 import logging
+from contextlib import contextmanager
 from datetime import datetime, date
 
 import psycopg2
 import sshtunnel
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from requests.auth import HTTPBasicAuth
 
 from business_register.converter.business_converter import BusinessConverter
 from business_register.models.company_models import Company
 from business_register.models.pep_models import Pep, RelatedPersonsLink, CompanyLinkWithPep
-from data_ocean.converter import Converter
+from data_ocean.converter import BulkUpdateManager, Converter, soft_delete_by_ids
 from data_ocean.downloader import Downloader
 from data_ocean.utils import to_lower_string_if_exists
 from location_register.converter.address import AddressConverter
@@ -228,6 +230,23 @@ class PepConverterFromJson(BusinessConverter):
 
 class PepConverterFromDB(Converter):
     refresh_updated_at_field = True
+    # rows fetched from the source DB at once by a server-side cursor
+    BATCH_SIZE = 2000
+    PEP_FIELDS = (
+        'source_id', 'first_name', 'middle_name', 'last_name', 'fullname', 'fullname_en',
+        'fullname_transcriptions_eng', 'is_pep', 'date_of_birth', 'place_of_birth', 'sanctions',
+        'criminal_record', 'assets_info', 'criminal_proceedings', 'wanted', 'info', 'pep_type',
+        'reason_of_termination', 'is_dead', 'termination_date',
+    )
+    PEP_LINK_FIELDS = (
+        'from_person_id', 'to_person_id', 'from_person_relationship_type', 'to_person_relationship_type',
+        'from_person_relationship_type_en', 'to_person_relationship_type_en', 'category',
+        'start_date', 'confirmation_date', 'end_date',
+    )
+    PEP_COMPANY_FIELDS = (
+        'company_id', 'pep_id', 'category', 'start_date', 'confirmation_date', 'end_date',
+        'is_state_company', 'relationship_type', 'relationship_type_en',
+    )
 
     def __init__(self):
         self.host = settings.PEP_SOURCE_HOST
@@ -235,24 +254,18 @@ class PepConverterFromDB(Converter):
         self.database = settings.PEP_SOURCE_DATABASE
         self.user = settings.PEP_SOURCE_USER
         self.password = settings.PEP_SOURCE_PASSWORD
-        self.peps_dict = self.put_objects_to_dict('code', 'business_register', 'Pep')
-        self.outdated_peps_dict = self.put_objects_to_dict('code', 'business_register', 'Pep')
-        self.peps_links_dict = self.put_objects_to_dict(
-            'source_id',
-            'business_register',
-            'RelatedPersonsLink')
-        self.outdated_peps_links_dict = self.put_objects_to_dict(
-            'source_id',
-            'business_register',
-            'RelatedPersonsLink')
-        self.peps_companies_dict = self.put_objects_to_dict(
-            'source_id',
-            'business_register',
-            'CompanyLinkWithPep')
-        self.outdated_peps_companies_dict = self.put_objects_to_dict(
-            'source_id',
-            'business_register',
-            'CompanyLinkWithPep')
+        # {key: (id, hash of the fields)} of the stored rows, full objects are loaded only for the changed rows
+        self.peps_index = self.put_objects_to_index(Pep, 'code', self.PEP_FIELDS)
+        self.peps_links_index = self.put_objects_to_index(RelatedPersonsLink, 'source_id', self.PEP_LINK_FIELDS)
+        self.peps_companies_index = self.put_objects_to_index(CompanyLinkWithPep, 'source_id',
+                                                              self.PEP_COMPANY_FIELDS)
+        # keys of the rows found in the source, the other rows of the index are outdated
+        self.seen_peps = set()
+        self.seen_peps_links = set()
+        self.seen_peps_companies = set()
+        # ids of peps with changed links, their updated_at is refreshed at the end
+        self.changed_peps = set()
+        self.address_converter = AddressConverter()
         self.peps_total_records_from_source = 0
         self.peps_links_total_records_from_source = 0
         self.peps_companies_total_records_from_source = 0
@@ -384,11 +397,18 @@ class PepConverterFromDB(Converter):
             'свекруха': 'mother-in-laws',
         }
 
-    def get_pep_data(self, host=None, port=None):
+    def put_objects_to_index(self, model_class, key_field, fields):
+        # soft deleted rows have no hash, so they are always updated and restored
+        index = {}
+        for key, object_id, deleted_at, *values in model_class.include_deleted_objects.values_list(
+                key_field, 'id', 'deleted_at', *fields).iterator():
+            index[key] = (object_id, None if deleted_at else hash(tuple(values)))
+        return index
 
+    @contextmanager
+    def connect_to_source_db(self, host=None, port=None):
         host = host or self.host
         port = port or self.port
-
         logger.info(f'business_pep: psycopg2 connect to {host}:{port}...')
         connection = psycopg2.connect(
             host=host,
@@ -397,31 +417,21 @@ class PepConverterFromDB(Converter):
             user=self.user,
             password=self.password
         )
+        connection.set_session(readonly=True)
         logger.info(f'business_pep: psycopg2 connection is active: {not connection.closed}')
+        try:
+            yield connection
+        finally:
+            connection.close()
 
-        with connection.cursor() as cursor:
-            cursor.execute(self.PEP_QUERY)
-            pep_data = cursor.fetchall()
-            logger.info(f'business_pep: psycopg2 result data length: {len(pep_data)} elements.')
-
-            cursor.execute(self.PEPS_LINKS_QUERY)
-            pep_links_data = cursor.fetchall()
-            logger.info(f'business_pep: psycopg2 result data length: {len(pep_links_data)} elements.')
-
-            cursor.execute(self.PEPS_COMPANIES_QUERY)
-            pep_companies_data = cursor.fetchall()
-            logger.info(f'business_pep: psycopg2 result data length: {len(pep_companies_data)} elements.')
-
-        connection.close()
-
-        return pep_data, pep_links_data, pep_companies_data
-
-    def get_data_from_source_db(self):
-
+    @contextmanager
+    def get_source_db_connection(self):
         logger.info(f'business_pep: use SSH tunnel: {settings.PEP_SOURCE_USE_SSH}')
 
         if not settings.PEP_SOURCE_USE_SSH:
-            return self.get_pep_data()
+            with self.connect_to_source_db() as connection:
+                yield connection
+            return
 
         sshtunnel.TUNNEL_TIMEOUT = settings.PEP_TUNNEL_TIMEOUT
         sshtunnel.SSH_TIMEOUT = settings.PEP_SSH_TIMEOUT
@@ -436,210 +446,210 @@ class PepConverterFromDB(Converter):
                 f'business_pep: tunnel is active: {tunnel.is_active} on '
                 f'{tunnel.local_bind_host}:{tunnel.local_bind_port}'
             )
-            return self.get_pep_data(
+            with self.connect_to_source_db(
                 host=tunnel.local_bind_host,
                 port=tunnel.local_bind_port,
-            )
+            ) as connection:
+                yield connection
+
+    def iter_source_batches(self, connection, name, query):
+        """
+        yields lists of BATCH_SIZE rows of the query, the rows are streamed by a named (server-side) cursor,
+        so the whole result is never kept in memory
+        """
+        with connection.cursor(name=name) as cursor:
+            cursor.itersize = self.BATCH_SIZE
+            cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(self.BATCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+
+    def save_changed_objects(self, model_class, key_field, fields, index, rows):
+        """
+        rows - {key: dict of the fields} of a batch.
+        Saves new rows with one bulk_create and changed rows with one bulk_update, unchanged rows are skipped.
+        Returns the ids of the saved rows.
+        """
+        new_objects = []
+        changed_rows = {}
+        for key, values in rows.items():
+            values_hash = hash(tuple(values[field] for field in fields))
+            stored = index.get(key)
+            if not stored:
+                new_objects.append(model_class(**{key_field: key}, **values))
+            elif stored[1] != values_hash:
+                changed_rows[stored[0]] = values
+        saved_ids = []
+        if new_objects:
+            with transaction.atomic():
+                model_class.objects.bulk_create(new_objects)
+                # bulk_create doesn't write history like objects.create() does
+                if hasattr(model_class, 'history'):
+                    model_class.history.bulk_history_create(new_objects)
+            for obj in new_objects:
+                index[getattr(obj, key_field)] = (obj.id, hash(tuple(getattr(obj, field) for field in fields)))
+                saved_ids.append(obj.id)
+        if changed_rows:
+            update_fields = [*fields, 'deleted_at']
+            if self.refresh_updated_at_field:
+                update_fields.append('updated_at')
+            changed_objects = list(model_class.include_deleted_objects.filter(id__in=changed_rows))
+            for obj in changed_objects:
+                for field, value in changed_rows[obj.id].items():
+                    setattr(obj, field, value)
+                obj.deleted_at = None
+                # bulk_update doesn't set auto_now fields
+                obj.updated_at = timezone.now()
+                index[getattr(obj, key_field)] = (obj.id, hash(tuple(getattr(obj, field) for field in fields)))
+                saved_ids.append(obj.id)
+            with transaction.atomic():
+                model_class.include_deleted_objects.bulk_update(changed_objects, update_fields)
+                if hasattr(model_class, 'history'):
+                    model_class.history.bulk_history_create(changed_objects, update=True)
+        return saved_ids
+
+    def soft_delete_outdated(self, model_class, index, seen_keys):
+        outdated = {key: object_id for key, (object_id, values_hash) in index.items()
+                    if key not in seen_keys and values_hash is not None}
+        for key, object_id in outdated.items():
+            index[key] = (object_id, None)
+        soft_delete_by_ids(list(outdated.values()), [(model_class, 'id')])
+        return list(outdated.values())
+
+    def get_pep_id(self, pep_source_id):
+        # links of deleted peps are not saved
+        stored = self.peps_index.get(str(pep_source_id))
+        if not stored or stored[1] is None:
+            logger.info(f'No such pep in our DB. '
+                        f'Check records in the source DB with id {pep_source_id}')
+            self.invalid_data_counter += 1
+            return None
+        return stored[0]
 
     def save_or_update_peps_links(self, peps_links_data):
+        links = {}
         for link in peps_links_data:
-            is_changed = False
-            from_person_source_id = link[0]
-            from_person = self.peps_dict.get(str(from_person_source_id))
-            if not from_person:
-                logger.info(f'No such pep in our DB. '
-                            f'Check records in the source DB with id {from_person_source_id}')
-                self.invalid_data_counter += 1
+            from_person_id = self.get_pep_id(link[0])
+            if not from_person_id:
                 continue
-            to_person_source_id = link[1]
-            to_person = self.peps_dict.get(str(to_person_source_id))
-            if not to_person:
-                logger.info(f'No such pep in our DB. '
-                            f'Check records in the source DB with id {to_person_source_id}')
-                self.invalid_data_counter += 1
+            to_person_id = self.get_pep_id(link[1])
+            if not to_person_id:
                 continue
             from_person_relationship_type = link[2]
             to_person_relationship_type = link[3]
-            from_person_relationship_type_en = self.PEP_RELATIONSHIPS_TYPES_TO_EN.get(from_person_relationship_type)
-            to_person_relationship_type_en = self.PEP_RELATIONSHIPS_TYPES_TO_EN.get(to_person_relationship_type)
-            category = self.PEP_RELATIONSHIPS_TYPES_TO_CATEGORIES.get(from_person_relationship_type)
-            start_date = link[4]
-            confirmation_date = link[5]
-            end_date = link[6]
             source_id = link[7]
-
-            stored_link = self.peps_links_dict.get(source_id)
-            if not stored_link:
-                self.peps_links_dict[source_id] = RelatedPersonsLink.objects.create(
-                    from_person_id=from_person.id,
-                    to_person_id=to_person.id,
-                    from_person_relationship_type=from_person_relationship_type,
-                    to_person_relationship_type=to_person_relationship_type,
-                    from_person_relationship_type_en=from_person_relationship_type_en,
-                    to_person_relationship_type_en=to_person_relationship_type_en,
-                    category=category,
-                    start_date=start_date,
-                    confirmation_date=confirmation_date,
-                    end_date=end_date,
-                    source_id=source_id
-                )
-
-                is_changed = True
-            else:
-                update_fields = []
-                if stored_link.from_person_relationship_type != from_person_relationship_type:
-                    stored_link.from_person_relationship_type = from_person_relationship_type
-                    update_fields.append('from_person_relationship_type')
-                if stored_link.to_person_relationship_type != to_person_relationship_type:
-                    stored_link.to_person_relationship_type = to_person_relationship_type
-                    update_fields.append('to_person_relationship_type')
-                if stored_link.from_person_relationship_type_en != from_person_relationship_type_en:
-                    stored_link.from_person_relationship_type_en = from_person_relationship_type_en
-                    update_fields.append('from_person_relationship_type_en')
-                if stored_link.to_person_relationship_type_en != to_person_relationship_type_en:
-                    stored_link.to_person_relationship_type_en = to_person_relationship_type_en
-                    update_fields.append('to_person_relationship_type_en')
-                if stored_link.category != category:
-                    stored_link.category = category
-                    update_fields.append('category')
-                if stored_link.start_date != start_date:
-                    stored_link.start_date = start_date
-                    update_fields.append('start_date')
-                if stored_link.confirmation_date != confirmation_date:
-                    stored_link.confirmation_date = confirmation_date
-                    update_fields.append('confirmation_date')
-                if stored_link.end_date != end_date:
-                    stored_link.end_date = end_date
-                    update_fields.append('end_date')
-                if stored_link.source_id != source_id:
-                    stored_link.source_id = source_id
-                    update_fields.append('source_id')
-                if update_fields:
-                    update_fields.append('updated_at')
-                    stored_link.save(update_fields=update_fields)
-                    is_changed = True
-                if self.outdated_peps_links_dict.get(source_id):
-                    del self.outdated_peps_links_dict[source_id]
-            if is_changed and self.refresh_updated_at_field:
-                from_person.save(update_fields=['updated_at', ])
-                to_person.save(update_fields=['updated_at', ])
-        if self.outdated_peps_links_dict:
-            for link in self.outdated_peps_links_dict.values():
-                link.soft_delete()
-                link.from_person.save(update_fields=['updated_at', ])
-                link.to_person.save(update_fields=['updated_at', ])
-
-    def create_company_link_with_pep(self, company, pep, category, start_date, confirmation_date,
-                                     end_date, is_state_company, source_id, relationship_type, relationship_type_en):
-        self.peps_companies_dict[source_id] = CompanyLinkWithPep.objects.create(
-            company=company,
-            pep=pep,
-            category=category,
-            start_date=start_date,
-            confirmation_date=confirmation_date,
-            end_date=end_date,
-            is_state_company=is_state_company,
-            source_id=source_id,
-            relationship_type=relationship_type,
-            relationship_type_en=relationship_type_en
-        )
+            self.seen_peps_links.add(source_id)
+            links[source_id] = {
+                'from_person_id': from_person_id,
+                'to_person_id': to_person_id,
+                'from_person_relationship_type': from_person_relationship_type,
+                'to_person_relationship_type': to_person_relationship_type,
+                'from_person_relationship_type_en': self.PEP_RELATIONSHIPS_TYPES_TO_EN.get(
+                    from_person_relationship_type),
+                'to_person_relationship_type_en': self.PEP_RELATIONSHIPS_TYPES_TO_EN.get(
+                    to_person_relationship_type),
+                'category': self.PEP_RELATIONSHIPS_TYPES_TO_CATEGORIES.get(from_person_relationship_type),
+                'start_date': link[4],
+                'confirmation_date': link[5],
+                'end_date': link[6],
+            }
+        saved_ids = self.save_changed_objects(RelatedPersonsLink, 'source_id', self.PEP_LINK_FIELDS,
+                                              self.peps_links_index, links)
+        for from_person_id, to_person_id in RelatedPersonsLink.include_deleted_objects.filter(
+                id__in=saved_ids).values_list('from_person_id', 'to_person_id'):
+            self.changed_peps.update((from_person_id, to_person_id))
+
+    def delete_outdated_peps_links(self):
+        outdated_ids = self.soft_delete_outdated(RelatedPersonsLink, self.peps_links_index, self.seen_peps_links)
+        for from_person_id, to_person_id in RelatedPersonsLink.include_deleted_objects.filter(
+                id__in=outdated_ids).values_list('from_person_id', 'to_person_id'):
+            self.changed_peps.update((from_person_id, to_person_id))
+
+    def get_companies(self, peps_companies_data):
+        """
+        returns {antac_id: company} of the companies of the batch, companies that are not linked
+        with ANTAC DB yet are found by edrpou among the companies from our register
+        """
+        companies = {company.antac_id: company for company in Company.include_deleted_objects.filter(
+            antac_id__in={link[1] for link in peps_companies_data})}
+        edrpou_list = {link[6] for link in peps_companies_data if link[1] not in companies and link[6]}
+        companies_by_edrpou = {}
+        for company in Company.include_deleted_objects.filter(
+                edrpou__in=edrpou_list,
+                source=Company.UKRAINE_REGISTER
+        ).order_by('id'):
+            # the first one of the duplicates, like .first() does
+            companies_by_edrpou.setdefault(company.edrpou, company)
+        return companies, companies_by_edrpou
 
     def save_or_update_peps_companies(self, peps_companies_data):
-        address_converter = AddressConverter()
+        companies, companies_by_edrpou = self.get_companies(peps_companies_data)
+        changed_companies = {}
+        new_companies = {}
+        links = {}
         for link in peps_companies_data:
-            is_changed = False
-            pep_source_id = link[0]
-            pep = self.peps_dict.get(str(pep_source_id))
-            if not pep:
-                logger.info(f'No such pep in our DB. '
-                            f'Check records in the source DB with id {pep_source_id}')
-                self.invalid_data_counter += 1
+            pep_id = self.get_pep_id(link[0])
+            if not pep_id:
                 continue
             company_antac_id = link[1]
-            start_date = link[2]
-            confirmation_date = link[3]
-            end_date = link[4]
-            category = link[5]
             edrpou = link[6]
-            is_state_company = link[7]
             company_name = link[9]
             country_name = link[10]
             source_id = link[11]
             company_name_en = link[12]
             if not company_name_en:
                 company_name_en = transliterate(translate_company_type_in_string(company_name))
-            relationship_type = link[13]
-            relationship_type_en = link[14]
-            country = address_converter.save_or_get_country(country_name) if country_name else None
-            company = Company.include_deleted_objects.filter(antac_id=company_antac_id).first()
-            company_update_fields = []
+            company = companies.get(company_antac_id)
             if not company and edrpou:
-                company = Company.include_deleted_objects.filter(
-                    edrpou=edrpou,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                company = companies_by_edrpou.get(edrpou)
                 if company:
                     company.antac_id = company_antac_id
-                    company_update_fields.append('antac_id')
+                    companies[company_antac_id] = company
+                    changed_companies[company.id] = company
             if not company:
-                company = Company.objects.create(name=company_name, name_en=company_name_en, edrpou=edrpou,
-                                                 country=country, code=company_name + edrpou, source=Company.ANTAC,
-                                                 antac_id=company_antac_id, from_antac_only=True)
-                self.create_company_link_with_pep(company, pep, category, start_date,
-                                                  confirmation_date, end_date, is_state_company,
-                                                  source_id, relationship_type, relationship_type_en)
-                is_changed = True
-            else:
-                if company.name_en != company_name_en:
-                    company.name_en = company_name_en
-                    company_update_fields.append('name_en')
-                if company_update_fields:
-                    company_update_fields.append('updated_at')
-                    company.save(update_fields=company_update_fields)
-                already_stored_link = self.peps_companies_dict.get(source_id)
-                if not already_stored_link:
-                    self.create_company_link_with_pep(company, pep, category, start_date,
-                                                      confirmation_date, end_date, is_state_company,
-                                                      source_id, relationship_type, relationship_type_en)
-                    is_changed = True
-                else:
-                    update_fields = []
-                    if already_stored_link.category != category:
-                        already_stored_link.category = category
-                        update_fields.append('category')
-                    if already_stored_link.relationship_type != relationship_type:
-                        already_stored_link.relationship_type = relationship_type
-                        update_fields.append('relationship_type')
-                    if already_stored_link.relationship_type_en != relationship_type_en:
-                        already_stored_link.relationship_type_en = relationship_type_en
-                        update_fields.append('relationship_type_en')
-                    if already_stored_link.start_date != start_date:
-                        already_stored_link.start_date = start_date
-                        update_fields.append('start_date')
-                    if already_stored_link.confirmation_date != confirmation_date:
-                        already_stored_link.confirmation_date = confirmation_date
-                        update_fields.append('confirmation_date')
-                    if already_stored_link.end_date != end_date:
-                        already_stored_link.end_date = end_date
-                        update_fields.append('end_date')
-                    if already_stored_link.is_state_company != is_state_company:
-                        already_stored_link.is_state_company = is_state_company
-                        update_fields.append('is_state_company')
-                    if already_stored_link.source_id != source_id:
-                        already_stored_link.source_id = source_id
-                        update_fields.append('source_id')
-                    if update_fields:
-                        update_fields.append('updated_at')
-                        already_stored_link.save(update_fields=update_fields)
-                        is_changed = True
-                    if self.outdated_peps_companies_dict.get(source_id):
-                        del self.outdated_peps_companies_dict[source_id]
-            if is_changed and self.refresh_updated_at_field:
-                pep.save(update_fields=['updated_at', ])
-        if self.outdated_peps_companies_dict:
-            for link in self.outdated_peps_companies_dict.values():
-                link.soft_delete()
-                link.pep.save(update_fields=['updated_at', ])
+                country = self.address_converter.save_or_get_country(country_name) if country_name else None
+                company = Company(name=company_name, name_en=company_name_en, edrpou=edrpou,
+                                  country=country, code=company_name + edrpou, source=Company.ANTAC,
+                                  antac_id=company_antac_id, from_antac_only=True)
+                companies[company_antac_id] = company
+                new_companies[company_antac_id] = company
+            elif company.name_en != company_name_en:
+                company.name_en = company_name_en
+                if company.id:
+                    changed_companies[company.id] = company
+            self.seen_peps_companies.add(source_id)
+            links[source_id] = {
+                'company': company,
+                'pep_id': pep_id,
+                'category': link[5],
+                'start_date': link[2],
+                'confirmation_date': link[3],
+                'end_date': link[4],
+                'is_state_company': link[7],
+                'relationship_type': link[13],
+                'relationship_type_en': link[14],
+            }
+        if new_companies:
+            Company.objects.bulk_create(new_companies.values())
+        if changed_companies:
+            bulk_manager = BulkUpdateManager()
+            for company in changed_companies.values():
+                bulk_manager.add(company, ['antac_id', 'name_en'])
+            bulk_manager.commit()
+        for values in links.values():
+            values['company_id'] = values.pop('company').id
+        saved_ids = self.save_changed_objects(CompanyLinkWithPep, 'source_id', self.PEP_COMPANY_FIELDS,
+                                              self.peps_companies_index, links)
+        self.changed_peps.update(CompanyLinkWithPep.include_deleted_objects.filter(
+            id__in=saved_ids).values_list('pep_id', flat=True))
+
+    def delete_outdated_peps_companies(self):
+        outdated_ids = self.soft_delete_outdated(CompanyLinkWithPep, self.peps_companies_index,
+                                                 self.seen_peps_companies)
+        self.changed_peps.update(CompanyLinkWithPep.include_deleted_objects.filter(
+            id__in=outdated_ids).values_list('pep_id', flat=True))
 
     def parse_date_of_birth(self, date_of_birth):
         if isinstance(date_of_birth, date) or isinstance(date_of_birth, datetime):
@@ -660,147 +670,80 @@ class PepConverterFromDB(Converter):
         return date_of_birth
 
     def save_or_update_peps(self, peps_data):
+        peps = {}
         for pep_data in peps_data:
             source_id = pep_data[0]
             code = str(source_id)
             last_name = pep_data[1].lower()
             first_name = pep_data[2].lower()
             middle_name = pep_data[3].lower()
-            fullname = f'{last_name} {first_name} {middle_name}'
             last_name_en = pep_data[4].lower()
             first_name_en = pep_data[5].lower()
             middle_name_en = pep_data[6].lower()
-            fullname_en = f'{last_name_en} {first_name_en} {middle_name_en}'
-            fullname_transcriptions_eng = pep_data[7].lower()
-            is_pep = pep_data[8]
-            date_of_birth = self.parse_date_of_birth(pep_data[9])
-            place_of_birth = to_lower_string_if_exists(pep_data[10])
-            sanctions = pep_data[12]
-            criminal_record = pep_data[14]
-            assets_info = pep_data[16]
-            criminal_proceedings = pep_data[18]
-            wanted = pep_data[20]
-            info = pep_data[22]
             pep_type_number = pep_data[24]
-            pep_type = self.PEP_TYPES.get(pep_type_number) if pep_type_number else None
             reason_of_termination_number = pep_data[25]
-            reason_of_termination = (self.REASONS_OF_TERMINATION.get(reason_of_termination_number)
-                                     if reason_of_termination_number else None)
-            is_dead = (reason_of_termination_number == 1)
-            termination_date = pep_data[26]
-            pep = self.peps_dict.get(code)
-            if not pep:
-                pep = Pep.objects.create(
-                    source_id=source_id,
-                    code=code,
-                    first_name=first_name,
-                    middle_name=middle_name,
-                    last_name=last_name,
-                    fullname=fullname,
-                    fullname_en=fullname_en,
-                    fullname_transcriptions_eng=fullname_transcriptions_eng,
-                    is_pep=is_pep,
-                    date_of_birth=date_of_birth,
-                    place_of_birth=place_of_birth,
-                    sanctions=sanctions,
-                    criminal_record=criminal_record,
-                    assets_info=assets_info,
-                    criminal_proceedings=criminal_proceedings,
-                    wanted=wanted,
-                    info=info,
-                    pep_type=pep_type,
-                    reason_of_termination=reason_of_termination,
-                    is_dead=is_dead,
-                    termination_date=termination_date,
-                )
-                self.peps_dict[code] = pep
-            else:
-                update_fields = []
-                if pep.source_id != source_id:
-                    pep.source_id = source_id
-                    update_fields.append('source_id')
-                if pep.first_name != first_name:
-                    pep.first_name = first_name
-                    update_fields.append('first_name')
-                if pep.middle_name != middle_name:
-                    pep.middle_name = middle_name
-                    update_fields.append('middle_name')
-                if pep.last_name != last_name:
-                    pep.last_name = last_name
-                    update_fields.append('last_name')
-                if pep.fullname != fullname:
-                    pep.fullname = fullname
-                    update_fields.append('fullname')
-                if pep.fullname_en != fullname_en:
-                    pep.fullname_en = fullname_en
-                    update_fields.append('fullname_en')
-                if pep.fullname_transcriptions_eng != fullname_transcriptions_eng:
-                    pep.fullname_transcriptions_eng = fullname_transcriptions_eng
-                    update_fields.append('fullname_transcriptions_eng')
-                if pep.is_pep != is_pep:
-                    pep.is_pep = is_pep
-                    update_fields.append('is_pep')
-                if pep.date_of_birth != date_of_birth:
-                    pep.date_of_birth = date_of_birth
-                    update_fields.append('date_of_birth')
-                if pep.place_of_birth != place_of_birth:
-                    pep.place_of_birth = place_of_birth
-                    update_fields.append('place_of_birth')
-                if pep.sanctions != sanctions:
-                    pep.sanctions = sanctions
-                    update_fields.append('sanctions')
-                if pep.criminal_record != criminal_record:
-                    pep.criminal_record = criminal_record
-                    update_fields.append('criminal_record')
-                if pep.assets_info != assets_info:
-                    pep.assets_info = assets_info
-                    update_fields.append('assets_info')
-                if pep.criminal_proceedings != criminal_proceedings:
-                    pep.criminal_proceedings = criminal_proceedings
-                    update_fields.append('criminal_proceedings')
-                if pep.wanted != wanted:
-                    pep.wanted = wanted
-                    update_fields.append('wanted')
-                if pep.info != info:
-                    pep.info = info
-                    update_fields.append('info')
-                if pep.pep_type != pep_type:
-                    pep.pep_type = pep_type
-                    update_fields.append('pep_type')
-                if pep.reason_of_termination != reason_of_termination:
-                    pep.reason_of_termination = reason_of_termination
-                    update_fields.append('reason_of_termination')
-                if pep.is_dead != is_dead:
-                    pep.is_dead = is_dead
-                    update_fields.append('is_dead')
-                if pep.termination_date != termination_date:
-                    pep.termination_date = termination_date
-                    update_fields.append('termination_date')
-                if len(update_fields):
-                    if self.refresh_updated_at_field:
-                        update_fields.append('updated_at')
-                    pep.save(update_fields=update_fields)
-                del self.outdated_peps_dict[code]
-        if self.outdated_peps_dict:
-            for pep in self.outdated_peps_dict.values():
-                pep.soft_delete()
+            self.seen_peps.add(code)
+            peps[code] = {
+                'source_id': source_id,
+                'first_name': first_name,
+                'middle_name': middle_name,
+                'last_name': last_name,
+                'fullname': f'{last_name} {first_name} {middle_name}',
+                'fullname_en': f'{last_name_en} {first_name_en} {middle_name_en}',
+                'fullname_transcriptions_eng': pep_data[7].lower(),
+                'is_pep': pep_data[8],
+                'date_of_birth': self.parse_date_of_birth(pep_data[9]),
+                'place_of_birth': to_lower_string_if_exists(pep_data[10]),
+                'sanctions': pep_data[12],
+                'criminal_record': pep_data[14],
+                'assets_info': pep_data[16],
+                'criminal_proceedings': pep_data[18],
+                'wanted': pep_data[20],
+                'info': pep_data[22],
+                'pep_type': self.PEP_TYPES.get(pep_type_number) if pep_type_number else None,
+                'reason_of_termination': (self.REASONS_OF_TERMINATION.get(reason_of_termination_number)
+                                          if reason_of_termination_number else None),
+                'is_dead': reason_of_termination_number == 1,
+                'termination_date': pep_data[26],
+            }
+        self.save_changed_objects(Pep, 'code', self.PEP_FIELDS, self.peps_index, peps)
+
+    def delete_outdated_peps(self):
+        self.soft_delete_outdated(Pep, self.peps_index, self.seen_peps)
+
+    def refresh_changed_peps(self):
+        if self.changed_peps and self.refresh_updated_at_field:
+            Pep.objects.filter(id__in=self.changed_peps).update(updated_at=timezone.now())
+        self.changed_peps = set()
 
     def process(self):
-        peps_data, peps_links_data, pep_companies_data = self.get_data_from_source_db()
-        self.peps_total_records_from_source = len(peps_data)
-        self.peps_links_total_records_from_source = len(peps_links_data)
-        self.peps_companies_total_records_from_source = len(pep_companies_data)
-        logger.info(f'business_pep: save_or_update_peps started with {len(peps_data)} elements ...')
-        self.save_or_update_peps(peps_data)
-        logger.info(f'business_pep: save_or_update_peps finished.')
-
-        logger.info(f'business_pep: save_pep_links started with {len(peps_links_data)} elements ...')
-        self.save_or_update_peps_links(peps_links_data)
-        logger.info(f'business_pep: save_pep_links finish.')
-
-        logger.info(f'business_pep: save_pep_links started with {len(pep_companies_data)} elements ...')
-        self.save_or_update_peps_companies(pep_companies_data)
-        logger.info(f'business_pep: save_pep_links finish.')
+        with self.get_source_db_connection() as connection:
+            logger.info('business_pep: save_or_update_peps started ...')
+            for peps_data in self.iter_source_batches(connection, 'business_pep_persons', self.PEP_QUERY):
+                self.peps_total_records_from_source += len(peps_data)
+                self.save_or_update_peps(peps_data)
+            self.delete_outdated_peps()
+            logger.info(f'business_pep: save_or_update_peps finished with '
+                        f'{self.peps_total_records_from_source} elements.')
+
+            logger.info('business_pep: save_pep_links started ...')
+            for peps_links_data in self.iter_source_batches(connection, 'business_pep_links',
+                                                            self.PEPS_LINKS_QUERY):
+                self.peps_links_total_records_from_source += len(peps_links_data)
+                self.save_or_update_peps_links(peps_links_data)
+            self.delete_outdated_peps_links()
+            logger.info(f'business_pep: save_pep_links finished with '
+                        f'{self.peps_links_total_records_from_source} elements.')
+
+            logger.info('business_pep: save_pep_companies started ...')
+            for pep_companies_data in self.iter_source_batches(connection, 'business_pep_companies',
+                                                               self.PEPS_COMPANIES_QUERY):
+                self.peps_companies_total_records_from_source += len(pep_companies_data)
+                self.save_or_update_peps_companies(pep_companies_data)
+            self.delete_outdated_peps_companies()
+            logger.info(f'business_pep: save_pep_companies finished with '
+                        f'{self.peps_companies_total_records_from_source} elements.')
+        self.refresh_changed_peps()
 
 
 class PepDownloader(Downloader):
@@ -0,0 +1,106 @@
+from data_ocean.record_schema import Collection, Group, RecordSchema, Text
+
+# schemas of the records of the EDR (Unified State Register) datasets
+
+ACTIVITY_KIND = RecordSchema('ActivityKind', [
+    Text('CODE'),
+    Text('NAME'),
+    Text('PRIMARY'),
+])
+
+EXCHANGE_ANSWER = RecordSchema('ExchangeAnswer', [
+    Text('AUTHORITY_NAME'),
+    Text('TAX_PAYER_TYPE'),
+    Text('START_DATE'),
+    Text('START_NUM'),
+    Text('END_DATE'),
+    Text('END_NUM'),
+])
+
+# item of ASSIGNEES and PREDECESSORS
+RELATED_COMPANY = RecordSchema('RelatedCompany', [
+    Text('NAME'),
+    Text('CODE'),
+])
+
+BRANCH = RecordSchema('Branch', [
+    Text('CODE'),
+    Text('NAME'),
+    Text('ADDRESS'),
+    Text('CREATE_DATE'),
+    Text('CONTACTS'),
+    Text('SIGNER'),
+    Collection('ACTIVITY_KINDS', ACTIVITY_KIND),
+    Collection('EXCHANGE_DATA', EXCHANGE_ANSWER),
+])
+
+TERMINATION_STARTED_INFO = RecordSchema('TerminationStartedInfo', [
+    Text('OP_DATE'),
+    Text('REASON'),
+    Text('SBJ_STATE'),
+    Text('SIGNER_NAME'),
+    Text('CREDITOR_REQ_END_DATE'),
+])
+
+BANKRUPTCY_READJUSTMENT_INFO = RecordSchema('BankruptcyReadjustmentInfo', [
+    Text('OP_DATE'),
+    Text('REASON'),
+    Text('SBJ_STATE'),
+    Text('BANKRUPTCY_READJUSTMENT_HEAD_NAME'),
+])
+
+# SUBJECT of EDR_UO_FULL
+UKR_COMPANY_FULL = RecordSchema('UkrCompanyRecord', [
+    Text('NAME'),
+    Text('SHORT_NAME'),
+    Text('EDRPOU'),
+    Text('ADDRESS'),
+    Text('STAN'),
+    Text('FOUNDING_DOCUMENT_NUM'),
+    Text('EXECUTIVE_POWER'),
+    Text('SUPERIOR_MANAGEMENT'),
+    Text('MANAGING_PAPER'),
+    Text('TERMINATED_INFO'),
+    Text('TERMINATION_CANCEL_INFO'),
+    Text('CONTACTS'),
+    Text('VP_DATES'),
+    Text('CURRENT_AUTHORITY'),
+    Text('AUTHORIZED_CAPITAL'),
+    Text('OPF'),
+    Text('STATUTE'),
+    Text('REGISTRATION'),
+    Collection('FOUNDERS'),
+    Collection('BENEFICIARIES'),
+    Collection('ACTIVITY_KINDS', ACTIVITY_KIND),
+    Collection('SIGNERS'),
+    Collection('PREDECESSORS', RELATED_COMPANY),
+    Collection('ASSIGNEES', RELATED_COMPANY),
+    Collection('EXCHANGE_DATA', EXCHANGE_ANSWER),
+    Collection('BRANCHES', BRANCH),
+    Group('TERMINATION_STARTED_INFO', TERMINATION_STARTED_INFO),
+    Group('BANKRUPTCY_READJUSTMENT_INFO', BANKRUPTCY_READJUSTMENT_INFO),
+])
+
+# SUBJECT of EDR_FOP_FULL
+FOP_FULL = RecordSchema('FopFullRecord', [
+    Text('NAME'),
+    Text('ADDRESS'),
+    Text('STAN'),
+    Text('REGISTRATION'),
+    Text('ESTATE_MANAGER'),
+    Text('TERMINATED_INFO'),
+    Text('TERMINATION_CANCEL_INFO'),
+    Text('CONTACTS'),
+    Text('VP_DATES'),
+    Text('CURRENT_AUTHORITY'),
+    Collection('ACTIVITY_KINDS', ACTIVITY_KIND),
+    Collection('EXCHANGE_DATA', EXCHANGE_ANSWER),
+])
+
+# RECORD of the short FOP dataset
+FOP = RecordSchema('FopRecord', [
+    Text('FIO'),
+    Text('ADDRESS'),
+    Text('KVED'),
+    Text('STAN'),
+])
@@ -7,6 +7,18 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('start_index', nargs='?', type=int, default=0)
+        parser.add_argument(
+            '-w', '--workers', type=int, default=1,
+            help='number of worker processes that save records to DB',
+        )
+        parser.add_argument(
+            '--ignore-fingerprints', action='store_true',
+            help='save all the records, also the ones not changed since the last import, '
+                 'for example after a fix of the converter',
+        )
 
     def handle(self, *args, **options):
-        UkrCompanyFullConverter().process(options['start_index'])
+        converter = UkrCompanyFullConverter()
+        if options['ignore_fingerprints']:
+            converter.fingerprint_manager.clear()
+        converter.process(options['start_index'], options['workers'])
@@ -24,6 +24,8 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--pep_source_id', nargs='?', type=int)
         parser.add_argument('--pep_id', nargs='?', type=int)
+        parser.add_argument('--replay', action='store_true',
+                            help='parse again the declarations stored locally, without requests to NACP')
 
     def add_pep_to_savepoint(self, nacp_declarant_id):
         if not self.is_pep_saved(nacp_declarant_id):
@@ -34,27 +36,40 @@ class Command(BaseCommand):
         return int(nacp_declarant_id) in self.peps_with_saved_declarations
 
     def load_one(self, pep: Pep):
-        for nacp_id in pep.nacp_id:
-            if not self.is_pep_saved(nacp_id):
-                self.converter.save_declarations_for_pep(nacp_declarant_id=nacp_id)
-                self.add_pep_to_savepoint(nacp_id)
+        self.converter.save_declarations(
+            [nacp_id for nacp_id in pep.nacp_id if not self.is_pep_saved(nacp_id)],
+            on_declarant_saved=self.add_pep_to_savepoint,
+        )
 
     def load_all(self):
         i = 0
-        for nacp_declarant_id in self.converter.only_peps:
+
+        def on_declarant_saved(nacp_declarant_id):
+            nonlocal i
             i += 1
-            self.stdout.write(f'\rStart process for pep #{i}', ending='')
+            self.add_pep_to_savepoint(nacp_declarant_id)
+            self.stdout.write(f'\rSaved declarations of pep #{i}', ending='')
             self.stdout.flush()
-            if not self.is_pep_saved(nacp_declarant_id):
-                self.converter.save_declarations_for_pep(nacp_declarant_id=nacp_declarant_id)
-                self.add_pep_to_savepoint(nacp_declarant_id)
+
+        self.converter.save_declarations(
+            [nacp_declarant_id for nacp_declarant_id in self.converter.only_peps
+             if not self.is_pep_saved(nacp_declarant_id)],
+            on_declarant_saved=on_declarant_saved,
+        )
         self.stdout.write()
 
     def handle(self, *args, **options):
         pep_source_id = options['pep_source_id']
         pep_id = options['pep_id']
 
-        if pep_source_id:
+        if options['replay']:
+            pep = None
+            if pep_source_id:
+                pep = Pep.objects.get(source_id=pep_source_id)
+            elif pep_id:
+                pep = Pep.objects.get(id=pep_id)
+            self.converter.replay_declarations(pep.nacp_id if pep else None)
+        elif pep_source_id:
             self.load_one(Pep.objects.get(source_id=pep_source_id))
         elif pep_id:
             self.load_one(Pep.objects.get(id=pep_id))
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.12 on 2026-10-18 21:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('business_register', '0149_intangibleasset_intangibleassetright'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='last_seen_run',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -90,7 +90,9 @@ class Company(DataOceanModel):  # constraint for not null in both name & short_n
     source = models.CharField(_('source'), max_length=5, choices=SOURCES, null=True,
                               blank=True, default=None, db_index=True, help_text='Source')
     code = models.CharField(_('our code'), max_length=510, db_index=True, help_text='Our code')
-    history = HistoricalRecords()
+    # data_ocean.models.ImportRun that found the company in the source last time
+    last_seen_run = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    history = HistoricalRecords(excluded_fields=['last_seen_run'])
 
     @property
     def founder_of(self):
@@ -27,13 +27,13 @@ def update_fop():
 
 
 @shared_task
-def update_fop_full():
+def update_fop_full(ignore_fingerprints=False):
     print('***************************')
     print('*    Update FOP (FULL)    *')
     print('***************************')
 
     from business_register.converter.fop_full import FopFullDownloader
-    FopFullDownloader().update()
+    FopFullDownloader().update(ignore_fingerprints=ignore_fingerprints)
 
     print('*** Task update_fop_full is done. ***')
 
@@ -51,13 +51,13 @@ def update_ukr_company():
 
 
 @shared_task
-def update_ukr_company_full():
+def update_ukr_company_full(ignore_fingerprints=False):
     print('*********************************')
     print('*   Update UKR Company (FULL)   *')
     print('*********************************')
 
     from business_register.converter.company_converters.ukr_company_full import UkrCompanyFullDownloader
-    UkrCompanyFullDownloader().update()
+    UkrCompanyFullDownloader().update(ignore_fingerprints=ignore_fingerprints)
 
     print('*** Task update_ukr_company_full is done. ***')
 
@@ -1,3 +1,289 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from business_register.converter.declaration_fetcher import DeclarationFetcher
+from business_register.converter.declaration_store import DeclarationStore
+from business_register.converter.fop_full import FopFullDownloader
+from business_register.converter.gazetteer import Gazetteer
+from data_ocean.models import Report
+from location_register.models.address_models import Country
+from location_register.models.ratu_models import RatuRegion, RatuDistrict, RatuCity
+
+
+class StubNacpHandler(BaseHTTPRequestHandler):
+    # GET /list/?user_declarant_id=<n> answers n declarations, GET /documents/<id> answers the document,
+    # declarant 404 and document '3-1' are not found, the first failures requests get 503
+    delay = 0.05
+    failures = 0
+    paths = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data=None):
+        body = json.dumps({'data': data}).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        type(self).paths.append(self.path)
+        if type(self).failures:
+            type(self).failures -= 1
+            self.send_json(503)
+            return
+        url = urlparse(self.path)
+        if url.path == '/list/':
+            declarant_id = int(parse_qs(url.query)['user_declarant_id'][0])
+            if declarant_id == 404:
+                self.send_json(404)
+                return
+            # later declarants are answered faster, so the results come out of order
+            time.sleep(self.delay / declarant_id)
+            self.send_json(200, [
+                {'id': f'{declarant_id}-{number}', 'declaration_type': 1}
+                for number in range(declarant_id)
+            ])
+            return
+        declaration_id = url.path.split('/')[-1]
+        if declaration_id == '3-1':
+            self.send_json(404)
+            return
+        time.sleep(self.delay / (int(declaration_id.split('-')[1]) + 1))
+        self.send_json(200, {'step_1': declaration_id})
+
+
+class DeclarationFetcherTestCase(SimpleTestCase):
+    def setUp(self):
+        StubNacpHandler.failures = 0
+        StubNacpHandler.paths = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubNacpHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{self.server.server_port}'
+        self.fetcher = DeclarationFetcher(workers=4, requests_per_second=1000,
+                                          list_url=f'{url}/list/', retrieve_url=f'{url}/documents/')
+        self.fetcher.session.adapters['http://'].max_retries.backoff_factor = 0
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_iter_declarations(self):
+        self.assertEqual(list(self.fetcher.iter_declarations([1, 404, 3, 2])), [
+            (1, [({'id': '1-0', 'declaration_type': 1}, {'step_1': '1-0'})]),
+            (404, []),
+            (3, [
+                ({'id': '3-0', 'declaration_type': 1}, {'step_1': '3-0'}),
+                ({'id': '3-1', 'declaration_type': 1}, None),
+                ({'id': '3-2', 'declaration_type': 1}, {'step_1': '3-2'}),
+            ]),
+            (2, [
+                ({'id': '2-0', 'declaration_type': 1}, {'step_1': '2-0'}),
+                ({'id': '2-1', 'declaration_type': 1}, {'step_1': '2-1'}),
+            ]),
+        ])
+
+    def test_is_needed(self):
+        declarations = list(self.fetcher.iter_declarations(
+            [2, 3], lambda declaration_data: declaration_data['id'].endswith('-1')
+        ))
+        self.assertEqual([
+            (declarant_id, [declaration_data['id'] for declaration_data, document in declarations])
+            for declarant_id, declarations in declarations
+        ], [(2, ['2-1']), (3, ['3-1'])])
+        # documents that are not needed are not requested
+        self.assertEqual(len(StubNacpHandler.paths), 4)
+
+    def test_retries(self):
+        StubNacpHandler.failures = 2
+        self.assertEqual(list(self.fetcher.iter_declarations([1])), [
+            (1, [({'id': '1-0', 'declaration_type': 1}, {'step_1': '1-0'})]),
+        ])
+
+    def test_rate_limit(self):
+        fetcher = DeclarationFetcher(workers=4, requests_per_second=20, list_url=self.fetcher.list_url,
+                                     retrieve_url=self.fetcher.retrieve_url)
+        self.addCleanup(fetcher.close)
+        start = time.monotonic()
+        list(fetcher.iter_declarations([1, 2]))
+        # 5 requests with 20 requests per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+
+class DeclarationStoreTestCase(SimpleTestCase):
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.store = DeclarationStore(folder)
+
+    def count_objects(self):
+        return sum(len(files) for path, folders, files in os.walk(self.store.objects_folder))
+
+    def test_save_and_load(self):
+        declaration_data = {'id': 'a1', 'declaration_type': 1}
+        data = {'step_1': {'data': {'lastname': 'Іваненко'}}, 'step_2': {'isNotApplicable': 1}}
+        content_hash = self.store.save(7, declaration_data, data)
+        self.assertEqual(self.store.load('a1'), (7, declaration_data, data))
+        self.assertIsNone(self.store.load('b2'))
+        # the same document is stored once
+        self.assertEqual(self.store.save(8, {'id': 'b2', 'declaration_type': 1}, dict(reversed(data.items()))),
+                         content_hash)
+        self.assertEqual(self.count_objects(), 1)
+        # the changed document of the declaration replaces the previous one
+        self.store.save(7, declaration_data, {'step_1': {}})
+        self.assertEqual(self.store.load('a1'), (7, declaration_data, {'step_1': {}}))
+        self.assertEqual(self.count_objects(), 2)
+        self.assertEqual([declaration[0] for declaration in self.store.iter_declarations()], [7, 8])
+        self.assertEqual([declaration[1]['id'] for declaration in self.store.iter_declarations([8])], ['b2'])
+
+    def test_damaged_document(self):
+        content_hash = self.store.save(7, {'id': 'a1'}, {'step_1': {}})
+        with open(self.store.get_object_path(content_hash), 'wb') as file:
+            file.write(gzip.compress(b'{}'))
+        with self.assertRaises(Exception):
+            self.store.load('a1')
+
+
+class StubFopConverter:
+    # the first run fails after saving a checkpoint
+    checkpoints = []
+    instances = []
+    failing = False
+
+    def __init__(self):
+        self.records_skipped = 0
+        self.records_processed = 0
+        self.fingerprint_manager = mock.Mock()
+        type(self).instances.append(self)
+
+    def process(self, checkpoint=None):
+        type(self).checkpoints.append(checkpoint)
+        if checkpoint is None or self.failing:
+            self.report.checkpoint_offset = 1024
+            self.report.checkpoint_index = 500
+            return False
+        return True
+
+
+class FullUpdateResumeTestCase(SimpleTestCase):
+    def setUp(self):
+        StubFopConverter.checkpoints = []
+        StubFopConverter.instances = []
+        StubFopConverter.failing = False
+        self.reports = []
+        file = tempfile.NamedTemporaryFile(suffix='.zip')
+        self.addCleanup(file.close)
+        self.downloader = FopFullDownloader.__new__(FopFullDownloader)
+        self.downloader.file_path = file.name
+
+        def download():
+            self.downloader.report.download_file_name = file.name
+            self.downloader.report.unzip_file_name = 'EDR_FOP_FULL.xml'
+            return True
+
+        report_objects = mock.Mock()
+        report_objects.create.side_effect = lambda **fields: self.reports.append(Report(**fields)) or self.reports[-1]
+        report_objects.filter.return_value.last.side_effect = lambda: self.reports[-1] if self.reports else None
+        for patcher in [
+            mock.patch('data_ocean.downloader.Report.objects', report_objects),
+            mock.patch.object(Report, 'save'),
+            mock.patch('business_register.converter.fop_full.FopFullConverter', StubFopConverter),
+            mock.patch('business_register.converter.fop_full.sleep'),
+            mock.patch('business_register.converter.fop_full.endpoints_cache_warm_up'),
+            mock.patch('business_register.converter.fop_full.Fop'),
+            mock.patch.object(self.downloader, 'download', download),
+            mock.patch.object(self.downloader, 'vacuum_analyze'),
+            mock.patch.object(self.downloader, 'remove_file'),
+            mock.patch.object(self.downloader, 'update_register_field'),
+            mock.patch.object(self.downloader, 'measure_changes'),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_resume_failed_update(self):
+        self.downloader.update()
+        self.assertFalse(self.reports[0].update_status)
+        # the failed update is resumed from its checkpoint instead of a new download
+        self.downloader.update()
+        self.assertEqual(len(self.reports), 1)
+        self.assertEqual(StubFopConverter.checkpoints, [None, (1024, 500)])
+        self.assertTrue(self.reports[0].update_status)
+        self.downloader.update()
+        self.assertEqual(len(self.reports), 2)
+
+    def test_resume_limit(self):
+        StubFopConverter.failing = True
+        for _ in range(FopFullDownloader.max_resume_count + 1):
+            self.downloader.update()
+        self.assertEqual(len(self.reports), 1)
+        self.assertEqual(self.reports[0].resume_count, FopFullDownloader.max_resume_count)
+        # the record fails every time, so the next update downloads the source again
+        self.downloader.update()
+        self.assertEqual(len(self.reports), 2)
+        self.assertIsNone(StubFopConverter.checkpoints[-1])
+
+    def test_ignore_fingerprints(self):
+        self.downloader.update(ignore_fingerprints=True)
+        self.downloader.update(ignore_fingerprints=True)
+        # fingerprints are cleared before the new dump only, the resumed update keeps the saved ones
+        first, resumed = StubFopConverter.instances
+        first.fingerprint_manager.clear.assert_called_once_with()
+        resumed.fingerprint_manager.clear.assert_not_called()
+
+
+class ParseCommandsTestCase(SimpleTestCase):
+    def test_ignore_fingerprints(self):
+        for command, converter_path in [
+            ('parse_fops', 'business_register.management.commands.parse_fops.FopFullConverter'),
+            ('parse_companies', 'business_register.management.commands.parse_companies.UkrCompanyFullConverter'),
+        ]:
+            with mock.patch(converter_path) as converter_class:
+                call_command(command, '-w', '2')
+                converter_class.return_value.fingerprint_manager.clear.assert_not_called()
+                converter_class.return_value.process.assert_called_once_with(0, 2)
+                call_command(command, '--ignore-fingerprints')
+                converter_class.return_value.fingerprint_manager.clear.assert_called_once_with()
+
+
+
+class GazetteerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.gazetteer = Gazetteer()
+        self.gazetteer.countries = {1: Country(id=5, nacp_id=1, name='ukraine')}
+        self.region = RatuRegion(id=1, name='ЛЬВІВСЬКА ОБЛАСТЬ')
+        self.district = RatuDistrict(id=2, name='стрийський  район', region=self.region)
+        self.gazetteer.add_region(self.region)
+        self.gazetteer.add_region(RatuRegion(id=3, name='львівська область'))
+        self.gazetteer.add_district(self.district)
+        self.gazetteer.add_city(RatuCity(id=4, name='стрий', region=self.region, district=self.district))
+        self.gazetteer.add_city(RatuCity(id=5, name='львів', region=self.region, district=None))
+
+    def test_find(self):
+        self.assertEqual(self.gazetteer.get_country('1').id, 5)
+        region = self.gazetteer.get_region('львівська область')
+        self.assertEqual(region.id, 1)
+        district = self.gazetteer.get_district('стрийський район', region)
+        self.assertEqual(self.gazetteer.get_city('Стрий', region, district).id, 4)
+        self.assertEqual(self.gazetteer.get_city('львів', region, None).id, 5)
+        self.assertFalse(self.gazetteer.misses)
+
+    def test_misses(self):
+        self.assertIsNone(self.gazetteer.get_country('2'))
+        self.assertIsNone(self.gazetteer.get_district('стрийський район', None))
+        self.assertIsNone(self.gazetteer.get_city('стрий', self.region, None))
+        # empty names are not searched
+        self.assertIsNone(self.gazetteer.get_region(''))
+        self.assertEqual(self.gazetteer.misses, {'country': 1, 'district': 1, 'city': 1})
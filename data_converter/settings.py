@@ -292,6 +292,8 @@ DRVBUILDING_REGISTER_LIST = '/api/drvbuilding/'
 # NACP`s API endpoint for declarations
 NACP_DECLARATION_RETRIEVE = 'https://public-api.nazk.gov.ua/v2/documents/'
 NACP_DECLARATION_LIST = 'https://public-api.nazk.gov.ua/v2/documents/list/'
+# raw documents of the fetched declarations, see business_register.converter.declaration_store
+NACP_DECLARATION_CACHE_FOLDER = os.path.join(BASE_DIR, 'source_data', 'nacp_declarations')
 
 FOP_TO_XLSX_LIMIT = 5000
 PEP_EXPORT_XLSX_DAYS_LIMIT = 30
\ No newline at end of file
@@ -103,7 +103,7 @@ LOCAL_FILE_NAME_KOATUU = ''
 LOCATION_RATU_SOURCE_REGISTER_ID = "a2d6c060-e7e6-4471-ac67-42cfa1742a19"
 LOCATION_RATU_SOURCE_PACKAGE = DATA_GOV_UA_SOURCE_PACKAGE + LOCATION_RATU_SOURCE_REGISTER_ID
 LOCAL_FILE_NAME_RATU = '28-ex_xml_atu.xml'
-CHUNK_SIZE_RATU = 100
+CHUNK_SIZE_RATU = 5000
 
 LOCATION_DRV_WSDL_URL = 'https://www.drv.gov.ua/ords/svc/personal/API/Opendata'
 LOCATION_DRV_STRICT = False
@@ -0,0 +1,61 @@
+import os
+import resource
+import time
+from collections import namedtuple
+
+from django.db import connection
+
+BenchmarkResult = namedtuple(
+    'BenchmarkResult',
+    ['name', 'records', 'seconds', 'records_per_second', 'queries', 'queries_per_record', 'peak_rss_mb']
+)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class QueryCounter:
+    """ connection.execute_wrapper() that counts the SQL queries of this process """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, workers of process_in_parallel are the children
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return round(peak_rss / 1024, 1)
+
+
+def run_converter(name, converter, file_path, records, workers=1):
+    """
+    Processes the file by the converter and measures it.
+    Queries of the worker processes are not counted, so use workers=1 for queries per record.
+    """
+    converter.LOCAL_FOLDER = os.path.dirname(file_path) + '/'
+    converter.LOCAL_FILE_NAME = os.path.basename(file_path)
+    query_counter = QueryCounter()
+    start = time.monotonic()
+    with connection.execute_wrapper(query_counter):
+        succeeded = converter.process(workers=workers)
+    seconds = time.monotonic() - start
+    if not succeeded:
+        # the error is already printed by process(), a failed run must not be reported as throughput
+        raise BenchmarkError(f'{name} failed, see the error above')
+    return BenchmarkResult(
+        name=name,
+        records=records,
+        seconds=round(seconds, 2),
+        records_per_second=round(records / seconds, 1) if seconds else 0,
+        queries=query_counter.count,
+        queries_per_record=round(query_counter.count / records, 2) if records else 0,
+        peak_rss_mb=get_peak_rss_mb(),
+    )
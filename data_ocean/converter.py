@@ -1,21 +1,54 @@
 import codecs
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import os
+import re
+import threading
 import traceback
 import zipfile
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple
 
 import requests
 import xmltodict
 from django.apps import apps
+from django.db import connection, connections, transaction
+from django.db.models import QuerySet
+from django.utils import timezone
 from lxml import etree
 
+from data_ocean.models import ImportRun, RecordFingerprint, Report
 from data_ocean.utils import Timer
 from location_register.models.address_models import Country
 
 logger = logging.getLogger(__name__)
 
+# converter instance of the current worker process, see Converter.process_in_parallel()
+worker_converter = None
+
+XML_ENCODING_REGEX = re.compile(rb'<\?xml[^>]*encoding=["\']([\w-]+)["\']')
+
+
+def init_worker(converter_class, state):
+    global worker_converter
+    # every worker opens its own DB connections
+    connections.close_all()
+    worker_converter = converter_class()
+    for attr, value in state.items():
+        setattr(worker_converter, attr, value)
+
+
+def save_chunk_in_worker(raw_records):
+    worker_converter.reset_worker_counters()
+    worker_converter.save_to_db([etree.fromstring(raw_record) for raw_record in raw_records])
+    return worker_converter.get_worker_counters()
+
+
+def call_in_worker(method_name, *args):
+    return getattr(worker_converter, method_name)(*args)
+
 
 class Converter:
     UPDATE_FILE_NAME = "update.cfg"
@@ -24,11 +57,24 @@ class Converter:
     LOCAL_FOLDER = "source_data/"  # local folder for unzipped source files
     DOWNLOAD_FOLDER = "download/"  # folder to downloaded files
     URLS_DICT = {}  # control remote dataset files update
+    # counters (int) and lists of ids collected by save_to_db() that should be merged from the workers
+    PARALLEL_COUNTERS = ()
+    # data_ocean.models.Report of the current update, checkpoints are saved to it
+    report = None
+    # callable returning a binary stream of the source XML to read instead of the LOCAL_FILE_NAME file,
+    # for example Downloader.open_source_stream()
+    source_opener = None
+    # register name of the data_ocean.models.ImportRun, rows seen in the source are stamped with the run
+    # by save_to_db(), so delete_outdated() finds the other rows by one query
+    IMPORT_RUN_REGISTER = None
+    import_run = None
     timing = False
     timer = None
 
     def __init__(self):
         self.all_countries_dict = self.put_objects_to_dict("name", "location_register", "Country")
+        # new names of the reference tables are created by one worker process at a time
+        self.creation_lock = threading.Lock()
         if self.timing:
             self.timer = Timer()
 
@@ -40,10 +86,19 @@ class Converter:
         if self.timing:
             self.timer.print_result()
 
+    def get_or_create_reference(self, model_class, **fields):
+        """
+        Returns (object, created) like get_or_create(). Reference tables (statuses, authorities etc.)
+        have unique names, so workers of process_in_parallel() create them under creation_lock
+        and take the object created by another worker.
+        """
+        with self.creation_lock:
+            return model_class.objects.get_or_create(**fields)
+
     def save_or_get_country(self, name):
         name = name.lower()
         if name not in self.all_countries_dict:
-            new_country = Country.objects.create(name=name)
+            new_country, created = self.get_or_create_reference(Country, name=name)
             self.all_countries_dict[name] = new_country
             return new_country
         return self.all_countries_dict[name]
@@ -194,6 +249,13 @@ class Converter:
         ).objects.all()
                 }
 
+    def put_objects_to_dict_of_lists(self, key_field, queryset):
+        # for example, stored child rows of a chunk grouped by parent id
+        objects_dict = defaultdict(list)
+        for obj in queryset:
+            objects_dict[getattr(obj, key_field)].append(obj)
+        return objects_dict
+
     def put_objects_to_dict_with_two_fields_key(self, first_field, second_field, app_name, model_name):
         return {f'{getattr(obj, first_field)}_{getattr(obj, second_field)}':
                     obj for obj in apps.get_model(
@@ -205,70 +267,261 @@ class Converter:
     def delete_outdated(self):
         """ delete some outdated records """
 
-    def process(self, start_index=0):
-        records = []
-        elements = etree.iterparse(
-            source=self.LOCAL_FOLDER + self.LOCAL_FILE_NAME,
-            tag=self.RECORD_TAG,
-            recover=False,
-        )
+    def get_worker_state(self):
+        # attributes that can be changed after __init__ and must be the same in the workers
+        return {
+            'LOCAL_FOLDER': self.LOCAL_FOLDER,
+            'LOCAL_FILE_NAME': self.LOCAL_FILE_NAME,
+            'import_run': self.import_run,
+            'creation_lock': self.creation_lock,
+        }
+
+    def start_import_run(self):
+        if self.IMPORT_RUN_REGISTER and not self.import_run:
+            self.import_run = ImportRun.start(self.IMPORT_RUN_REGISTER, self.report)
+
+    def can_delete_outdated(self, start_index, checkpoint):
+        # rows saved before the checkpoint are stamped with the same run,
+        # without the run their ids are unknown, so nothing is deleted after resuming
+        return start_index == 0 and (not checkpoint or self.import_run is not None)
+
+    def finish_processing(self, start_index, checkpoint):
+        if self.can_delete_outdated(start_index, checkpoint):
+            self.delete_outdated()
+        if self.import_run:
+            self.import_run.finish()
+        print('All the records have been rewritten.')
+        return True
 
-        # for _ in range(start_index):
-        #     next(elements)
+    def reset_worker_counters(self):
+        for name in self.PARALLEL_COUNTERS:
+            setattr(self, name, [] if isinstance(getattr(self, name), list) else 0)
 
-        # i = start_index
-        i = 0
-        chunk_start_index = i
-        for _, elem in elements:
-            records_len = len(records)
+    def get_worker_counters(self):
+        return {name: getattr(self, name) for name in self.PARALLEL_COUNTERS}
 
-            if records_len == 0:
-                chunk_start_index = i
+    def merge_worker_counters(self, counters):
+        for name, value in counters.items():
+            if isinstance(value, list):
+                getattr(self, name).extend(value)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+    def open_source(self):
+        if self.source_opener:
+            return self.source_opener()
+        return open(self.LOCAL_FOLDER + self.LOCAL_FILE_NAME, 'rb')
+
+    def get_source_encoding(self):
+        with self.open_source() as file:
+            declaration = XML_ENCODING_REGEX.search(file.read(256))
+        return declaration.group(1).decode().lower() if declaration else 'utf-8'
+
+    def save_checkpoint(self, offset, index):
+        # the first record that is not saved yet, see Downloader.get_unfinished_report()
+        if self.report:
+            self.report.checkpoint_offset = offset
+            self.report.checkpoint_index = index
+            Report.objects.filter(id=self.report.id).update(checkpoint_offset=offset, checkpoint_index=index)
+
+    def iter_raw_chunks(self, start_index=0, checkpoint=None):
+        """
+        yields (chunk_start_index, list of UTF-8 serialized records, offset of the end of the chunk in the file)
+        checkpoint - (offset, index) of the record to start from, the file is not read before it
+        """
+        offset, i = checkpoint or (0, 0)
+        encoding = self.get_source_encoding()
+        records = []
+        chunk_start_index = i
+        with self.open_source() as file:
+            if file.seekable():
+                file.seek(offset)
+            else:
+                # a stream from zip can't seek, the part before the checkpoint is only decompressed
+                skipped = 0
+                while skipped < offset:
+                    block = file.read(min(offset - skipped, 16 * 1024 * 1024))
+                    if not block:
+                        break
+                    skipped += len(block)
+            for record_offset, raw_record in iter_raw_records(file, self.RECORD_TAG, offset):
+                if not records:
+                    chunk_start_index = i
+                chunk_end_offset = record_offset + len(raw_record)
+                if encoding not in ('utf-8', 'utf8'):
+                    raw_record = raw_record.decode(encoding).encode()
+                records.append(raw_record)
+                i += 1
+                if len(records) >= self.CHUNK_SIZE:
+                    if i > start_index:
+                        yield chunk_start_index, records, chunk_end_offset
+                    records = []
+            if records and i > start_index:
+                yield chunk_start_index, records, chunk_end_offset
+
+    def process_in_parallel(self, workers, start_index=0, checkpoint=None):
+        """
+        Records are saved by a pool of worker processes, every chunk of whole records
+        (a SUBJECT with its branches, founders etc.) is saved by one worker,
+        so linking inside a record is the same as in process().
+        """
+        self.start_import_run()
+        # connections must not be shared with the forked workers
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        self.creation_lock = context.Lock()
+        pending = deque()
+        chunk_start_index = checkpoint[1] if checkpoint else start_index
+        with context.Pool(
+                workers,
+                initializer=init_worker,
+                initargs=(type(self), self.get_worker_state())
+        ) as pool:
+            try:
+                for chunk_start_index, raw_records, chunk_end_offset in self.iter_raw_chunks(start_index,
+                                                                                             checkpoint):
+                    pending.append((
+                        chunk_start_index, len(raw_records), chunk_end_offset,
+                        pool.apply_async(save_chunk_in_worker, (raw_records,))
+                    ))
+                    # do not keep more than two chunks per worker in memory
+                    while len(pending) >= workers * 2:
+                        chunk_start_index, records_len, chunk_end_offset, result = pending.popleft()
+                        self.merge_worker_counters(result.get())
+                        # chunks are finished in order, so all the records before the end are saved
+                        self.save_checkpoint(chunk_end_offset, chunk_start_index + records_len)
+                        print(chunk_start_index)
+                while pending:
+                    chunk_start_index, records_len, chunk_end_offset, result = pending.popleft()
+                    self.merge_worker_counters(result.get())
+                    self.save_checkpoint(chunk_end_offset, chunk_start_index + records_len)
+            except Exception as e:
+                msg = f'!!! Save to db failed at index = {chunk_start_index}. Error: {str(e)}'
+                logger.error(msg)
+                traceback.print_exc()
+                print(msg)
+                pool.terminate()
+                return False
+        return self.finish_processing(start_index, checkpoint)
+
+    def process(self, start_index=0, workers=1, checkpoint=None):
+        """
+        start_index - index of the first record to save, the records before it are skipped without parsing
+        checkpoint - (offset, index) saved by save_checkpoint() after the last saved chunk
+        """
+        if workers > 1:
+            return self.process_in_parallel(workers, start_index, checkpoint)
+        self.start_import_run()
+        for chunk_start_index, raw_records, chunk_end_offset in self.iter_raw_chunks(start_index, checkpoint):
+            try:
+                self.time_it('preparing chunk of records')
+                self.save_to_db([etree.fromstring(raw_record) for raw_record in raw_records])
+                self.print_running_times()
+                print(chunk_start_index + len(raw_records) - 1)
+            except Exception as e:
+                msg = f'!!! Save to db failed at index = {chunk_start_index}. Error: {str(e)}'
+                logger.error(msg)
+                traceback.print_exc()
+                print(msg)
+                return False
+            self.save_checkpoint(chunk_end_offset, chunk_start_index + len(raw_records))
+            print('>>> Saved successfully')
+        return self.finish_processing(start_index, checkpoint)
 
-            # for text in elem.iter():
-            #     print('\t%28s\t%s' % (text.tag, text.text))
+    print('Converter has imported.')
 
-            records.append(elem)
-            records_len += 1
-            if records_len >= self.CHUNK_SIZE:
-                # print(f'>>> Start save to db records {chunk_start_index}-{i}')
-                try:
-                    if i >= start_index:
-                        self.time_it('preparing chunk of records')
-                        self.save_to_db(records)
-                    self.print_running_times()
-                    print(i)
-                except Exception as e:
-                    msg = f'!!! Save to db failed at index = {chunk_start_index}. Error: {str(e)}'
-                    logger.error(msg)
-                    traceback.print_exc()
-                    print(msg)
-                    return False
-                records.clear()
-
-                # http://lxml.de/parsing.html#modifying-the-tree
-                # Based on Liza Daly fast_iter
-                # http://www.ibm.com/developerworks/xml/library/x-hiperfparse/
-                # See also http://effbot.org/zone/element-iterparse.htm
-                #
-                # It safe to call clear() here because no descendants will be accessed
-                elem.clear()
-                # # Also eliminate now-empty references from the root node to elem
-                for ancestor in elem.xpath('ancestor-or-self::*'):
-                    while ancestor.getprevious() is not None:
-                        del ancestor.getparent()[0]
-
-                print('>>> Saved successfully')
-            i += 1
-        if records_len:
-            self.save_to_db(records)
-        if start_index == 0:
-            self.delete_outdated()
-        del elements
-        print('All the records have been rewritten.')
-        return True
 
-    print('Converter has imported.')
+def iter_raw_records(file, tag, offset=0, block_size=16 * 1024 * 1024):
+    """
+    Yields (offset, bytes) of every <tag>...</tag> element of a binary XML stream without parsing it.
+    offset - position of the stream in the file, offsets of the records are counted from it.
+    Elements with the tag must not be nested.
+    """
+    start_regex = re.compile(b'<' + tag.encode() + rb'[\s>]')
+    end_tag = f'</{tag}>'.encode()
+    buffer = b''
+    position = 0
+    eof = False
+    while True:
+        start = start_regex.search(buffer, position)
+        end = buffer.find(end_tag, start.start()) if start else -1
+        if end == -1:
+            if eof:
+                if start:
+                    raise Exception('Error!', f'Unexpected end of the file in <{tag}> at {offset + start.start()}')
+                return
+            if not start:
+                # the rest of the buffer may contain only a part of the start tag
+                position = max(position, len(buffer) - len(tag) - 2)
+            block = file.read(block_size)
+            eof = not block
+            if position > block_size:
+                buffer = buffer[position:]
+                offset += position
+                position = 0
+            buffer += block
+            continue
+        end += len(end_tag)
+        yield offset + start.start(), buffer[start.start():end]
+        position = end
+
+
+def get_line_shards(file_name, shard_size, start=0):
+    """
+    Splits a text file from the start offset into (start, end) byte ranges of about shard_size bytes,
+    every range ends after a line break, so the shards can be read by different processes.
+    Lines must not contain line breaks inside quoted values.
+    """
+    shards = []
+    file_size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as file:
+        while start < file_size:
+            end = start + shard_size
+            if end >= file_size:
+                end = file_size
+            else:
+                file.seek(end - 1)
+                # the line that goes through the boundary belongs to this shard
+                end += len(file.readline()) - 1
+            shards.append((start, end))
+            start = end
+    return shards
+
+
+def iter_lines(file_name, start, end, encoding='utf-8'):
+    """ yields decoded lines starting in the [start, end) byte range of the file """
+    with open(file_name, 'rb') as file:
+        file.seek(start)
+        position = start
+        while position < end:
+            line = file.readline()
+            if not line:
+                return
+            position += len(line)
+            yield line.decode(encoding)
+
+
+def to_copy_value(value):
+    # text format of COPY, see https://www.postgresql.org/docs/current/sql-copy.html
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_to_table(cursor, db_table, columns, rows):
+    """ streams rows (lists of values prepared for DB) into db_table with COPY ... FROM STDIN """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(to_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    quote_name = connection.ops.quote_name
+    cursor.copy_expert(
+        f'COPY {quote_name(db_table)} ({", ".join(quote_name(column) for column in columns)}) FROM STDIN',
+        buffer
+    )
 
 
 class BulkCreateManager(object):  # https://www.caktusgroup.com/blog/2019/01/09/django-bulk-inserts/
@@ -276,14 +529,46 @@ class BulkCreateManager(object):  # https://www.caktusgroup.com/blog/2019/01/09/
     This helper class keeps track of ORM objects to be created for multiple
     model classes.
     The developer must clear all queues after all objects are created for all models.
+    Objects of copy_models are saved with COPY instead of bulk_create, that is much faster
+    for millions of rows. Primary keys are taken from the table sequence before COPY,
+    so saved objects can be linked with their children the same way as after bulk_create.
+    Use COPY only for models without array and json fields.
     """
 
-    def __init__(self):
+    def __init__(self, copy_models=()):
         self.queues = defaultdict(list)
+        self.copy_models = {model_class._meta.label for model_class in copy_models}
 
     def commit(self, model_class):
         model_key = model_class._meta.label
-        model_class.objects.bulk_create(self.queues[model_key])
+        if model_key in self.copy_models:
+            self.copy_create(model_class, self.queues[model_key])
+        else:
+            model_class.objects.bulk_create(self.queues[model_key])
+
+    def copy_create(self, model_class, objs):
+        if not objs:
+            return
+        opts = model_class._meta
+        fields = opts.concrete_fields
+        with connection.cursor() as cursor:
+            objs_without_pk = [obj for obj in objs if obj.pk is None]
+            if objs_without_pk:
+                cursor.execute(
+                    'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                    [opts.db_table, opts.pk.column, len(objs_without_pk)]
+                )
+                for obj, (pk,) in zip(objs_without_pk, cursor.fetchall()):
+                    obj.pk = pk
+            # pre_save() sets auto_now and auto_now_add fields like save() does
+            rows = (
+                [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields]
+                for obj in objs
+            )
+            copy_to_table(cursor, opts.db_table, [field.column for field in fields], rows)
+        for obj in objs:
+            obj._state.adding = False
+            obj._state.db = connection.alias
 
     def add(self, obj):
         """
@@ -293,3 +578,317 @@ class BulkCreateManager(object):  # https://www.caktusgroup.com/blog/2019/01/09/
         model_class = type(obj)
         model_key = model_class._meta.label
         self.queues[model_key].append(obj)
+
+
+class BulkUpdateManager:
+    """
+    Keeps track of changed ORM objects and saves them with one bulk_update per model
+    instead of a save(update_fields=...) per object. History records are created
+    the same way as save() does.
+    """
+
+    def __init__(self):
+        self.queues = defaultdict(dict)
+        self.fields = defaultdict(set)
+        self.models = {}
+
+    def add(self, obj, update_fields):
+        model_class = type(obj)
+        model_key = model_class._meta.label
+        # bulk_update doesn't set auto_now fields
+        obj.updated_at = timezone.now()
+        self.queues[model_key][obj.pk] = obj
+        self.fields[model_key].update(update_fields)
+        self.fields[model_key].add('updated_at')
+        self.models[model_key] = model_class
+
+    def soft_delete(self, obj):
+        if not obj.deleted_at:
+            obj.deleted_at = timezone.now()
+            self.add(obj, ['deleted_at'])
+
+    def commit(self):
+        for model_key, objs in self.queues.items():
+            if not objs:
+                continue
+            model_class = self.models[model_key]
+            objs = list(objs.values())
+            with transaction.atomic():
+                # soft deleted objects are updated too
+                model_class.include_deleted_objects.bulk_update(objs, list(self.fields[model_key]))
+                if hasattr(model_class, 'history'):
+                    model_class.history.bulk_history_create(objs, update=True)
+        self.queues.clear()
+        self.fields.clear()
+
+
+def soft_delete_by_ids(ids, relations):
+    """
+    Soft-deletes the rows of the models related to ids in one transaction: ids are copied
+    into a temporary table and every model is updated with one UPDATE ... FROM.
+    History records are written by the same statement, as soft_delete() does.
+    ids - iterable of ids or a values_list('id', flat=True) queryset, that is selected by the DB only
+    relations - pairs (model class, column referencing ids), like (Founder, 'company_id'), (Company, 'id')
+    Returns the numbers of soft-deleted rows by model labels.
+    """
+    deleted = {}
+    is_queryset = isinstance(ids, QuerySet)
+    if not is_queryset and not ids:
+        return deleted
+    quote_name = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('CREATE TEMPORARY TABLE outdated_ids (id bigint PRIMARY KEY)')
+        if is_queryset:
+            sql, params = ids.query.sql_with_params()
+            cursor.execute(f'INSERT INTO outdated_ids SELECT DISTINCT * FROM ({sql}) ids', params)
+        else:
+            copy_to_table(cursor, 'outdated_ids', ['id'], ([object_id] for object_id in set(ids)))
+        cursor.execute('ANALYZE outdated_ids')
+        for model_class, column in relations:
+            table = quote_name(model_class._meta.db_table)
+            update = (
+                f'UPDATE {table} SET deleted_at = now(), updated_at = now() FROM outdated_ids '
+                f'WHERE {table}.{quote_name(column)} = outdated_ids.id AND {table}.deleted_at IS NULL'
+            )
+            if hasattr(model_class, 'history'):
+                history_columns = {field.column for field in model_class.history.model._meta.concrete_fields}
+                columns = ', '.join(
+                    quote_name(field.column) for field in model_class._meta.concrete_fields
+                    if field.column in history_columns
+                )
+                cursor.execute(
+                    f'WITH deleted AS ({update} RETURNING {table}.*) '
+                    f'INSERT INTO {quote_name(model_class.history.model._meta.db_table)} '
+                    f'({columns}, history_date, history_type) SELECT {columns}, now(), %s FROM deleted',
+                    ['~']
+                )
+            else:
+                cursor.execute(update)
+            deleted[model_class._meta.label] = cursor.rowcount
+        cursor.execute('DROP TABLE outdated_ids')
+    return deleted
+
+
+UpsertResult = namedtuple('UpsertResult', ['inserted', 'updated', 'unchanged'])
+
+
+class UpsertManager:
+    """
+    Saves a chunk of rows with a handful of set-based statements instead of
+    a query and a save() per record.
+    The chunk is copied into a temporary staging table (not WAL-logged and private for
+    the connection, so parallel workers don't mix their chunks), then changed rows are updated
+    and new rows are inserted. Our tables have no unique index on the key (there are old
+    duplicates of the code), so ON CONFLICT can't be used and the upsert is done with
+    UPDATE ... FROM staging + INSERT ... WHERE NOT EXISTS in one transaction under an advisory lock of the table.
+    Only the first stored row of the duplicates is updated, and NULL in the key matches NULL.
+    Soft deleted rows are restored when they come back in the source.
+    """
+
+    SKIPPED_FIELDS = ('created_at', 'updated_at', 'deleted_at')
+
+    def __init__(self, model_class, key_fields, update_fields, run_field=None):
+        """
+        run_field - field for the id of data_ocean.models.ImportRun, like 'last_seen_run'.
+        It is set from the rows for all the stored rows of the chunk, changed or not,
+        without a history record and a new updated_at.
+        """
+        opts = model_class._meta
+        self.model_class = model_class
+        self.db_table = opts.db_table
+        self.staging_table = f'{opts.db_table}_staging'
+        # attnames, like 'status_id' for ForeignKey
+        self.key_fields = key_fields
+        self.update_fields = update_fields
+        self.run_field = run_field
+        self.fields = [field for field in opts.concrete_fields
+                       if not field.primary_key and field.attname not in self.SKIPPED_FIELDS]
+        self.columns = {field.attname: field.column for field in self.fields}
+        self.has_history = hasattr(model_class, 'history')
+
+    def get_key_condition(self, field):
+        column = connection.ops.quote_name(field.column)
+        if not field.null:
+            return f't.{column} = s.{column}'
+        # the same as IS NOT DISTINCT FROM, but an index on the column can still be used
+        return f'(t.{column} = s.{column} OR t.{column} IS NULL AND s.{column} IS NULL)'
+
+    def get_key(self, values):
+        return values[0] if len(values) == 1 else tuple(values)
+
+    def prepare_rows(self, rows):
+        for row in rows:
+            yield [
+                field.get_db_prep_save(row[field.attname] if field.attname in row else field.get_default(), connection)
+                for field in self.fields
+            ]
+
+    def upsert(self, rows):
+        """
+        rows - list of dicts {attname: value}
+        returns UpsertResult with dicts {key: id} of inserted, updated and unchanged rows
+        """
+        if not rows:
+            return UpsertResult({}, {}, {})
+        quote_name = connection.ops.quote_name
+        table = quote_name(self.db_table)
+        staging = quote_name(self.staging_table)
+        columns = [quote_name(self.columns[field.attname]) for field in self.fields]
+        key_columns = [quote_name(self.columns[attname]) for attname in self.key_fields]
+        update_columns = [quote_name(self.columns[attname]) for attname in self.update_fields]
+        join_condition = ' AND '.join(
+            self.get_key_condition(self.model_class._meta.get_field(attname)) for attname in self.key_fields
+        )
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS AS '
+                f'SELECT {", ".join(columns)} FROM {table} WITH NO DATA'
+            )
+            # rows of the previous chunk are still here when upsert() is called inside an outer transaction
+            cursor.execute(f'TRUNCATE {staging}')
+            copy_to_table(cursor, self.staging_table, [self.columns[field.attname] for field in self.fields],
+                          self.prepare_rows(rows))
+            # workers of process_in_parallel() can get the same new key in their chunks, so they
+            # look for the stored rows and insert the new ones one at a time till the commit
+            cursor.execute('SELECT pg_advisory_xact_lock(%s::regclass::oid::bigint)', [self.db_table])
+            cursor.execute(
+                f'SELECT t.id, {", ".join(f"t.{column}" for column in key_columns)} '
+                f'FROM {table} t JOIN {staging} s ON {join_condition} ORDER BY t.id'
+            )
+            stored = {}
+            for stored_id, *key in cursor.fetchall():
+                # for duplicates of the key the first stored row is used, like .first() does
+                stored.setdefault(self.get_key(key), stored_id)
+            if self.run_field and stored:
+                run_column = quote_name(self.columns[self.run_field])
+                run_id = rows[0][self.run_field]
+                cursor.execute(
+                    f'UPDATE {table} SET {run_column} = %s '
+                    f'WHERE id = ANY(%s) AND {run_column} IS DISTINCT FROM %s',
+                    [run_id, list(stored.values()), run_id]
+                )
+            updated_ids = set()
+            if stored:
+                cursor.execute(
+                    f'UPDATE {table} t SET '
+                    f'{", ".join(f"{column} = s.{column}" for column in update_columns)}, '
+                    f'updated_at = now(), deleted_at = NULL '
+                    f'FROM {staging} s WHERE t.id = ANY(%s) AND {join_condition} AND ('
+                    f'({", ".join(f"t.{column}" for column in update_columns)}) IS DISTINCT FROM '
+                    f'({", ".join(f"s.{column}" for column in update_columns)}) '
+                    f'OR t.deleted_at IS NOT NULL) '
+                    f'RETURNING t.id',
+                    [list(stored.values())]
+                )
+                updated_ids = {row[0] for row in cursor.fetchall()}
+            cursor.execute(
+                f'INSERT INTO {table} ({", ".join(columns)}, created_at, updated_at) '
+                f'SELECT DISTINCT ON ({", ".join(f"s.{column}" for column in key_columns)}) '
+                f'{", ".join(f"s.{column}" for column in columns)}, now(), now() '
+                f'FROM {staging} s WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {join_condition}) '
+                f'RETURNING id, {", ".join(key_columns)}'
+            )
+            inserted = {self.get_key(key): inserted_id for inserted_id, *key in cursor.fetchall()}
+            if inserted and self.has_history:
+                self.model_class.history.bulk_history_create(
+                    list(self.model_class.objects.filter(id__in=inserted.values()))
+                )
+            if updated_ids and self.has_history:
+                self.model_class.history.bulk_history_create(
+                    list(self.model_class.include_deleted_objects.filter(id__in=updated_ids)),
+                    update=True
+                )
+        updated = {}
+        unchanged = {}
+        for key, stored_id in stored.items():
+            if stored_id in updated_ids:
+                updated[key] = stored_id
+            else:
+                unchanged[key] = stored_id
+        return UpsertResult(inserted, updated, unchanged)
+
+
+class FingerprintManager:
+    """
+    Most records of a full dump are the same as in the previous one. A hash of every saved
+    record is stored, so unchanged records can be skipped before any ORM work.
+    Fingerprints are saved together with the chunk, after the records were stored.
+    """
+
+    def __init__(self, register):
+        self.register = register
+        self.fingerprints = {}
+        self.pending = {}
+
+    @staticmethod
+    def get_hash(value):
+        return hashlib.md5(value).hexdigest()
+
+    def get_fingerprint(self, record):
+        # canonical XML doesn't depend on the attributes order, quotes, empty tags notation etc.
+        return self.get_hash(etree.tostring(record, method='c14n'))
+
+    def filter_changed(self, records, get_key):
+        """
+        get_key(record) returns the key of the record in the register or None if it can't be built
+        returns the list of new and changed records and dict {key: object_id} of unchanged ones
+        """
+        keyed_records = [(get_key(record), record) for record in records]
+        keys = {key: self.get_hash(key.encode()) for key, record in keyed_records if key is not None}
+        stored = {
+            key: (fingerprint, object_id) for key, fingerprint, object_id in
+            RecordFingerprint.objects.filter(
+                register=self.register, key__in=keys.values()
+            ).values_list('key', 'fingerprint', 'object_id')
+        }
+        changed = []
+        unchanged = {}
+        self.fingerprints = {}
+        for key, record in keyed_records:
+            if key is None:
+                changed.append(record)
+                continue
+            fingerprint = self.get_fingerprint(record)
+            stored_fingerprint, object_id = stored.get(keys[key], (None, None))
+            if fingerprint == stored_fingerprint:
+                unchanged[key] = object_id
+            else:
+                changed.append(record)
+                self.fingerprints[key] = fingerprint
+        return changed, unchanged
+
+    def add(self, key, object_id=None):
+        # the record with the key was saved successfully
+        if key in self.fingerprints:
+            self.pending[self.get_hash(key.encode())] = (self.fingerprints[key], object_id)
+
+    def commit(self):
+        if not self.pending:
+            return
+        params = []
+        for key, (fingerprint, object_id) in self.pending.items():
+            params.extend((self.register, key, fingerprint, object_id))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {RecordFingerprint._meta.db_table} (register, key, fingerprint, object_id) '
+                f'VALUES {", ".join(["(%s, %s, %s, %s)"] * len(self.pending))} '
+                f'ON CONFLICT (register, key) DO UPDATE SET '
+                f'fingerprint = EXCLUDED.fingerprint, object_id = EXCLUDED.object_id',
+                params
+            )
+        self.pending = {}
+        self.fingerprints = {}
+
+    def forget(self, object_ids):
+        # records of the deleted objects must be processed when they come back
+        RecordFingerprint.objects.filter(register=self.register, object_id__in=object_ids).delete()
+
+    def clear(self):
+        RecordFingerprint.objects.filter(register=self.register).delete()
+
+
+class JsonFingerprintManager(FingerprintManager):
+    """ FingerprintManager for records that are dicts and lists, like the responses of SOAP and JSON APIs """
+
+    def get_fingerprint(self, record):
+        return self.get_hash(json.dumps(record, sort_keys=True, ensure_ascii=False, default=str).encode())
@@ -1,10 +1,14 @@
 import codecs
+import hashlib
+import io
+import json
 import logging
 import os
 import subprocess
 import tempfile
 import zipfile
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from django.apps import apps
@@ -18,6 +22,217 @@ from business_register.models.company_models import Company
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# replaced in the cp1251 XML files of the EDR before parsing
+UNREADABLE_CHARACTERS = (
+    ('&quot;', '"'),
+    ('windows-1251', 'UTF-8'),
+    ('&#3;', ''),
+    ('&#14;', ''),
+    ('&#16;', ''),
+    ('&#24;', ''),
+    ('&#30;', ''),
+    ('&#31;', ''),
+)
+
+
+class CleanXmlStream(io.RawIOBase):
+    """
+    Binary stream of a cp1251 XML file transcoded to UTF-8 and cleaned of UNREADABLE_CHARACTERS
+    block by block, the same as Downloader.remove_unreadable_characters() does without the temporary file.
+    """
+
+    def __init__(self, raw, encoding='cp1251', block_size=16 * 1024 * 1024):
+        self.raw = raw
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.block_size = block_size
+        self.max_length = max(len(old) for old, new in UNREADABLE_CHARACTERS)
+        self.tail = ''
+        self.buffer = bytearray()
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def read_block(self):
+        block = self.raw.read(self.block_size)
+        text = self.tail + self.decoder.decode(block, final=not block)
+        self.tail = ''
+        if block:
+            # a replaced string can be cut by the end of the block, it is cleaned with the next one
+            for length in range(self.max_length - 1, 0, -1):
+                if any(old.startswith(text[-length:]) for old, new in UNREADABLE_CHARACTERS):
+                    text, self.tail = text[:-length], text[-length:]
+                    break
+        else:
+            self.eof = True
+        for old, new in UNREADABLE_CHARACTERS:
+            text = text.replace(old, new)
+        self.buffer += text.encode()
+
+    def readinto(self, b):
+        while len(self.buffer) < len(b) and not self.eof:
+            self.read_block()
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        del self.buffer[:size]
+        return size
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class FileFetcher:
+    """
+    Downloads a file over HTTP into file_path:
+    - an interrupted download is continued with Range requests, in the same run and in the next one;
+    - big files can be fetched by a few parallel segments;
+    - validators of the last download (ETag, Last-Modified) are kept in the meta file (<file_path>.meta.json
+      by default) and sent with the next request, so an unchanged file is not downloaded again;
+    - sha256 of the file is computed while it is written.
+    """
+    META_SUFFIX = '.meta.json'
+    PART_SUFFIX = '.part'
+
+    def __init__(self, url, file_path, meta_path=None, segments=1, chunk_size=1024 * 1024, retries=3,
+                 timeout=60, **request_kwargs):
+        self.url = url
+        self.file_path = file_path
+        self.segments = segments
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        # data, auth, headers etc. for requests.get()
+        self.request_kwargs = request_kwargs
+        self.headers = request_kwargs.pop('headers', None) or {}
+        self.meta_path = meta_path or file_path + self.META_SUFFIX
+        self.meta = self.load_meta()
+        self.size = None
+        self.sha256 = None
+
+    def load_meta(self):
+        try:
+            with open(self.meta_path) as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return meta if meta.get('url') == self.url else {}
+
+    def save_meta(self, **values):
+        self.meta.update(values, url=self.url)
+        with open(self.meta_path, 'w') as file:
+            json.dump(self.meta, file)
+
+    def get(self, headers=None):
+        return requests.get(self.url, headers={**self.headers, **(headers or {})}, stream=True,
+                            timeout=self.timeout, **self.request_kwargs)
+
+    def get_validator(self, response):
+        return response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+    def get_part_path(self, segment):
+        return f'{self.file_path}{self.PART_SUFFIX}{segment}'
+
+    def get_segment_ranges(self, segments):
+        segment_size = -(-self.size // segments)
+        return [(start, min(start + segment_size, self.size) - 1) for start in range(0, self.size, segment_size)]
+
+    def remove_parts(self):
+        for segment in range(self.meta.get('segments', 1)):
+            if os.path.isfile(self.get_part_path(segment)):
+                os.remove(self.get_part_path(segment))
+
+    def fetch(self):
+        """ returns False if the file was not modified since the last download """
+        conditional_headers = {}
+        if self.meta.get('complete'):
+            if self.meta.get('etag'):
+                conditional_headers['If-None-Match'] = self.meta['etag']
+            if self.meta.get('last_modified'):
+                conditional_headers['If-Modified-Since'] = self.meta['last_modified']
+        with self.get(conditional_headers) as response:
+            if response.status_code == 304:
+                # the file of the last download is still here when it wasn't processed successfully
+                return os.path.isfile(self.file_path)
+            response.raise_for_status()
+            self.size = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+            accept_ranges = response.headers.get('Accept-Ranges') == 'bytes' and self.size
+            validator = self.get_validator(response)
+            resumable = (accept_ranges and validator and not self.meta.get('complete')
+                         and self.meta.get('validator') == validator and self.meta.get('size') == self.size)
+            if not resumable:
+                self.remove_parts()
+                segments = self.segments if accept_ranges and validator else 1
+                self.save_meta(etag=response.headers.get('ETag'), validator=validator, size=self.size,
+                               last_modified=response.headers.get('Last-Modified'),
+                               segments=segments, complete=False, sha256=None)
+            if self.meta['segments'] == 1 and not (resumable and os.path.isfile(self.get_part_path(0))):
+                # nothing to resume, the body of this response is used
+                hasher = hashlib.sha256()
+                try:
+                    with open(self.get_part_path(0), 'wb') as file:
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            file.write(chunk)
+                            hasher.update(chunk)
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                    if not accept_ranges or not validator:
+                        raise
+                    logger.warning(f'{self.url}: download interrupted ({e}), resuming...')
+                if self.size is None or os.path.getsize(self.get_part_path(0)) == self.size:
+                    self.finish(hasher)
+                    return True
+        if not accept_ranges or not validator:
+            raise requests.exceptions.RequestException('Error! Bad file size after download.')
+        ranges = self.get_segment_ranges(self.meta['segments'])
+        if len(ranges) == 1:
+            self.fetch_segment(0, *ranges[0], validator)
+        else:
+            with ThreadPoolExecutor(len(ranges)) as executor:
+                for result in [executor.submit(self.fetch_segment, segment, start, end, validator)
+                               for segment, (start, end) in enumerate(ranges)]:
+                    result.result()
+        self.finish(None)
+        return True
+
+    def fetch_segment(self, segment, start, end, validator):
+        part_path = self.get_part_path(segment)
+        for attempt in range(self.retries + 1):
+            done = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            if start + done > end:
+                return
+            try:
+                with self.get({'Range': f'bytes={start + done}-{end}', 'If-Range': validator}) as response:
+                    if response.status_code != 206:
+                        raise requests.exceptions.RequestException(
+                            f'Error! The file changed while downloading, status: {response.status_code}')
+                    with open(part_path, 'ab') as file:
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            file.write(chunk)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f'{self.url}: segment {segment} interrupted ({e}), resuming...')
+        if os.path.getsize(part_path) != end - start + 1:
+            raise requests.exceptions.RequestException('Error! Bad file size after download.')
+
+    def finish(self, hasher):
+        if hasher is None:
+            # the parts are joined and hashed in one pass
+            hasher = hashlib.sha256()
+            with open(self.get_part_path(0), 'r+b') as file:
+                for chunk in iter(lambda: file.read(self.chunk_size), b''):
+                    hasher.update(chunk)
+                for segment in range(1, self.meta['segments']):
+                    with open(self.get_part_path(segment), 'rb') as part:
+                        for chunk in iter(lambda: part.read(self.chunk_size), b''):
+                            file.write(chunk)
+                            hasher.update(chunk)
+                    os.remove(self.get_part_path(segment))
+        os.replace(self.get_part_path(0), self.file_path)
+        self.size = os.path.getsize(self.file_path)
+        self.sha256 = hasher.hexdigest()
+        self.save_meta(complete=True, sha256=self.sha256)
+
 
 class Downloader(ABC):
     auth = None
@@ -27,6 +242,8 @@ class Downloader(ABC):
     local_path = settings.LOCAL_FOLDER
     chunk_size = 16 * 1024
     stream = True
+    # parallel HTTP Range requests for big files, see FileFetcher
+    download_segments = 1
     reg_name = ''
     file_name = ''
     file_path = ''
@@ -35,6 +252,10 @@ class Downloader(ABC):
     zip_required_file_sign = ''
     unzip_required_file_sign = ''
     unzip_after_download = False
+    # the converter reads the required file straight from the downloaded zip, see open_source_stream()
+    stream_from_zip = False
+    # a failed update is resumed from its checkpoint this many times, then the source is downloaded again
+    max_resume_count = 3
     report = None
     start_time = None
     source_dataset_url = ''
@@ -103,6 +324,21 @@ class Downloader(ABC):
         logger.exception(f'{self.reg_name}: {msg}')
         raise Exception('Error!', msg)
 
+    def find_zip_required_file(self):
+        # there is no need to test the archive, CRC of the file is checked while it is read
+        self.is_zip_file()
+        for i in self.get_zip_filelist():
+            if self.unzip_required_file_sign in i:
+                self.report.unzip_file_name = i
+                self.report.unzip_status = True
+                self.report.save()
+                return
+        self.no_req_sign()
+
+    def open_source_stream(self):
+        zip_file = zipfile.ZipFile(self.file_path)
+        return CleanXmlStream(zip_file.open(self.report.unzip_file_name))
+
     def unzip_source_file(self):
         self.is_zip_file()
         self.test_zip_file()
@@ -123,6 +359,30 @@ class Downloader(ABC):
     def report_init(self):
         self.report = Report.objects.create(registry_name=self.reg_name)
 
+    def get_unfinished_report(self):
+        # the last update was interrupted or failed while saving the unzipped file that is still here
+        report = Report.objects.filter(registry_name=self.reg_name).last()
+        if not report or not report.checkpoint_index or report.update_status or not report.unzip_file_name:
+            return None
+        if report.resume_count >= self.max_resume_count:
+            # the same record may fail every time, so a new dump is downloaded instead
+            logger.warning(f'{self.reg_name}: the update failed after {report.resume_count} resumes, '
+                           f'starting a new one')
+            return None
+        if self.stream_from_zip:
+            if not os.path.isfile(report.download_file_name):
+                return None
+            self.file_path = report.download_file_name
+            self.file_name = os.path.basename(self.file_path)
+        elif os.path.isfile(self.local_path + report.unzip_file_name):
+            self.file_name = report.unzip_file_name
+            self.file_path = self.local_path + self.file_name
+        else:
+            return None
+        report.resume_count += 1
+        report.save()
+        return report
+
     def get_source_file_url(self):
         assert self.url
         return self.url
@@ -145,34 +405,36 @@ class Downloader(ABC):
                 logger.info(f'{self.reg_name}: {query} {table} at {timezone.now() - start_time}')
 
     def download(self):
+        """ returns False if the source file was not modified since the last download """
         assert self.url
         assert self.file_path
 
         start_time = timezone.now()
         try:
-            with requests.get(self.url, data=self.data, stream=self.stream,
-                              auth=self.auth, headers=self.get_headers()) as r:
-                r.raise_for_status()
-
-                self.file_size = int(r.headers['Content-Length'])
-                logger.info(f"{self.reg_name}: Start downloading: {self.file_path}, size: {self.file_size} ...")
-                self.remove_file()
-                with open(self.file_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=self.chunk_size):
-                        f.write(chunk)
-                    f.flush()
-
-                if not self.file_size_is_correct():
-                    raise requests.exceptions.RequestException('Error! Bad file size after download.')
-
-                logger.info(
-                    f"{self.reg_name}: {self.file_path} downloaded successfully at {timezone.now() - start_time}.")
-
+            # the same file can be the source of a few registers
+            fetcher = FileFetcher(self.url, self.file_path,
+                                  meta_path=self.local_path + self.reg_name + FileFetcher.META_SUFFIX,
+                                  segments=self.download_segments,
+                                  chunk_size=self.chunk_size, data=self.data, auth=self.auth,
+                                  headers=self.get_headers())
+            logger.info(f"{self.reg_name}: Start downloading: {self.file_path} ...")
+            if not fetcher.fetch():
+                logger.info(f'{self.reg_name}: {self.url} was not modified since the last download.')
                 self.report.download_finish = timezone.now()
-                self.report.download_status = True
-                self.report.download_file_name = self.file_path
-                self.report.download_file_length = self.file_size
+                self.report.download_message = 'Not modified'
                 self.report.save()
+                return False
+            self.file_size = fetcher.size
+
+            logger.info(
+                f"{self.reg_name}: {self.file_path} ({self.file_size} bytes, sha256 {fetcher.sha256}) "
+                f"downloaded successfully at {timezone.now() - start_time}.")
+
+            self.report.download_finish = timezone.now()
+            self.report.download_status = True
+            self.report.download_file_name = self.file_path
+            self.report.download_file_length = self.file_size
+            self.report.save()
 
         except requests.exceptions.RequestException as e:
 
@@ -183,8 +445,18 @@ class Downloader(ABC):
             logger.exception(f'{self.reg_name}: {e}')
             raise Exception('Error!', e)
 
-        if self.unzip_after_download:
+        if self.stream_from_zip:
+            self.find_zip_required_file()
+        elif self.unzip_after_download:
             self.unzip_source_file()
+        return True
+
+    def report_not_modified(self):
+        self.report.update_message = 'The source file was not modified since the last update.'
+        self.report.update_status = True
+        self.report.update_finish = timezone.now()
+        self.report.save()
+        logger.info(f'{self.reg_name}: {self.report.update_message}')
 
     def update_register_field(self, register_api_list, field_name, new_field_value):
         register = Register.objects.get(api_list=register_api_list)
@@ -225,14 +497,8 @@ class Downloader(ABC):
         tmp = tempfile.mkstemp()
         with codecs.open(file, 'r', 'Windows-1251') as fd1, codecs.open(tmp[1], 'w', 'UTF-8') as fd2:
             for line in fd1:
-                line = line.replace('&quot;', '"')\
-                    .replace('windows-1251', 'UTF-8')\
-                    .replace('&#3;', '')\
-                    .replace('&#14;', '')\
-                    .replace('&#16;', '')\
-                    .replace('&#24;', '')\
-                    .replace('&#30;', '')\
-                    .replace('&#31;', '')
+                for old, new in UNREADABLE_CHARACTERS:
+                    line = line.replace(old, new)
                 fd2.write(line)
         os.rename(tmp[1], file)
         logger.info(f'{self.reg_name}: remove_unreadable_characters finished.')
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class RateLimiter:
+    """ Lets at most `rate` calls per second through wait(), shared by all the threads """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def make_session(retries=3, backoff_factor=0.5, pool_size=10):
+    """
+    requests.Session that keeps the connections alive and retries connection errors and 429/5xx responses
+    with exponential backoff. POST requests are retried too, because SOAP calls are POST and read-only.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_ordered(function, items, workers=4, max_pending=None, rate_limiter=None):
+    """
+    Calls function(item) for the items in a pool of threads and yields (item, result) in the order of the items,
+    so the results can be saved to DB by the single consumer thread.
+    At most max_pending (2 * workers by default) results are fetched ahead of the consumer,
+    so a slow consumer doesn't make the payloads pile up in memory.
+    An exception of function(item) is raised when its result is consumed.
+    """
+    max_pending = max_pending or workers * 2
+
+    def call(item):
+        if rate_limiter:
+            rate_limiter.wait()
+        return function(item)
+
+    pending = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        try:
+            for item in items:
+                pending.append((item, executor.submit(call, item)))
+                if len(pending) >= max_pending:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            # the consumer stopped or failed, the calls that are not started yet are not needed
+            for item, future in pending:
+                future.cancel()
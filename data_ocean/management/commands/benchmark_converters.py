@@ -0,0 +1,88 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from data_ocean import synthetic
+from data_ocean.benchmark import BenchmarkError, run_converter
+from data_ocean.models import Register
+
+# name: (converter, record generator, models whose rows missing in the file are soft-deleted by the converter)
+CONVERTERS = {
+    'uo_full': ('business_register.converter.company_converters.ukr_company_full.UkrCompanyFullConverter',
+                synthetic.ukr_company_full_record, ('business_register.models.company_models.Company',)),
+    'fop_full': ('business_register.converter.fop_full.FopFullConverter', synthetic.fop_full_record, ()),
+    'fop': ('business_register.converter.fop.FopConverter', synthetic.fop_record, ()),
+    'ratu': ('location_register.converter.ratu.RatuConverter', synthetic.ratu_record, (
+        'location_register.models.ratu_models.RatuDistrict',
+        'location_register.models.ratu_models.RatuCity',
+        'location_register.models.ratu_models.RatuCityDistrict',
+        'location_register.models.ratu_models.RatuStreet',
+    )),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Processes synthetic source files by the converters and reports records/sec, SQL queries per record '
+        'and peak RSS. Records are saved to the configured DB, so use a local one. '
+        'The first run with a seed fills the DB, the next runs with --change-ratio measure updates. '
+        'Full imports soft-delete the stored rows missing in the synthetic file, so they run only on empty '
+        'tables unless --allow-delete is passed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('converters', nargs='*', help=f'some of {", ".join(CONVERTERS)}, all by default')
+        parser.add_argument('-n', '--records', type=int, default=10000)
+        parser.add_argument('-c', '--children', type=int, default=3,
+                            help='max size of the child collections (founders, kveds, branches) of a record')
+        parser.add_argument('-r', '--change-ratio', type=float, default=0.0,
+                            help='share of the records that differ from the records generated with the same seed')
+        parser.add_argument('-s', '--seed', type=int, default=0)
+        parser.add_argument('-w', '--workers', type=int, default=1)
+        parser.add_argument('--folder', help='folder for the generated files, a temporary one by default')
+        parser.add_argument('--allow-delete', action='store_true',
+                            help='run full imports on tables with rows, the rows missing in the file are deleted')
+
+    def handle(self, *args, **options):
+        for name in options['converters']:
+            if name not in CONVERTERS:
+                raise CommandError(f'Unknown converter "{name}", choose from {", ".join(CONVERTERS)}')
+        if options['children'] < 1:
+            raise CommandError('--children must be at least 1')
+        if not options['allow_delete']:
+            for name in options['converters'] or CONVERTERS:
+                for model_path in CONVERTERS[name][2]:
+                    model_class = import_string(model_path)
+                    if model_class.objects.exists():
+                        raise CommandError(
+                            f'"{name}" deletes {model_class._meta.label} rows missing in the synthetic file, '
+                            f'but the table is not empty. Use an empty DB or pass --allow-delete'
+                        )
+        folder = options['folder'] or tempfile.mkdtemp(prefix='benchmark_')
+        results = []
+        for name in options['converters'] or CONVERTERS:
+            converter_path, record_function, _ = CONVERTERS[name]
+            file_path = os.path.join(folder, f'{name}.xml')
+            synthetic.generate(file_path, record_function, options['records'], options['seed'],
+                               options['change_ratio'], options['children'])
+            try:
+                converter = import_string(converter_path)()
+            except Register.DoesNotExist:
+                raise CommandError('Registers are not found, load them by "manage.py loaddata register"')
+            try:
+                results.append(run_converter(name, converter, file_path, options['records'], options['workers']))
+            except BenchmarkError as e:
+                raise CommandError(str(e))
+            finally:
+                if not options['folder']:
+                    os.remove(file_path)
+        if not options['folder']:
+            os.rmdir(folder)
+        self.stdout.write(f'{"converter":<10}{"records":>10}{"seconds":>10}{"rec/sec":>10}'
+                          f'{"queries":>10}{"q/rec":>8}{"peak RSS, MB":>14}')
+        for result in results:
+            self.stdout.write(f'{result.name:<10}{result.records:>10}{result.seconds:>10}'
+                              f'{result.records_per_second:>10}{result.queries:>10}'
+                              f'{result.queries_per_record:>8}{result.peak_rss_mb:>14}')
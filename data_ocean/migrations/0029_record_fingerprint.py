@@ -0,0 +1,41 @@
+# Generated by Django 3.1.12 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_ocean', '0028_register_name_in_daily_report'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('register', models.CharField(max_length=50)),
+                ('key', models.CharField(max_length=32)),
+                ('fingerprint', models.CharField(max_length=32)),
+                ('object_id', models.PositiveIntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='records_processed',
+            field=models.IntegerField(blank=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='records_skipped',
+            field=models.IntegerField(blank=True, default=0, help_text='records of the source that were not changed since the last update'),
+        ),
+        migrations.AddIndex(
+            model_name='recordfingerprint',
+            index=models.Index(fields=['register', 'object_id'], name='data_ocean__registe_eb8ec2_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recordfingerprint',
+            unique_together={('register', 'key')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.12 on 2026-10-18 20:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_ocean', '0029_record_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='checkpoint_index',
+            field=models.IntegerField(blank=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='checkpoint_offset',
+            field=models.BigIntegerField(blank=True, default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.12 on 2026-10-18 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_ocean', '0031_import_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='resume_count',
+            field=models.PositiveSmallIntegerField(blank=True, default=0, help_text='times the failed update was resumed from the checkpoint'),
+        ),
+    ]
@@ -134,8 +134,17 @@ class Report(DataOceanModel):
     records_added = models.IntegerField(blank=True, default=0)
     records_changed = models.IntegerField(blank=True, default=0)
     records_deleted = models.IntegerField(blank=True, default=0)
+    records_skipped = models.IntegerField(blank=True, default=0,
+                                          help_text='records of the source that were not changed since the last update')
+    records_processed = models.IntegerField(blank=True, default=0)
     invalid_data = models.IntegerField(blank=True, default=0)
 
+    # the first record of the source file that is not saved yet, for resuming after a crash
+    checkpoint_offset = models.BigIntegerField(blank=True, default=0)
+    checkpoint_index = models.IntegerField(blank=True, default=0)
+    resume_count = models.PositiveSmallIntegerField(blank=True, default=0,
+                                                    help_text='times the failed update was resumed from the checkpoint')
+
     @staticmethod
     def collect_last_day_reports():
         day_ago = timezone.now() - timezone.timedelta(hours=24)
@@ -148,3 +157,38 @@ class Report(DataOceanModel):
         ordering = ['id']
         verbose_name = _('data update report')
         verbose_name_plural = _('data update reports')
+
+
+class RecordFingerprint(models.Model):
+    # hashes of the source records of the last update, see data_ocean.converter.FingerprintManager
+    register = models.CharField(max_length=50)
+    key = models.CharField(max_length=32)
+    fingerprint = models.CharField(max_length=32)
+    object_id = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        unique_together = [['register', 'key']]
+        indexes = [models.Index(fields=['register', 'object_id'])]
+
+
+class ImportRun(models.Model):
+    # an update of a register, rows seen in the source are stamped with its id in last_seen_run,
+    # so rows with another value are not in the source anymore
+    register = models.CharField(max_length=50)
+    report = models.ForeignKey(Report, on_delete=models.SET_NULL, null=True, blank=True)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def start(cls, register, report=None):
+        # the interrupted update is continued with the same run
+        if report:
+            return cls.objects.get_or_create(register=register, report=report)[0]
+        return cls.objects.create(register=register)
+
+    def finish(self):
+        self.finished_at = timezone.now()
+        self.save(update_fields=['finished_at'])
+
+    def __str__(self):
+        return f'{self.register} #{self.id}'
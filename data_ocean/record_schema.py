@@ -0,0 +1,87 @@
+"""
+Declarative schemas of XML records of the sources.
+
+A schema is compiled once into an extractor that walks the children of a record element
+one time and puts their values into a slotted record, instead of a record.xpath() call
+(that compiles and evaluates an expression) for every field.
+
+    SIGNER = RecordSchema('Signer', [Text('NAME'), Text('CODE')])
+    record = SIGNER.extract(element)
+    record.name, record.code
+
+Values of missing and empty elements are None, of missing collections - empty lists.
+"""
+
+
+class Record:
+    __slots__ = ()
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({values})'
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+
+class Text:
+    """ text of the child element """
+
+    def __init__(self, tag, name=None):
+        self.tag = tag
+        self.name = name or tag.lower()
+
+    def get_default(self):
+        return None
+
+    def extract(self, element):
+        return element.text
+
+
+class Group(Text):
+    """ child element with its own fields, extracted into a nested record """
+
+    def __init__(self, tag, schema, name=None):
+        super().__init__(tag, name)
+        self.schema = schema
+
+    def extract(self, element):
+        return self.schema.extract(element)
+
+
+class Collection(Text):
+    """
+    children of the child element, like <FOUNDERS><FOUNDER>...</FOUNDER>...</FOUNDERS>
+    schema - RecordSchema of an item or None for a list of the texts of the items
+    """
+
+    def __init__(self, tag, schema=None, name=None):
+        super().__init__(tag, name)
+        self.schema = schema
+
+    def get_default(self):
+        return []
+
+    def extract(self, element):
+        if self.schema:
+            return [self.schema.extract(item) for item in element]
+        return [item.text for item in element]
+
+
+class RecordSchema:
+    def __init__(self, name, fields):
+        self.fields = fields
+        self.record_class = type(name, (Record,), {'__slots__': tuple(field.name for field in fields)})
+        self.extractors = {field.tag: (field.name, field.extract) for field in fields}
+
+    def extract(self, element):
+        record = self.record_class()
+        for field in self.fields:
+            setattr(record, field.name, field.get_default())
+        for child in element:
+            extractor = self.extractors.get(child.tag)
+            if extractor:
+                setattr(record, extractor[0], extractor[1](child))
+        return record
@@ -0,0 +1,160 @@
+"""
+Generators of synthetic source files for benchmarks of the converters.
+
+Every record is generated from its own random state, so files with the same seed have the same
+records and a file with change_ratio > 0 differs from the file with change_ratio=0 only in that
+share of the records (the keys of the changed records stay the same, except for RATU streets).
+"""
+import random
+from xml.sax.saxutils import escape
+
+SURNAMES = ('ШЕВЧЕНКО', 'КОВАЛЕНКО', 'БОНДАРЕНКО', 'ТКАЧЕНКО', 'КРАВЧЕНКО', 'ОЛІЙНИК', 'ЛИСЕНКО', 'МЕЛЬНИК')
+NAMES = ('ІВАН', 'ПЕТРО', 'ОЛЕНА', 'МАРІЯ', 'АНДРІЙ', 'ОКСАНА')
+REGIONS = ('ПОЛТАВСЬКА ОБЛ.', 'ЛЬВІВСЬКА ОБЛ.', 'ХМЕЛЬНИЦЬКА ОБЛ.', 'М.КИЇВ')
+DISTRICTS = ('ПОЛТАВСЬКИЙ Р-Н', 'ЯВОРІВСЬКИЙ Р-Н', 'ВІНЬКОВЕЦЬКИЙ Р-Н')
+CITIES = ('М.ПОЛТАВА', 'М.ЛЬВІВ', 'СМТ.ВІНЬКІВЦІ', 'С.ГРУШІВКА')
+STREETS = ('ВУЛ.ШЕВЧЕНКА', 'ПРОСП.ПЕРЕМОГИ', 'ВУЛ.СОБОРНА', 'ВУЛ.САДОВА', 'ПРОВ.ТИХИЙ')
+OPF = ('товариство з обмеженою відповідальністю', 'приватне підприємство', 'громадська організація')
+STAN = ('зареєстровано', 'припинено', 'в стані припинення')
+KVEDS = (
+    ('62.01', 'Комп\'ютерне програмування'),
+    ('46.90', 'Неспеціалізована оптова торгівля'),
+    ('68.20', 'Надання в оренду й експлуатацію власного чи орендованого нерухомого майна'),
+    ('47.11', 'Роздрібна торгівля в неспеціалізованих магазинах'),
+    ('01.11', 'Вирощування зернових культур'),
+)
+AUTHORITIES = ('Головне управління ДПС у м. Києві', 'Пенсійний фонд України')
+
+
+def element(tag, text=None):
+    if text is None:
+        return f'<{tag}/>'
+    return f'<{tag}>{escape(str(text))}</{tag}>'
+
+
+def person(rnd):
+    return f'{rnd.choice(SURNAMES)} {rnd.choice(NAMES)} {rnd.choice(NAMES)}ОВИЧ'
+
+
+def address(rnd):
+    return (f'Україна, {rnd.randint(1000, 99999):05d}, {rnd.choice(CITIES)}, '
+            f'{rnd.choice(STREETS)}, будинок {rnd.randint(1, 200)}')
+
+
+def date(rnd):
+    return f'{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}.{rnd.randint(1995, 2021)}'
+
+
+def activity_kinds(rnd, children):
+    kinds = ''.join(
+        '<ACTIVITY_KIND>' + element('CODE', code) + element('NAME', name)
+        + element('PRIMARY', 'так' if i == 0 else 'ні') + '</ACTIVITY_KIND>'
+        for i, (code, name) in enumerate(rnd.sample(KVEDS, rnd.randint(1, min(children, len(KVEDS)))))
+    )
+    return f'<ACTIVITY_KINDS>{kinds}</ACTIVITY_KINDS>'
+
+
+def exchange_data(rnd):
+    answers = ''.join(
+        '<EXCHANGE_ANSWER>' + element('AUTHORITY_NAME', authority) + element('AUTHORITY_CODE', '43141377')
+        + element('TAX_PAYER_TYPE', 'платник податку на прибуток') + element('START_DATE', date(rnd))
+        + element('START_NUM', rnd.randint(100000, 999999)) + element('END_DATE') + element('END_NUM')
+        + '</EXCHANGE_ANSWER>'
+        for authority in AUTHORITIES
+    )
+    return f'<EXCHANGE_DATA>{answers}</EXCHANGE_DATA>'
+
+
+def ukr_company_full_record(identity, rnd, i, children):
+    """ SUBJECT of EDR_UO_FULL, the key is NAME + EDRPOU """
+    edrpou = f'{10000000 + i:08d}'
+    founders = ''.join(
+        element('FOUNDER', f'{person(rnd)}, {address(rnd)}, '
+                           f'розмір внеску до статутного фонду {rnd.randint(1, 9999)}.00 грн.')
+        for _ in range(rnd.randint(1, children))
+    )
+    beneficiaries = element('BENEFICIARY', f'{person(rnd)}; Україна; {address(rnd)}')
+    branches = ''
+    if rnd.random() < 0.1:
+        branches = ''.join(
+            '<BRANCH>' + element('CODE', f'{20000000 + i * 10 + b:08d}')
+            + element('NAME', f'ФІЛІЯ {b} ТОВ "КОМПАНІЯ {i}"') + element('PRIMARY_CODE', edrpou)
+            + element('ADDRESS', address(rnd)) + element('CREATE_DATE', date(rnd)) + element('SIGNER', person(rnd))
+            + activity_kinds(rnd, children) + exchange_data(rnd) + element('CONTACTS', '044-123-45-67')
+            + '</BRANCH>'
+            for b in range(rnd.randint(1, min(children, 9)))
+        )
+    termination = ''
+    if rnd.random() < 0.05:
+        termination = (
+            '<TERMINATION_STARTED_INFO>' + element('OP_DATE', date(rnd))
+            + element('REASON', 'РІШЕННЯ ЗАСНОВНИКІВ') + element('SBJ_STATE', 'В СТАНІ ПРИПИНЕННЯ')
+            + element('SIGNER_NAME', person(rnd)) + element('CREDITOR_REQ_END_DATE', date(rnd))
+            + '</TERMINATION_STARTED_INFO>'
+        )
+    return (
+        '<SUBJECT>'
+        + element('NAME', f'ТОВАРИСТВО З ОБМЕЖЕНОЮ ВІДПОВІДАЛЬНІСТЮ "КОМПАНІЯ {i}"')
+        + element('SHORT_NAME', f'ТОВ "КОМПАНІЯ {i}"') + element('EDRPOU', edrpou)
+        + element('ADDRESS', address(rnd)) + element('STAN', rnd.choice(STAN)) + element('FOUNDING_DOCUMENT_NUM')
+        + element('EXECUTIVE_POWER', 'ДИРЕКТОР') + element('SUPERIOR_MANAGEMENT', 'ЗАГАЛЬНІ ЗБОРИ')
+        + element('MANAGING_PAPER') + element('TERMINATED_INFO') + element('TERMINATION_CANCEL_INFO')
+        + element('CONTACTS', '044-123-45-67') + element('VP_DATES')
+        + element('CURRENT_AUTHORITY', 'Шевченківська районна в місті Києві державна адміністрація')
+        + element('AUTHORIZED_CAPITAL', f'{rnd.randint(1, 100000)},00') + element('OPF', rnd.choice(OPF))
+        + element('STATUTE', 'модельний статут') + element('REGISTRATION', f'{date(rnd)} 1 074 102 0000 012345')
+        + f'<FOUNDERS>{founders}</FOUNDERS><BENEFICIARIES>{beneficiaries}</BENEFICIARIES>'
+        + activity_kinds(rnd, children) + f'<SIGNERS>{element("SIGNER", person(rnd))}</SIGNERS>'
+        + '<PREDECESSORS/><ASSIGNEES/>' + exchange_data(rnd) + f'<BRANCHES>{branches}</BRANCHES>'
+        + termination
+        + '</SUBJECT>\n'
+    )
+
+
+def fop_full_record(identity, rnd, i, children):
+    """ SUBJECT of EDR_FOP_FULL, the key is NAME + ADDRESS """
+    return (
+        '<SUBJECT>'
+        + element('NAME', f'{person(identity)} {i}') + element('ADDRESS', address(identity))
+        + element('STAN', rnd.choice(STAN))
+        + element('REGISTRATION', f'{date(rnd)} {date(rnd)} 2 000 000 0000 {i:06d}') + element('ESTATE_MANAGER')
+        + element('TERMINATED_INFO') + element('TERMINATION_CANCEL_INFO') + element('CONTACTS', '044-123-45-67')
+        + element('VP_DATES')
+        + element('CURRENT_AUTHORITY', 'Шевченківська районна в місті Києві державна адміністрація')
+        + activity_kinds(rnd, children) + exchange_data(rnd)
+        + '</SUBJECT>\n'
+    )
+
+
+def fop_record(identity, rnd, i, children):
+    """ RECORD of the short FOP dataset, the key is FIO + ADDRESS """
+    code, name = rnd.choice(KVEDS)
+    return (
+        '<RECORD>'
+        + element('FIO', f'{person(identity)} {i}') + element('ADDRESS', address(identity))
+        + element('KVED', f'{code} {name}') + element('STAN', rnd.choice(STAN))
+        + '</RECORD>\n'
+    )
+
+
+def ratu_record(identity, rnd, i, children):
+    """ RECORD of RATU, a changed record is a renamed street """
+    return (
+        '<RECORD>'
+        + element('OBL_NAME', identity.choice(REGIONS)) + element('REGION_NAME', identity.choice(DISTRICTS))
+        + element('CITY_NAME', identity.choice(CITIES)) + element('CITY_REGION_NAME')
+        + element('STREET_NAME', f'{rnd.choice(STREETS)} {i}')
+        + '</RECORD>\n'
+    )
+
+
+def generate(file_path, record_function, count, seed=0, change_ratio=0.0, children=3, encoding='UTF-8'):
+    changes = random.Random(f'{seed}:changes')
+    with open(file_path, 'w', encoding=encoding) as file:
+        file.write(f'<?xml version="1.0" encoding="{encoding}"?>\n<DATA FORMAT_VERSION="1.0">\n')
+        for i in range(count):
+            changed = changes.random() < change_ratio
+            identity = random.Random(f'{seed}:{i}')
+            rnd = random.Random(f'{seed}:{i}:changed' if changed else f'{seed}:{i}:content')
+            file.write(record_function(identity, rnd, i, children))
+        file.write('</DATA>\n')
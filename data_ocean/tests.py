@@ -1,5 +1,29 @@
-from django.test import SimpleTestCase
+import datetime
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+from django.test import SimpleTestCase, TestCase
+from lxml import etree
+
+from data_ocean.benchmark import BenchmarkError, run_converter
+from data_ocean.converter import (
+    BulkCreateManager, FingerprintManager, JsonFingerprintManager, UpsertManager, get_line_shards, iter_lines,
+    iter_raw_records, to_copy_value
+)
+from data_ocean.downloader import CleanXmlStream, FileFetcher
+from data_ocean.fetcher import RateLimiter, fetch_ordered, make_session
+from data_ocean.models import Status
+from data_ocean.record_schema import Collection, Group, RecordSchema, Text
+from data_ocean.synthetic import fop_full_record, generate
+from business_register.models.company_models import Company, Founder
 from data_ocean.transliteration.utils import transliterate, translate_company_type_in_string,\
     translate_country_in_string, translate_last_position_in_string
 
@@ -150,3 +174,475 @@ class TransliterateTestCase(SimpleTestCase):
         )
         for tested, expected in variants:
             self.assertEqual(transliterate(translate_last_position_in_string(tested)), expected)
+
+
+class CopyValueTestCase(SimpleTestCase):
+    def test_to_copy_value(self):
+        variants = (
+            (None, '\\N'),
+            (True, 't'),
+            (False, 'f'),
+            (12.5, '12.5'),
+            ('ТОВ "АЛМАЗ"', 'ТОВ "АЛМАЗ"'),
+            ('вул. Шевченка\tбуд. 1\r\nкв. 2', 'вул. Шевченка\\tбуд. 1\\r\\nкв. 2'),
+            ('C:\\data', 'C:\\\\data'),
+        )
+        for tested, expected in variants:
+            self.assertEqual(to_copy_value(tested), expected)
+
+
+class CopyCreateTestCase(TestCase):
+    def test_copy_create(self):
+        status = Status.objects.create(name='зареєстровано')
+        companies = [
+            Company(name='ТОВ "АЛМАЗ"\tфілія\r\nкв. 2', code='C:\\data', edrpou=None, status=status,
+                    registration_date=datetime.date(2020, 2, 29), from_antac_only=False),
+            Company(name='ПП "ЮЛІЯ"', code='2', status=None, from_antac_only=True),
+        ]
+        bulk_manager = BulkCreateManager(copy_models=(Company, Founder))
+        for company in companies:
+            bulk_manager.add(company)
+        bulk_manager.commit(Company)
+        # ids are taken from the sequence, so the children are linked before the next COPY
+        for company in companies:
+            self.assertIsNotNone(company.id)
+            self.assertFalse(company._state.adding)
+            bulk_manager.add(Founder(company=company, name='ІВАНОВ\tІВАН', info='', equity=12.5, edrpou=None))
+        bulk_manager.commit(Founder)
+        self.assertGreater(Company.objects.create(name='ТОВ "ВЕСНА"', code='3').id, max(c.id for c in companies))
+        for company in companies:
+            stored = Company.objects.get(id=company.id)
+            for field in ('name', 'code', 'edrpou', 'status_id', 'registration_date', 'from_antac_only'):
+                self.assertEqual(getattr(stored, field), getattr(company, field))
+            # auto_now and auto_now_add fields are set like save() does
+            self.assertIsNotNone(company.created_at)
+            self.assertEqual(stored.created_at, company.created_at)
+            self.assertEqual(stored.updated_at, company.updated_at)
+            self.assertIsNone(stored.deleted_at)
+            self.assertEqual(
+                list(stored.founders.values_list('name', 'equity', 'edrpou', 'is_beneficiary')),
+                [('ІВАНОВ\tІВАН', 12.5, None, False)]
+            )
+
+
+class FingerprintTestCase(SimpleTestCase):
+    def test_get_fingerprint(self):
+        fingerprint_manager = FingerprintManager('test')
+        fingerprint = fingerprint_manager.get_fingerprint(
+            etree.fromstring('<SUBJECT a="1" b="2"><NAME>АЛМАЗ</NAME><CONTACTS/></SUBJECT>')
+        )
+        variants = (
+            ('<SUBJECT b="2" a="1"><NAME>АЛМАЗ</NAME><CONTACTS></CONTACTS></SUBJECT>', True),
+            ("<SUBJECT a='1' b='2'><NAME>АЛМАЗ</NAME><CONTACTS/></SUBJECT>", True),
+            ('<SUBJECT a="1" b="2"><NAME>АЛМАЗ 2</NAME><CONTACTS/></SUBJECT>', False),
+            ('<SUBJECT a="1" b="2"><NAME>АЛМАЗ</NAME></SUBJECT>', False),
+        )
+        for tested, expected in variants:
+            self.assertEqual(fingerprint_manager.get_fingerprint(etree.fromstring(tested)) == fingerprint, expected)
+
+    def test_get_json_fingerprint(self):
+        fingerprint_manager = JsonFingerprintManager('test')
+        fingerprint = fingerprint_manager.get_fingerprint({'Geon_Id': 1, 'BUILDS': {'BUILD': [{'Bld_Num': '1'}]}})
+        variants = (
+            ({'BUILDS': {'BUILD': [{'Bld_Num': '1'}]}, 'Geon_Id': 1}, True),
+            ({'Geon_Id': 1, 'BUILDS': {'BUILD': [{'Bld_Num': '1'}, {'Bld_Num': '2'}]}}, False),
+            ({'Geon_Id': '1', 'BUILDS': {'BUILD': [{'Bld_Num': '1'}]}}, False),
+        )
+        for tested, expected in variants:
+            self.assertEqual(fingerprint_manager.get_fingerprint(tested) == fingerprint, expected)
+
+
+class FingerprintStoreTestCase(TestCase):
+    def test_clear(self):
+        records = [etree.fromstring(f'<SUBJECT><NAME>{name}</NAME></SUBJECT>') for name in ('А', 'Б')]
+        fingerprint_manager = FingerprintManager('test')
+        changed, unchanged = fingerprint_manager.filter_changed(records, lambda record: record.findtext('NAME'))
+        self.assertEqual(changed, records)
+        fingerprint_manager.add('А', 1)
+        fingerprint_manager.add('Б', 2)
+        fingerprint_manager.commit()
+        changed, unchanged = fingerprint_manager.filter_changed(records, lambda record: record.findtext('NAME'))
+        self.assertEqual((changed, unchanged), ([], {'А': 1, 'Б': 2}))
+        # fingerprints of the other registers are kept
+        FingerprintManager('other').clear()
+        self.assertEqual(fingerprint_manager.filter_changed(records, lambda record: record.findtext('NAME'))[0], [])
+        # all the records are saved again after a fix of the converter
+        fingerprint_manager.clear()
+        changed, unchanged = fingerprint_manager.filter_changed(records, lambda record: record.findtext('NAME'))
+        self.assertEqual((changed, unchanged), (records, {}))
+
+
+class UpsertManagerTestCase(TestCase):
+    def setUp(self):
+        self.upsert_manager = UpsertManager(Company, key_fields=('edrpou', 'source'), update_fields=('name',),
+                                            run_field='last_seen_run')
+
+    def create_company(self, name, edrpou):
+        return Company.objects.create(name=name, edrpou=edrpou, source=Company.GREAT_BRITAIN_REGISTER, code=name)
+
+    def get_row(self, name, edrpou):
+        return {'name': name, 'edrpou': edrpou, 'source': Company.GREAT_BRITAIN_REGISTER, 'code': name,
+                'last_seen_run': 7}
+
+    def test_upsert(self):
+        first = self.create_company('ALMAZ', '1')
+        duplicate = self.create_company('ALMAZ', '1')
+        without_number = self.create_company('YULIYA', None)
+        deleted = self.create_company('ZORYA', '3')
+        deleted.soft_delete()
+        unchanged = self.create_company('VESNA', '5')
+        result = self.upsert_manager.upsert([
+            self.get_row('ALMAZ 2', '1'),
+            self.get_row('YULIYA 2', None),
+            self.get_row('ZORYA', '3'),
+            self.get_row('NOVA', '4'),
+            self.get_row('NOVA', '4'),
+            self.get_row('VESNA', '5'),
+        ])
+        gb = Company.GREAT_BRITAIN_REGISTER
+        new = Company.objects.get(edrpou='4')
+        self.assertEqual(result.inserted, {('4', gb): new.id})
+        self.assertEqual(result.updated, {('1', gb): first.id, (None, gb): without_number.id, ('3', gb): deleted.id})
+        self.assertEqual(result.unchanged, {('5', gb): unchanged.id})
+        # only the first one of the duplicates is updated
+        self.assertEqual(Company.objects.get(id=first.id).name, 'ALMAZ 2')
+        self.assertEqual(Company.objects.get(id=duplicate.id).name, 'ALMAZ')
+        self.assertEqual(Company.objects.get(id=without_number.id).name, 'YULIYA 2')
+        self.assertTrue(Company.objects.filter(id=deleted.id).exists())
+        # stored rows are stamped with the run, changed or not
+        self.assertEqual(
+            dict(Company.objects.values_list('id', 'last_seen_run')),
+            {first.id: 7, duplicate.id: None, without_number.id: 7, deleted.id: 7, unchanged.id: 7, new.id: 7}
+        )
+        self.assertEqual(list(Company.history.filter(id=new.id).values_list('history_type', flat=True)), ['+'])
+        self.assertEqual(Company.history.filter(id=first.id, history_type='~').count(), 1)
+        self.assertEqual(Company.history.filter(id=unchanged.id, history_type='~').count(), 0)
+        # NULL in the key matches the stored row, so nothing is inserted by the next run
+        result = self.upsert_manager.upsert([self.get_row('YULIYA 2', None), self.get_row('NOVA', '4')])
+        self.assertEqual((result.inserted, result.updated), ({}, {}))
+        self.assertEqual(Company.objects.count(), 6)
+
+
+class RawRecordsTestCase(SimpleTestCase):
+    def test_iter_raw_records(self):
+        data = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n<DATA>\n<RECORD><NAME>ТОВ "АЛМАЗ"</NAME></RECORD>\n'
+            '<RECORDS_COUNT>2</RECORDS_COUNT>\n<RECORD a="1">\n<NAME>ПП "ЮЛІЯ"</NAME>\n</RECORD>\n</DATA>\n'
+        ).encode()
+        expected = [
+            '<RECORD><NAME>ТОВ "АЛМАЗ"</NAME></RECORD>'.encode(),
+            '<RECORD a="1">\n<NAME>ПП "ЮЛІЯ"</NAME>\n</RECORD>'.encode(),
+        ]
+        for block_size in (1, 7, 1024):
+            records = list(iter_raw_records(io.BytesIO(data), 'RECORD', block_size=block_size))
+            self.assertEqual([record for offset, record in records], expected)
+            for offset, record in records:
+                self.assertEqual(data[offset:offset + len(record)], record)
+        # resuming from the end of the first record
+        offset = records[0][0] + len(records[0][1])
+        self.assertEqual(
+            list(iter_raw_records(io.BytesIO(data[offset:]), 'RECORD', offset, block_size=7)),
+            [records[1]]
+        )
+        with self.assertRaises(Exception):
+            list(iter_raw_records(io.BytesIO(data[:-30]), 'RECORD', block_size=7))
+
+
+class LineShardsTestCase(SimpleTestCase):
+    def test_get_line_shards(self):
+        lines = ['"name","number"\n'] + [f'"ТОВ {i}","{i:08d}"\n' for i in range(50)]
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8', delete=False) as file:
+            file.writelines(lines)
+        self.addCleanup(os.remove, file.name)
+        header_size = len(lines[0].encode())
+        for shard_size in (1, 20, 100, 10000):
+            shards = get_line_shards(file.name, shard_size, header_size)
+            self.assertEqual(shards[0][0], header_size)
+            self.assertEqual(shards[-1][1], os.path.getsize(file.name))
+            self.assertEqual(
+                [line for start, end in shards for line in iter_lines(file.name, start, end)],
+                lines[1:]
+            )
+
+
+class RecordSchemaTestCase(SimpleTestCase):
+    def test_extract(self):
+        kved = RecordSchema('Kved', [Text('CODE'), Text('NAME'), Text('PRIMARY')])
+        info = RecordSchema('Info', [Text('OP_DATE'), Text('REASON')])
+        schema = RecordSchema('Subject', [
+            Text('NAME'),
+            Text('EDRPOU', 'code'),
+            Text('ADDRESS'),
+            Collection('FOUNDERS'),
+            Collection('ACTIVITY_KINDS', kved),
+            Collection('SIGNERS'),
+            Group('TERMINATION_STARTED_INFO', info),
+            Group('BANKRUPTCY_READJUSTMENT_INFO', info),
+        ])
+        element = etree.fromstring(
+            '<SUBJECT><NAME>ТОВ "АЛМАЗ"</NAME><EDRPOU>12345678</EDRPOU><ADDRESS/><STAN>зареєстровано</STAN>'
+            '<FOUNDERS><FOUNDER>ІВАНОВ ІВАН</FOUNDER><FOUNDER>ПЕТРОВ ПЕТРО</FOUNDER></FOUNDERS>'
+            '<ACTIVITY_KINDS><ACTIVITY_KIND><CODE>62.01</CODE><NAME>Програмування</NAME><PRIMARY>так</PRIMARY>'
+            '</ACTIVITY_KIND><ACTIVITY_KIND><NAME>Торгівля</NAME></ACTIVITY_KIND></ACTIVITY_KINDS>'
+            '<TERMINATION_STARTED_INFO><OP_DATE>01.02.2020</OP_DATE></TERMINATION_STARTED_INFO></SUBJECT>'
+        )
+        record = schema.extract(element)
+        self.assertEqual(record.name, 'ТОВ "АЛМАЗ"')
+        self.assertEqual(record.code, '12345678')
+        self.assertIsNone(record.address)
+        self.assertFalse(hasattr(record, 'stan'))
+        self.assertEqual(record.founders, ['ІВАНОВ ІВАН', 'ПЕТРОВ ПЕТРО'])
+        self.assertEqual(
+            [(item.code, item.name, item.primary) for item in record.activity_kinds],
+            [('62.01', 'Програмування', 'так'), (None, 'Торгівля', None)]
+        )
+        self.assertEqual(record.signers, [])
+        self.assertEqual(record.termination_started_info.op_date, '01.02.2020')
+        self.assertIsNone(record.termination_started_info.reason)
+        self.assertIsNone(record.bankruptcy_readjustment_info)
+        # collections of the records are not shared
+        self.assertIsNot(schema.extract(element).signers, record.signers)
+        self.assertEqual(schema.extract(element), record)
+
+
+class SyntheticTestCase(SimpleTestCase):
+    def read_records(self, file_path):
+        with open(file_path, 'rb') as file:
+            return [record for offset, record in iter_raw_records(file, 'SUBJECT')]
+
+    def test_generate(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        file_path = os.path.join(folder, 'fop.xml')
+        generate(file_path, fop_full_record, 200, seed=1)
+        records = self.read_records(file_path)
+        self.assertEqual(len(records), 200)
+        generate(file_path, fop_full_record, 200, seed=1)
+        self.assertEqual(self.read_records(file_path), records)
+        generate(file_path, fop_full_record, 200, seed=1, change_ratio=0.2)
+        changed = [
+            (etree.fromstring(old), etree.fromstring(new))
+            for old, new in zip(records, self.read_records(file_path)) if old != new
+        ]
+        self.assertTrue(20 < len(changed) < 60)
+        # keys of the changed records are the same
+        for old, new in changed:
+            self.assertEqual(old.findtext('NAME'), new.findtext('NAME'))
+            self.assertEqual(old.findtext('ADDRESS'), new.findtext('ADDRESS'))
+
+
+class FailingConverter:
+    LOCAL_FOLDER = None
+    LOCAL_FILE_NAME = None
+
+    def process(self, workers=1):
+        return False
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    def test_failed_run(self):
+        with self.assertRaises(BenchmarkError):
+            run_converter('fop', FailingConverter(), '/tmp/fop.xml', 100)
+
+
+class CleanXmlStreamTestCase(SimpleTestCase):
+    def test_clean_xml_stream(self):
+        source = (
+            '<?xml version="1.0" encoding="windows-1251"?>\n<DATA>'
+            '<SUBJECT><NAME>ТОВ &quot;АЛМАЗ&quot;&#3;</NAME></SUBJECT>'
+            '<SUBJECT><NAME>ПП &#31;&quot;ЮЛІЯ&quot;</NAME></SUBJECT></DATA>\n'
+        )
+        expected = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n<DATA>'
+            '<SUBJECT><NAME>ТОВ "АЛМАЗ"</NAME></SUBJECT>'
+            '<SUBJECT><NAME>ПП "ЮЛІЯ"</NAME></SUBJECT></DATA>\n'
+        ).encode()
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('EDR_UO_FULL.xml', source.encode('cp1251'))
+        for block_size in (1, 3, 7, 1024):
+            with zipfile.ZipFile(archive) as zip_file:
+                stream = CleanXmlStream(zip_file.open('EDR_UO_FULL.xml'), block_size=block_size)
+                self.assertEqual(stream.read(), expected)
+        with zipfile.ZipFile(archive) as zip_file:
+            stream = CleanXmlStream(zip_file.open('EDR_UO_FULL.xml'), block_size=5)
+            self.assertEqual(
+                [record for offset, record in iter_raw_records(stream, 'SUBJECT', block_size=4)],
+                ['<SUBJECT><NAME>ТОВ "АЛМАЗ"</NAME></SUBJECT>'.encode(),
+                 '<SUBJECT><NAME>ПП "ЮЛІЯ"</NAME></SUBJECT>'.encode()]
+            )
+
+
+class StubFileHandler(BaseHTTPRequestHandler):
+    content = bytes(range(256)) * 4000
+    etag = '"v1"'
+    # the connection is dropped after this number of bytes of the next response
+    drop_after = None
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start, end = 0, len(self.content) - 1
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') == self.etag:
+            start, end = (int(value) for value in range_header[len('bytes='):].split('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(self.content)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        body = self.content[start:end + 1]
+        if type(self).drop_after is not None:
+            body = body[:type(self).drop_after]
+            type(self).drop_after = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+class FileFetcherTestCase(SimpleTestCase):
+    def setUp(self):
+        StubFileHandler.requests = []
+        StubFileHandler.drop_after = None
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubFileHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/ufop_full.zip'
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, 'ufop_full.zip')
+        self.sha256 = hashlib.sha256(StubFileHandler.content).hexdigest()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def assertFetched(self, fetcher):
+        with open(self.file_path, 'rb') as file:
+            self.assertEqual(file.read(), StubFileHandler.content)
+        self.assertEqual(fetcher.sha256, self.sha256)
+        self.assertEqual(sorted(os.listdir(self.folder)), ['ufop_full.zip', 'ufop_full.zip.meta.json'])
+
+    def test_fetch_and_not_modified(self):
+        fetcher = FileFetcher(self.url, self.file_path, chunk_size=1000)
+        self.assertTrue(fetcher.fetch())
+        self.assertFetched(fetcher)
+        os.remove(self.file_path)
+        self.assertFalse(FileFetcher(self.url, self.file_path).fetch())
+        self.assertEqual(StubFileHandler.requests[-1].get('If-None-Match'), '"v1"')
+
+    def test_fetch_segments(self):
+        fetcher = FileFetcher(self.url, self.file_path, segments=3, chunk_size=1000)
+        self.assertTrue(fetcher.fetch())
+        self.assertFetched(fetcher)
+        self.assertEqual(len([headers for headers in StubFileHandler.requests if 'Range' in headers]), 3)
+
+    def test_resume_interrupted(self):
+        StubFileHandler.drop_after = 100000
+        fetcher = FileFetcher(self.url, self.file_path, chunk_size=1000)
+        self.assertTrue(fetcher.fetch())
+        self.assertFetched(fetcher)
+        self.assertEqual(StubFileHandler.requests[-1]['Range'], f'bytes=100000-{len(StubFileHandler.content) - 1}')
+
+    def test_resume_next_run(self):
+        # the previous run was interrupted after 50000 bytes
+        with open(self.file_path + '.part0', 'wb') as file:
+            file.write(StubFileHandler.content[:50000])
+        with open(self.file_path + FileFetcher.META_SUFFIX, 'w') as file:
+            json.dump({'url': self.url, 'etag': '"v1"', 'validator': '"v1"', 'last_modified': None,
+                       'size': len(StubFileHandler.content), 'segments': 1, 'complete': False}, file)
+        fetcher = FileFetcher(self.url, self.file_path)
+        self.assertTrue(fetcher.fetch())
+        self.assertFetched(fetcher)
+        self.assertEqual(StubFileHandler.requests[-1]['Range'], f'bytes=50000-{len(StubFileHandler.content) - 1}')
+
+
+class StubServiceHandler(BaseHTTPRequestHandler):
+    # POST /<number> answers the number after a delay, the first failures requests get 503
+    delay = 0.1
+    failures = 0
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if type(self).failures:
+            type(self).failures -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        number = int(self.path.strip('/'))
+        handler = type(self)
+        with self.lock:
+            handler.in_flight += 1
+            handler.max_in_flight = max(handler.max_in_flight, handler.in_flight)
+        # later items are answered faster, so the results come out of order
+        time.sleep(self.delay / (number + 1))
+        with self.lock:
+            handler.in_flight -= 1
+        body = str(number).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FetcherTestCase(SimpleTestCase):
+    def setUp(self):
+        StubServiceHandler.failures = 0
+        StubServiceHandler.max_in_flight = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubServiceHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.session = make_session(backoff_factor=0)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, number):
+        response = self.session.post(f'{self.url}/{number}', data=b'<Envelope/>', timeout=5)
+        response.raise_for_status()
+        return int(response.text)
+
+    def test_fetch_ordered(self):
+        for workers, max_pending in ((1, None), (4, None), (4, 1), (8, 3)):
+            self.assertEqual(
+                list(fetch_ordered(self.request, range(12), workers, max_pending)),
+                [(number, number) for number in range(12)]
+            )
+
+    def test_concurrency(self):
+        for workers in (1, 4):
+            StubServiceHandler.max_in_flight = 0
+            list(fetch_ordered(self.request, [0] * 8, workers=workers))
+            # requests of 0.1 sec each overlap, but no more of them than the workers
+            self.assertLessEqual(StubServiceHandler.max_in_flight, workers)
+        self.assertGreater(StubServiceHandler.max_in_flight, 1)
+
+    def test_retries(self):
+        StubServiceHandler.failures = 2
+        self.assertEqual(list(fetch_ordered(self.request, [3], workers=2)), [(3, 3)])
+        StubServiceHandler.failures = 5
+        with self.assertRaises(Exception):
+            list(fetch_ordered(self.request, [3], workers=2))
+
+    def test_rate_limiter(self):
+        start = time.monotonic()
+        list(fetch_ordered(self.request, range(5, 10), workers=5, rate_limiter=RateLimiter(10)))
+        # 5 requests with 10 requests per second take 0.4 sec at least, a slow runner only makes it longer
+        self.assertGreater(time.monotonic() - start, 0.3)
@@ -2,14 +2,18 @@
 
 import logging
 import sys
+import threading
 
 from django.conf import settings
 from django.utils import timezone
 from zeep import Client, Settings
+from zeep.cache import InMemoryCache
 from zeep.helpers import serialize_object
+from zeep.transports import Transport
 
-from data_ocean.converter import Converter
+from data_ocean.converter import Converter, JsonFingerprintManager, soft_delete_by_ids
 from data_ocean.downloader import Downloader
+from data_ocean.fetcher import RateLimiter, fetch_ordered, make_session
 from data_ocean.utils import clean_name, change_to_full_name
 from location_register.models.drv_models import (DrvAto, DrvBuilding,
                                                  DrvCouncil, DrvDistrict,
@@ -25,6 +29,12 @@ class DrvConverter(Converter):
     SETTINGS = Settings(strict=settings.LOCATION_DRV_STRICT, xml_huge_tree=settings.LOCATION_DRV_XML_HUGE_TREE)
 
     # SETTINGS = Settings(strict=False, xml_huge_tree=True)
+    IMPORT_RUN_REGISTER = 'location_drv'
+    # ATOs of the regions and streets of the ATOs are fetched by threads, DB is written by the main one
+    FETCH_WORKERS = 4
+    REQUESTS_PER_SECOND = 10
+    # fields of DrvBuilding compared with the source, attnames
+    BUILDING_FIELDS = ('region_id', 'district_id', 'council_id', 'ato_id', 'street_id', 'zip_code_id', 'number')
 
     def __init__(self):
         """
@@ -45,12 +55,33 @@ class DrvConverter(Converter):
         self.outdated_streets_dict = self.put_objects_to_dict('code', 'location_register', 'DrvStreet')
         self.zipcodes_dict = self.put_objects_to_dict('code', 'location_register', 'ZipCode')
         self.outdated_zipcodes_dict = self.put_objects_to_dict('code', 'location_register', 'ZipCode')
-        self.outdated_buildings_list = list(DrvBuilding.objects.values_list('id', flat=True))
+        # {code: (id, hash of BUILDING_FIELDS)}
+        self.buildings_index = self.put_buildings_to_index()
+        # hashes of the street payloads of the last update, buildings of unchanged streets are not compared
+        self.street_fingerprints = JsonFingerprintManager('location_drv_street')
+        self.streets_skipped = 0
+        self.streets_changed = 0
+        self.buildings_skipped = 0
+        # one session and one parsed WSDL for all the requests
+        self.transport = Transport(session=make_session(pool_size=self.FETCH_WORKERS * 2), cache=InMemoryCache())
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.rate_limiter = RateLimiter(self.REQUESTS_PER_SECOND)
 
         super().__init__()
 
+    def get_client(self, service_name):
+        with self.clients_lock:
+            if service_name not in self.clients:
+                self.clients[service_name] = Client(self.WSDL_URL, service_name=service_name,
+                                                    settings=self.SETTINGS, transport=self.transport)
+            return self.clients[service_name]
+
+    def fetch(self, function, items):
+        return fetch_ordered(function, items, self.FETCH_WORKERS, rate_limiter=self.rate_limiter)
+
     def parse_regions_data(self):
-        client = Client(self.WSDL_URL, service_name='GetRegionsService', settings=self.SETTINGS)
+        client = self.get_client('GetRegionsService')
         response = client.service.GetRegions()
         # converting zeep object to Python ordered dictionary
         response_to_dict = serialize_object(response)
@@ -60,6 +91,7 @@ class DrvConverter(Converter):
     # Regions can be renamed only via constitutional amendments, so we use name as unique identifier
     # and updating only codes, numbers and short_names)
     def save_region_data(self, regions_data_list):
+        regions = []
         for dictionary in regions_data_list:
             code = str(dictionary['Region_Id'])
             number = dictionary['Region_Num']
@@ -92,11 +124,12 @@ class DrvConverter(Converter):
                     capital=capital
                 )
                 self.regions_dict[name] = region
-            atos_data_list = self.parse_atos_data(region)
+            regions.append(region)
+        for region, atos_data_list in self.fetch(self.parse_atos_data, regions):
             self.save_ato_data(atos_data_list, region)
 
     def parse_atos_data(self, region):
-        client = Client(self.WSDL_URL, service_name='GetATUUService', settings=self.SETTINGS)
+        client = self.get_client('GetATUUService')
         response = client.service.ATUUQuery(ATOParams=region.code)
         # converting zeep object to Python ordered dictionary
         response_to_dict = serialize_object(response)
@@ -104,6 +137,9 @@ class DrvConverter(Converter):
         return response_to_dict['ATO']
 
     def save_ato_data(self, atos_data_list, region):
+        atos = []
+        # streets of new and moved ATOs are saved even with unchanged payloads
+        changed_atos = set()
         for dictionary in atos_data_list:
             district_name = dictionary['ATO_Raj']
             district_name = change_to_full_name(district_name)
@@ -154,6 +190,7 @@ class DrvConverter(Converter):
                 if update_fields:
                     update_fields.append('updated_at')
                     ato.save(update_fields=update_fields)
+                    changed_atos.add(ato.id)
                 if self.outdated_atos_dict.get(ato_code):
                     del self.outdated_atos_dict[ato_code]
             else:
@@ -164,17 +201,54 @@ class DrvConverter(Converter):
                     name=ato_name,
                     code=ato_code)
                 self.atos_dict[ato_code] = ato
-            streets_data_list = self.parse_streets_data(ato)
+                changed_atos.add(ato.id)
+            atos.append((district, council, ato))
+        for (district, council, ato), streets_data_list in self.fetch(lambda item: self.parse_streets_data(item[2]),
+                                                                      atos):
+            streets_data_list = self.filter_changed_streets(streets_data_list, ato, ato.id in changed_atos)
             self.save_street_data(streets_data_list, region, district, council, ato)
+            self.street_fingerprints.commit()
 
     def parse_streets_data(self, ato):
-        client = Client(self.WSDL_URL, service_name='GetAdrRegService', settings=self.SETTINGS)
+        client = self.get_client('GetAdrRegService')
         response = client.service.AdrRegQuery(AdrRegParams=ato.code)
         # converting zeep object to Python ordered dictionary
         response_to_dict = serialize_object(response)
         # accessing a nested list with ATO data as dictionaries
         return response_to_dict['GEONIM']
 
+    def filter_changed_streets(self, streets_data_list, ato, ato_changed):
+        """
+        returns the new streets and the streets changed since the last update,
+        buildings of the other streets are only stamped with the current run
+        """
+        streets_data = {str(dictionary['Geon_Id']): dictionary for dictionary in streets_data_list}
+        changed, unchanged = self.street_fingerprints.filter_changed(
+            streets_data_list, lambda dictionary: str(dictionary['Geon_Id'])
+        )
+        seen_streets = []
+        for code, street_id in unchanged.items():
+            dictionary = streets_data[code]
+            buildings_data_list = dictionary['BUILDS']['BUILD'] if dictionary['BUILDS'] else []
+            zip_code_values = {building_data['Bld_Ind'] for building_data in buildings_data_list}
+            street = self.streets_dict.get(code)
+            if (ato_changed or not street or street.id != street_id or street.ato_id != ato.id
+                    or any(value not in self.zipcodes_dict for value in zip_code_values)):
+                # the payload is the same, but the stored rows are not, fingerprints stay as they are
+                changed.append(dictionary)
+                continue
+            if self.outdated_streets_dict.get(code):
+                del self.outdated_streets_dict[code]
+            for value in zip_code_values:
+                self.outdated_zipcodes_dict.pop(value, None)
+            seen_streets.append(street.id)
+            self.buildings_skipped += len(buildings_data_list)
+        if seen_streets:
+            DrvBuilding.objects.filter(street_id__in=seen_streets).update(last_seen_run=self.import_run.id)
+        self.streets_skipped += len(seen_streets)
+        self.streets_changed += len(changed)
+        return changed
+
     def save_street_data(self, streets_data_list, region, district, council, ato):
         for dictionary in streets_data_list:
             code = str(dictionary['Geon_Id'])
@@ -232,8 +306,24 @@ class DrvConverter(Converter):
                 self.streets_dict[code] = street
             if buildings_data_list:
                 self.save_building_data(buildings_data_list, region, district, council, ato, street)
+            self.street_fingerprints.add(code, street.id)
+
+    def get_building_values(self, building):
+        return tuple(getattr(building, field) for field in self.BUILDING_FIELDS)
+
+    def put_buildings_to_index(self):
+        # only the id and a hash of the fields are kept for the millions of buildings,
+        # soft deleted buildings have no hash, so they are always updated and restored
+        buildings_index = {}
+        for code, building_id, deleted_at, *values in DrvBuilding.include_deleted_objects.values_list(
+                'code', 'id', 'deleted_at', *self.BUILDING_FIELDS).iterator():
+            buildings_index[code] = (building_id, None if deleted_at else hash(tuple(values)))
+        return buildings_index
 
     def save_building_data(self, buildings_data_list, region, district, council, ato, street):
+        new_buildings = {}
+        changed_buildings = {}
+        seen_buildings = []
         for dictionary in buildings_data_list:
             code = str(dictionary['Bld_ID'])
             number = dictionary['Bld_Num']
@@ -274,47 +364,45 @@ class DrvConverter(Converter):
                     ato=ato,
                     code=zip_code_value)
                 self.zipcodes_dict[zip_code_value] = zip_code
-            building = DrvBuilding.objects.filter(code=code).first()
-            if building:
-                update_fields = []
-                if building.region_id != region.id:
-                    building.region_id = region.id
-                    update_fields.append('region')
-                if building.district_id != district.id:
-                    building.district_id = district.id
-                    update_fields.append('district')
-                if building.council_id != council.id:
-                    building.council_id = council.id
-                    update_fields.append('council')
-                if building.ato_id != ato.id:
-                    building.ato_id = ato.id
-                    update_fields.append('ato')
-                if building.street_id != street.id:
-                    building.street_id = street.id
-                    update_fields.append('street')
-                if building.zip_code_id != zip_code.id:
-                    building.zip_code_id = zip_code.id
-                    update_fields.append('zip_code')
-                if building.number != number:
-                    building.number = number
-                    update_fields.append('number')
-                if update_fields:
-                    update_fields.append('updated_at')
-                    building.save(update_fields=update_fields)
-                self.outdated_buildings_list.remove(building.id)
+            building = DrvBuilding(
+                region_id=region.id,
+                district_id=district.id,
+                council_id=council.id,
+                ato_id=ato.id,
+                street_id=street.id,
+                zip_code_id=zip_code.id,
+                code=code,
+                number=number,
+                last_seen_run=self.import_run.id
+            )
+            values_hash = hash(self.get_building_values(building))
+            stored = self.buildings_index.get(code)
+            if not stored:
+                # the last one of the duplicates of the code is saved
+                new_buildings[code] = building
+            elif stored[1] != values_hash:
+                building.id = stored[0]
+                building.updated_at = timezone.now()
+                building.deleted_at = None
+                changed_buildings[code] = building
+                self.buildings_index[code] = (stored[0], values_hash)
             else:
-                building = DrvBuilding.objects.create(
-                    region=region,
-                    district=district,
-                    council=council,
-                    ato=ato,
-                    street=street,
-                    zip_code=zip_code,
-                    code=code,
-                    number=number
-                )
+                seen_buildings.append(stored[0])
+        if new_buildings:
+            for building in DrvBuilding.objects.bulk_create(new_buildings.values()):
+                self.buildings_index[building.code] = (building.id, hash(self.get_building_values(building)))
+        if changed_buildings:
+            # bulk_update doesn't set auto_now fields, so updated_at is set above
+            DrvBuilding.include_deleted_objects.bulk_update(
+                changed_buildings.values(),
+                [*self.BUILDING_FIELDS, 'updated_at', 'deleted_at', 'last_seen_run']
+            )
+        if seen_buildings:
+            DrvBuilding.objects.filter(id__in=seen_buildings).update(last_seen_run=self.import_run.id)
 
     def delete_outdated(self):
+        # deleted streets must be saved when they come back
+        self.street_fingerprints.forget([street.id for street in self.outdated_streets_dict.values()])
         if self.outdated_districts_dict:
             for district in self.outdated_districts_dict.values():
                 district.soft_delete()
@@ -330,14 +418,19 @@ class DrvConverter(Converter):
         if self.outdated_zipcodes_dict:
             for zipcode in self.outdated_zipcodes_dict.values():
                 zipcode.soft_delete()
-        if self.outdated_buildings_list:
-            for building_id in self.outdated_buildings_list:
-                DrvBuilding.objects.get(id=building_id).soft_delete()
+        # buildings that were not stamped with the current run
+        outdated_buildings = DrvBuilding.objects.exclude(
+            last_seen_run=self.import_run.id
+        ).values_list('id', flat=True)
+        soft_delete_by_ids(outdated_buildings, [(DrvBuilding, 'id')])
 
     def process(self):
+        self.start_import_run()
         regions_data = self.parse_regions_data()
         self.save_region_data(regions_data)
+        logger.info(f'Streets skipped: {self.streets_skipped}, changed: {self.streets_changed}.')
         self.delete_outdated()
+        self.import_run.finish()
 
 
 class DrvUpdater(Downloader):
@@ -355,8 +448,10 @@ class DrvUpdater(Downloader):
 
         logger.info(f'{self.reg_name}: DrvConverter().process() started ...')
         converter = DrvConverter()
+        converter.report = self.report
         converter.process()
         self.report.invalid_data = converter.invalid_data_counter
+        self.report.records_skipped = converter.buildings_skipped
         logger.info(f'{self.reg_name}: DrvConverter().process() finished successfully.')
 
         self.report.update_finish = timezone.now()
@@ -1,11 +1,13 @@
 # Python logging package
 import logging
+from collections import Counter, defaultdict
 
 import requests
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 
-from data_ocean.converter import Converter
+from data_ocean.converter import BulkUpdateManager, Converter
 from data_ocean.downloader import Downloader
 from data_ocean.utils import clean_name, change_to_full_name, get_lowercase_substring_before_slash
 from location_register.models.koatuu_models import (KoatuuFirstLevel, KoatuuSecondLevel, KoatuuThirdLevel,
@@ -17,6 +19,12 @@ logger.setLevel(logging.INFO)
 
 
 class KoatuuConverter(Converter):
+    """
+    Writes KOATUU codes and categories to the RATU tables.
+    The KOATUU file is read once, the RATU tables and categories are loaded once, and every unit
+    is matched in memory by its name within the parent found by the prefix of its code.
+    Changed objects are saved by one bulk_update per model.
+    """
     # paths for the local souce file
     LOCAL_FILE_NAME = settings.LOCATION_KOATUU_LOCAL_FILE_NAME
 
@@ -28,239 +36,148 @@ class KoatuuConverter(Converter):
     CATEGORY = 'Категорія'
     OBJECT_NAME = "Назва об'єкта українською мовою"
 
-    # geting all words before virgule and changing string to lowercase
-    def get_lowercase_words_before_virgule(self, string):
-        return string.lower().split('/')[0]
-
-    # creating a dictionary out off the values, which already exists in region table
-    def create_dictionary_for(self, table_model):  # table_medel is one model from ratu_models
-        koatuu_dict = {}
-        table_model_objects = table_model.objects.all()
-        for table_record in table_model_objects:  # dictionary for keeping whole model class objects
-            if table_record.name:
-                unit_name = table_record.name
-                koatuu_dict[unit_name] = table_record
-        return koatuu_dict
-
-    # creating a dictionary out off the values, which already exists in city table
-    def create_dictionary_for_city_table(self, table_model):
-        koatuu_dict = {}
-        table_model_objects = table_model.objects.all()  # table_model is a model from ratu_models
-        for table_record in table_model_objects:  # dictionary for keeping whole model class objects
-            if table_record.name:
-                unit_name = table_record.name + str(table_record.district_id)
-                koatuu_dict[unit_name] = table_record
-        return koatuu_dict
-
-    # creating a dictionary out off the values, which already exists in district y city table
-    def create_dictionary_for_district_table(self, table_model):
-        koatuu_dict = {}
-        table_model_objects = table_model.objects.all()  # table_model is a model from ratu_models
-        for table_record in table_model_objects:  # dictionary for keeping whole model class objects
-            if table_record.name:
-                unit_name = table_record.name + str(table_record.region_id)
-                koatuu_dict[unit_name] = table_record
-        return koatuu_dict
-
-    # creating a dictionary out off the values, which already exists in citydistrict table
-    def create_dictionary_for_citydistrict_table(self):  # table_model is a model from ratu_models
-        koatuu_dict = {}
-        table_model_objects = RatuCityDistrict.objects.all()
-        for table_record in table_model_objects:  # dictionary for keeping whole model class objects
-            if table_record.name:
-                unit_name = table_record.name + str(table_record.city_id)
-                koatuu_dict[unit_name] = table_record
-        return koatuu_dict
-
-    # creating list out of name and district_id from json file for district items
-    def create_district_items_list(
-            self,
-            object_region_name,
-            region_dict,
-            object_district_name,
-            koatuu_value
-    ):
-        district_items_list = []
-        if object_region_name not in region_dict:
+    # the first digits of a KOATUU code are the code of the region and of the district or the city of the region
+    REGION_PREFIX_LENGTH = 2
+    SECOND_LEVEL_PREFIX_LENGTH = 5
+
+    def __init__(self):
+        self.categories = self.put_objects_to_dict('code', 'location_register', 'KoatuuCategory')
+        self.regions_dict = {region.name: region for region in RatuRegion.objects.all()}
+        self.districts_dict = {(district.region_id, district.name): district
+                               for district in RatuDistrict.objects.all()}
+        self.cities_dict = {(city.region_id, city.district_id, city.name): city for city in RatuCity.objects.all()}
+        self.citydistricts_dict = {(citydistrict.city_id, citydistrict.name): citydistrict
+                                   for citydistrict in RatuCityDistrict.objects.all()}
+        # matched units by the prefixes of their KOATUU codes
+        self.regions_by_prefix = {}
+        self.second_level_by_prefix = {}
+        # {model class: {KOATUU code: object}}
+        self.assigned = defaultdict(dict)
+        # ids of the objects with a new KOATUU code
+        self.changed_ids = defaultdict(list)
+        self.bulk_update_manager = BulkUpdateManager()
+        self.matched = Counter()
+        self.missed = Counter()
+        super().__init__()
+
+    def get_code(self, value):
+        # some codes are numbers without the leading zero in the file
+        if isinstance(value, int):
+            return str(value).zfill(10)
+        return value or ''
+
+    def get_category(self, category_code):
+        return self.categories.get(category_code)
+
+    def assign(self, level, obj, code, category=None):
+        if code in self.assigned[type(obj)]:
+            logger.warning(f'KOATUU code {code} is matched with {self.assigned[type(obj)][code]} and {obj}')
+            self.missed[level] += 1
             return
-        region_koatuu = region_dict[object_region_name]
-        if koatuu_value[:2] != str(region_koatuu.koatuu)[:2]:
+        self.assigned[type(obj)][code] = obj
+        update_fields = []
+        if obj.koatuu != code:
+            obj.koatuu = code
+            update_fields.append('koatuu')
+            self.changed_ids[type(obj)].append(obj.id)
+        if category and obj.category_id != category.id:
+            obj.category_id = category.id
+            update_fields.append('category')
+        if update_fields:
+            self.bulk_update_manager.add(obj, update_fields)
+        self.matched[level] += 1
+
+    def match_region(self, code, name):
+        region = self.regions_dict.get(change_to_full_name(clean_name(get_lowercase_substring_before_slash(name))))
+        if not region:
+            self.missed['region'] += 1
             return
-        object_district_name = object_district_name + str(region_koatuu.id)
-        district_items_list.append(object_district_name)
-        return district_items_list
-
-    # creating list out of name and district_id from json file fot city items
-    def create_city_items_list(self, city_dict, district_items_list, koatuu_value):
-        city_list = []
-        for object_district_name in district_items_list:
-            if object_district_name in city_dict and koatuu_value[2] == '1':
-                city_koatuu = city_dict[object_district_name]
-                city_list.append(city_koatuu.name + str(city_koatuu.district_id))
-            return city_list
-
-    # getting id value from category table
-    def get_category_id(self, string):
-        id_number = KoatuuCategory.objects.get(code=string).id
-        return id_number
-
-    # writing entry to koatuu field in region table
-    def save_to_region_table(self, data):
-        region_dict = self.create_dictionary_for(RatuRegion)
-        for object_koatuu in data:
-            if object_koatuu[self.LEVEL_ONE] and not object_koatuu[self.LEVEL_TWO]:
-                object_region_name = self.get_lowercase_words_before_virgule(
-                    object_koatuu[self.OBJECT_NAME])
-                if object_region_name not in region_dict:
-                    return
-                region_koatuu = region_dict[object_region_name]
-                region_koatuu.koatuu = object_koatuu[self.LEVEL_ONE]
-                region_koatuu.save()
-        logger.info("Koatuu values to region saved")
-
-    # writing entry to koatuu field in district table and level_two records of city_table
-    def save_to_district_table(self, data):
-        region_dict = self.create_dictionary_for(RatuRegion)
-        district_dict = self.create_dictionary_for_district_table(RatuDistrict)
-        city_dict = self.create_dictionary_for_city_table(RatuCity)
-        for object_koatuu in data:
-            if object_koatuu[self.LEVEL_ONE] and not object_koatuu[self.LEVEL_TWO]:
-                object_region_name = self.get_lowercase_words_before_virgule(
-                    object_koatuu[self.OBJECT_NAME])
-            if object_koatuu[self.LEVEL_ONE] and object_koatuu[
-                self.LEVEL_TWO] and not object_koatuu[self.LEVEL_THREE]:
-                # koatuu_value is position in koatuu number wich defines district or city record
-                koatuu_value = str(object_koatuu[self.LEVEL_TWO])
-                object_district_name = self.get_lowercase_words_before_virgule(
-                    object_koatuu[self.OBJECT_NAME])
-                district_items_list = self.create_district_items_list(
-                    object_region_name, region_dict, object_district_name, koatuu_value)
-                category_level_two = self.get_category_id(object_koatuu[self.CATEGORY])
-                for object_district_name in district_items_list:
-                    if (object_district_name in district_dict) and (koatuu_value[2] != '1'):
-                        district_koatuu = district_dict[object_district_name]
-                        district_koatuu.koatuu = object_koatuu[self.LEVEL_TWO]
-                        district_koatuu.save()
-                    elif (object_district_name in city_dict) and (koatuu_value[2] == '1'):
-                        city_koatuu = city_dict[object_district_name]
-                        city_koatuu.koatuu = object_koatuu[self.LEVEL_TWO]
-                        city_koatuu.category_id = category_level_two
-                        city_koatuu.save()
-        logger.info("Koatuu values to district saved")
-
-    # processing entry to koatuu field in city_table and citydistrict_table
-    def save_to_city_or_citydistrict(self, data):
-        region_dict = self.create_dictionary_for(RatuRegion)
-        district_dict = self.create_dictionary_for_district_table(RatuDistrict)
-        city_dict_for_district_table = self.create_dictionary_for_district_table(RatuCity)
-        city_dict = self.create_dictionary_for_city_table(RatuCity)
-        citydistrict_dict = self.create_dictionary_for_citydistrict_table()
-        # getting values in json file Koatuu
-        for object_koatuu in data:
-            if object_koatuu[self.LEVEL_ONE] and not object_koatuu[self.LEVEL_TWO]:
-                object_region_name = self.get_lowercase_words_before_virgule(
-                    object_koatuu[self.OBJECT_NAME])
-            if object_koatuu[self.LEVEL_ONE] and object_koatuu[
-                self.LEVEL_TWO] and not object_koatuu[self.LEVEL_THREE]:
-                # koatuu_value is position in koatuu number wich defines district or city record
-                koatuu_value = str(object_koatuu[self.LEVEL_TWO])
-                object_district_name = self.get_lowercase_words_before_virgule(
-                    object_koatuu[self.OBJECT_NAME])
-                district_items_list = self.create_district_items_list(
-                    object_region_name, region_dict, object_district_name, koatuu_value)
-                city_items_list = self.create_city_items_list(
-                    city_dict_for_district_table, district_items_list, koatuu_value)
-            if object_koatuu[self.LEVEL_ONE] and object_koatuu[self.LEVEL_TWO] and object_koatuu[
-                self.LEVEL_THREE] and not object_koatuu[self.LEVEL_FOUR]:
-                object_city_name = self.get_lowercase_words_before_virgule(
-                    object_koatuu[self.OBJECT_NAME])
-                object_level_three = object_koatuu[self.LEVEL_THREE]
-                category_level_three = self.get_category_id(object_koatuu[self.CATEGORY])
-                self.save_to_city_or_citydistrict_table(
-                    object_level_three,
-                    object_city_name,
-                    district_items_list,
-                    district_dict,
-                    city_dict,
-                    category_level_three
-                )
-                self.save_to_city_or_citydistrict_table(
-                    object_level_three,
-                    object_city_name,
-                    city_items_list,
-                    city_dict,
-                    citydistrict_dict,
-                    category_level_three
-                )
-            if object_koatuu[self.LEVEL_ONE] and object_koatuu[self.LEVEL_TWO] and object_koatuu[
-                self.LEVEL_THREE] and not object_koatuu[self.LEVEL_FOUR]:
-                object_citydistrict_name = self.get_lowercase_words_before_virgule(
-                    object_koatuu[self.OBJECT_NAME])
-                object_level_four = object_koatuu[self.LEVEL_FOUR]
-                category_level_four = self.get_category_id(object_koatuu[self.CATEGORY])
-                self.save_to_city_or_citydistrict_table(
-                    object_level_four,
-                    object_citydistrict_name,
-                    district_items_list,
-                    district_dict,
-                    city_dict,
-                    category_level_four
-                )
-                self.save_to_city_or_citydistrict_table(
-                    object_level_four,
-                    object_citydistrict_name,
-                    city_items_list,
-                    city_dict,
-                    citydistrict_dict,
-                    category_level_four
-                )
-        logger.info("Koatuu values to city and citydistrict saved")
-
-    # writing entry to koatuu field in city and citydistrict table
-    def save_to_city_or_citydistrict_table(
-            self,
-            object_level_number,
-            object_level_name,
-            level_items_list,
-            up_level_dict,
-            level_dict,
-            category
-    ):
-        for object_name in level_items_list:
-            if object_name not in up_level_dict:
-                return
-            up_level_koatuu = up_level_dict[object_name]
-            if str(object_level_number)[:5] != str(up_level_koatuu.koatuu)[:5]:
-                return
-            object_level_name = object_level_name + str(up_level_koatuu.id)
-            if object_level_name not in level_dict:
-                return
-            level_koatuu = level_dict[object_level_name]
-            level_koatuu.koatuu = object_level_number
-            level_koatuu.category_id = category
-            level_koatuu.save()
-
-    # writing entry to category fields where koatuu is empty
-    def writing_category_null_id(self, table_model):
-        category = self.get_category_id('null')
-        table_model_objects = table_model.objects.filter(category_id__isnull=True)
-        for table_record in table_model_objects:
-            table_record.category_id = category
-            table_record.save()
+        self.regions_by_prefix[code[:self.REGION_PREFIX_LENGTH]] = region
+        self.assign('region', region, code)
+
+    def match_second_level(self, code, name, category):
+        region = self.regions_by_prefix.get(code[:self.REGION_PREFIX_LENGTH])
+        # the third digit 1 is for the cities of the region, others are for districts
+        if code[2] == '1':
+            level = 'city'
+            unit = region and self.cities_dict.get(
+                (region.id, None, clean_name(get_lowercase_substring_before_slash(name)))
+            )
+        else:
+            level = 'district'
+            unit = region and self.districts_dict.get(
+                (region.id, change_to_full_name(clean_name(get_lowercase_substring_before_slash(name))))
+            )
+        if not unit:
+            self.missed[level] += 1
+            return
+        self.second_level_by_prefix[code[:self.SECOND_LEVEL_PREFIX_LENGTH]] = unit
+        self.assign(level, unit, code, category if level == 'city' else None)
+
+    def match_settlement(self, code, name, category):
+        # cities of the districts and districts of the cities of the region, from the third and fourth levels
+        parent = self.second_level_by_prefix.get(code[:self.SECOND_LEVEL_PREFIX_LENGTH])
+        name = clean_name(get_lowercase_substring_before_slash(name))
+        if isinstance(parent, RatuDistrict):
+            level = 'city'
+            unit = self.cities_dict.get((parent.region_id, parent.id, name))
+        else:
+            level = 'citydistrict'
+            unit = parent and self.citydistricts_dict.get((parent.id, name))
+        if not unit:
+            self.missed[level] += 1
+            return
+        self.assign(level, unit, code, category)
+
+    def write_null_category(self):
+        # units without KOATUU get the category without code
+        null_category = self.categories.get(None)
+        if not null_category:
+            return
+        for unit in (*self.cities_dict.values(), *self.citydistricts_dict.values()):
+            if not unit.category_id:
+                unit.category_id = null_category.id
+                self.bulk_update_manager.add(unit, ['category'])
+
+    def commit(self):
+        # KOATUU codes are unique, so the codes of the changed objects and
+        # of the previous holders of the assigned codes are cleared first
+        cleared_ids = self.changed_ids
+        for units_dict in (self.regions_dict, self.districts_dict, self.cities_dict, self.citydistricts_dict):
+            for unit in units_dict.values():
+                holder = self.assigned[type(unit)].get(unit.koatuu)
+                if holder and holder is not unit:
+                    unit.koatuu = None
+                    cleared_ids[type(unit)].append(unit.id)
+        for model_class, ids in cleared_ids.items():
+            model_class.include_deleted_objects.filter(id__in=ids).update(koatuu=None)
+        self.bulk_update_manager.commit()
 
     # storing data to all tables
     def save_to_db(self, json_file):
         data = self.load_json(json_file)
-        try:
-            self.save_to_region_table(data)
-            self.save_to_district_table(data)
-            self.save_to_city_or_citydistrict(data)
-            self.writing_category_null_id(RatuCity)
-            self.writing_category_null_id(RatuCityDistrict)
-        except TypeError:
-            logger.exception('Tried to iterate NonType object')
-        else:
-            logger.info("Koatuu values saved")
+        # rows by the number of the filled levels, the parents are matched first
+        rows_by_depth = defaultdict(list)
+        for object_koatuu in data:
+            codes = [self.get_code(object_koatuu[level])
+                     for level in (self.LEVEL_ONE, self.LEVEL_TWO, self.LEVEL_THREE, self.LEVEL_FOUR)]
+            depth = next((index for index, code in enumerate(codes) if not code), len(codes))
+            if depth:
+                rows_by_depth[depth].append(
+                    (codes[depth - 1], object_koatuu[self.OBJECT_NAME], object_koatuu[self.CATEGORY])
+                )
+        for code, name, category_code in rows_by_depth[1]:
+            self.match_region(code, name)
+        for code, name, category_code in rows_by_depth[2]:
+            self.match_second_level(code, name, self.get_category(category_code))
+        for code, name, category_code in rows_by_depth[3] + rows_by_depth[4]:
+            self.match_settlement(code, name, self.get_category(category_code))
+        self.write_null_category()
+        with transaction.atomic():
+            self.commit()
+        for level in ('region', 'district', 'city', 'citydistrict'):
+            logger.info(f'KOATUU {level}: {self.matched[level]} matched, {self.missed[level]} missed')
+        logger.info("Koatuu values saved")
 
 
 class NewKoatuuConverter(Converter):
@@ -484,7 +401,9 @@ class KoatuuDownloader(Downloader):
         logger.info(f'{self.reg_name}: Update started...')
 
         self.report_init()
-        self.download()
+        if not self.download():
+            self.report_not_modified()
+            return
 
         self.report.update_start = timezone.now()
         self.report.save()
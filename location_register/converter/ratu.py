@@ -51,104 +51,100 @@ class RatuConverter(Converter):
             new_filename = 'ratu.xml'
         return new_filename
 
-    def save_or_get_region(self, name):
-        region_name = clean_name(name)
-        region_name = change_to_full_name(region_name)
-        if region_name not in self.all_regions_dict:
-            region = RatuRegion.objects.create(
-                name=region_name
-            )
-            self.all_regions_dict[region_name] = region
-            return region
-        return self.all_regions_dict[region_name]
-
-    def save_or_get_district(self, name, region):
-        district_name = clean_name(name)
-        district_name = change_to_full_name(district_name)
-        district_code = region.name + district_name
-        if district_code not in self.all_districts_dict:
-            district = RatuDistrict.objects.create(
-                region=region,
-                name=district_name,
-                code=district_code
-            )
-            self.all_districts_dict[district_code] = district
-            return district
-        else:
-            if self.outdated_districts_dict.get(district_code):
-                del self.outdated_districts_dict[district_code]
-        return self.all_districts_dict[district_code]
-
-    def save_or_get_city(self, name, region, district):
-        city_name = clean_name(name)
-        district_name = 'EMPTY' if not district else district.name
-        city_code = region.name + district_name + city_name
-        if city_code not in self.all_cities_dict:
-            city = RatuCity.objects.create(
-                region=region,
-                district=district,
-                name=city_name,
-                code=city_code
-            )
-            self.all_cities_dict[city_code] = city
-            return city
-        else:
-            if self.outdated_cities_dict.get(city_code):
-                del self.outdated_cities_dict[city_code]
-        return self.all_cities_dict[city_code]
-
-    def save_or_get_citydistrict(self, name, region, district, city):
-        citydistrict_name = clean_name(name)
-        citydistrict_code = region.name + city.name + citydistrict_name
-        if citydistrict_code not in self.all_citydistricts_dict:
-            citydistrict = RatuCityDistrict.objects.create(
-                region=region,
-                district=district,
-                city=city,
-                name=citydistrict_name,
-                code=citydistrict_code
-            )
-            self.all_citydistricts_dict[citydistrict_code] = citydistrict
-            return citydistrict
-        else:
-            if self.outdated_citydistricts_dict.get(citydistrict_code):
-                del self.outdated_citydistricts_dict[citydistrict_code]
-        return self.all_citydistricts_dict[citydistrict_code]
-
-    def save_street(self, name, region, district, city, citydistrict):
-        street_name = change_to_full_name(name)
-        # Saving streets that are located in Kyiv and Sevastopol that are regions
-        if not city:
-            city = self.save_or_get_city(region.name, region, district)
-        district_name = 'EMPTY' if not district else district.name
-        citydistrict_name = 'EMPTY' if not citydistrict else citydistrict.name
-        street_code = region.name + district_name + city.name + citydistrict_name + street_name
-        if street_code not in self.all_streets_dict:
-            street = RatuStreet.objects.create(
-                region=region,
-                district=district,
-                city=city,
-                citydistrict=citydistrict,
-                name=street_name,
-                code=street_code
-            )
-        else:
-            if self.outdated_streets_dict.get(street_code):
-                del self.outdated_streets_dict[street_code]
+    def save_level(self, model_class, all_objects_dict, outdated_dict, objects):
+        """
+        objects - {code: unsaved object} of one level of the hierarchy found in the chunk,
+        the missing ones are created by one bulk_create that sets ids of the objects,
+        so they can be linked by the next level
+        returns {code: saved object}
+        """
+        missing = {}
+        for code, obj in objects.items():
+            if code in all_objects_dict:
+                if outdated_dict is not None and outdated_dict.get(code):
+                    del outdated_dict[code]
+            else:
+                missing[code] = obj
+        if missing:
+            model_class.objects.bulk_create(missing.values())
+            all_objects_dict.update(missing)
+        return {code: all_objects_dict[code] for code in objects}
 
     def save_to_db(self, records):
+        rows = []
         for record in records:
-            region = self.save_or_get_region(record.xpath('OBL_NAME')[0].text)
-            district = (self.save_or_get_district(record.xpath('REGION_NAME')[0].text, region)
-                        if record.xpath('REGION_NAME')[0].text else None)
-            city = (self.save_or_get_city(record.xpath('CITY_NAME')[0].text, region, district)
-                    if record.xpath('CITY_NAME')[0].text else None)
-            citydistrict = (self.save_or_get_citydistrict(record.xpath('CITY_REGION_NAME')[0].text,
-                                                          region, district, city)
-                            if record.xpath('CITY_REGION_NAME')[0].text else None)
-            if record.xpath('STREET_NAME')[0].text:
-                self.save_street(record.xpath('STREET_NAME')[0].text, region, district,
-                                 city, citydistrict)
+            region_name = change_to_full_name(clean_name(record.findtext('OBL_NAME')))
+            district_name = record.findtext('REGION_NAME')
+            if district_name:
+                district_name = change_to_full_name(clean_name(district_name))
+            city_name = record.findtext('CITY_NAME')
+            if city_name:
+                city_name = clean_name(city_name)
+            street_name = record.findtext('STREET_NAME')
+            if street_name:
+                street_name = change_to_full_name(street_name)
+                # Saving streets that are located in Kyiv and Sevastopol that are regions
+                if not city_name:
+                    city_name = clean_name(region_name)
+            citydistrict_name = record.findtext('CITY_REGION_NAME')
+            if citydistrict_name:
+                citydistrict_name = clean_name(citydistrict_name)
+            rows.append((region_name, district_name or None, city_name or None,
+                         citydistrict_name or None, street_name or None))
+
+        # the hierarchy is saved level by level, each level by one bulk_create
+        regions = self.save_level(RatuRegion, self.all_regions_dict, None, {
+            region_name: RatuRegion(name=region_name) for region_name, *names in rows
+        })
+        districts = {}
+        for region_name, district_name, *names in rows:
+            if district_name:
+                districts[region_name + district_name] = RatuDistrict(
+                    region=regions[region_name],
+                    name=district_name,
+                    code=region_name + district_name
+                )
+        districts = self.save_level(RatuDistrict, self.all_districts_dict, self.outdated_districts_dict, districts)
+        cities = {}
+        for region_name, district_name, city_name, *names in rows:
+            if city_name:
+                city_code = region_name + (district_name or 'EMPTY') + city_name
+                cities[city_code] = RatuCity(
+                    region=regions[region_name],
+                    district=districts[region_name + district_name] if district_name else None,
+                    name=city_name,
+                    code=city_code
+                )
+        cities = self.save_level(RatuCity, self.all_cities_dict, self.outdated_cities_dict, cities)
+        citydistricts = {}
+        for region_name, district_name, city_name, citydistrict_name, street_name in rows:
+            citydistrict_code = citydistrict_name and region_name + city_name + citydistrict_name
+            # the code doesn't include the district, so the first district of the code is saved
+            if citydistrict_name and citydistrict_code not in citydistricts:
+                citydistricts[citydistrict_code] = RatuCityDistrict(
+                    region=regions[region_name],
+                    district=districts[region_name + district_name] if district_name else None,
+                    city=cities[region_name + (district_name or 'EMPTY') + city_name],
+                    name=citydistrict_name,
+                    code=citydistrict_code
+                )
+        citydistricts = self.save_level(RatuCityDistrict, self.all_citydistricts_dict,
+                                        self.outdated_citydistricts_dict, citydistricts)
+        streets = {}
+        for region_name, district_name, city_name, citydistrict_name, street_name in rows:
+            if street_name:
+                street_code = (region_name + (district_name or 'EMPTY') + city_name
+                               + (citydistrict_name or 'EMPTY') + street_name)
+                streets[street_code] = RatuStreet(
+                    region=regions[region_name],
+                    district=districts[region_name + district_name] if district_name else None,
+                    city=cities[region_name + (district_name or 'EMPTY') + city_name],
+                    citydistrict=(citydistricts[region_name + city_name + citydistrict_name]
+                                  if citydistrict_name else None),
+                    name=street_name,
+                    code=street_code
+                )
+        self.save_level(RatuStreet, self.all_streets_dict, self.outdated_streets_dict, streets)
 
     def delete_outdated(self):
         if self.outdated_districts_dict:
@@ -197,7 +193,9 @@ class RatuDownloader(Downloader):
         logger.info(f'{self.reg_name}: Update started...')
 
         self.report_init()
-        self.download()
+        if not self.download():
+            self.report_not_modified()
+            return
 
         self.report.update_start = timezone.now()
         self.report.save()
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.12 on 2026-10-18 21:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('location_register', '0024_auto_20210526_0845'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='drvbuilding',
+            name='last_seen_run',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -89,6 +89,8 @@ class DrvBuilding(DataOceanModel):
                                  verbose_name=_('ZIP code'))
     code = models.CharField(_('code'), max_length=20, unique=True)
     number = models.CharField(max_length=58)
+    # data_ocean.models.ImportRun that found the building in the source last time
+    last_seen_run = models.PositiveIntegerField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return self.number
@@ -1,3 +1,331 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
 from django.test import TestCase
+from lxml import etree
+
+from data_ocean.fetcher import RateLimiter
+from location_register.converter.drv import DrvConverter
+from location_register.models.drv_models import (DrvAto, DrvBuilding, DrvCouncil, DrvDistrict, DrvRegion,
+                                                 DrvStreet, ZipCode)
+
+
+def string_elements(*names):
+    return ''.join(f'<xs:element name="{name}" type="xs:string" minOccurs="0"/>' for name in names)
+
+
+BUILDS_ELEMENT = (
+    '<xs:element name="BUILDS" minOccurs="0"><xs:complexType><xs:sequence>'
+    '<xs:element name="BUILDS_COUNT" type="xs:int"/>'
+    '<xs:element name="BUILD" minOccurs="0" maxOccurs="unbounded"><xs:complexType><xs:sequence>'
+    + string_elements('Bld_ID', 'Bld_Num', 'Bld_Korp', 'Bld_Ind')
+    + '</xs:sequence></xs:complexType></xs:element>'
+    '</xs:sequence></xs:complexType></xs:element>'
+)
+# (service, operation, parameter, element of the result list, elements of the list item)
+DRV_SERVICES = (
+    ('GetRegionsService', 'GetRegions', None, 'Region',
+     string_elements('Region_Id', 'Region_Num', 'Region_Name', 'Region_Short', 'Region_Center')),
+    ('GetATUUService', 'ATUUQuery', 'ATOParams', 'ATO', string_elements('ATO_Id', 'ATO_Raj', 'ATO_Rad', 'ATO_Name')),
+    ('GetAdrRegService', 'AdrRegQuery', 'AdrRegParams', 'GEONIM',
+     string_elements('Geon_Id', 'Geon_Name', 'Geon_OldNames') + BUILDS_ELEMENT),
+)
+
+
+def get_drv_wsdl(url):
+    """ document/literal WSDL with the services of DRV, every one is answered by StubDrvHandler at url """
+    elements = []
+    definitions = []
+    for service, operation, parameter, item, item_elements in DRV_SERVICES:
+        elements.append(
+            f'<xs:element name="{operation}"><xs:complexType><xs:sequence>'
+            + (string_elements(parameter) if parameter else '')
+            + f'</xs:sequence></xs:complexType></xs:element>'
+            f'<xs:element name="{operation}Response"><xs:complexType><xs:sequence>'
+            f'<xs:element name="{item}" minOccurs="0" maxOccurs="unbounded"><xs:complexType><xs:sequence>'
+            f'{item_elements}</xs:sequence></xs:complexType></xs:element>'
+            # zeep returns the only child of a response instead of the response
+            f'{string_elements("Message")}'
+            f'</xs:sequence></xs:complexType></xs:element>'
+        )
+        definitions.append(
+            f'<message name="{operation}Input"><part name="parameters" element="tns:{operation}"/></message>'
+            f'<message name="{operation}Output"><part name="parameters" element="tns:{operation}Response"/></message>'
+            f'<portType name="{operation}Port"><operation name="{operation}">'
+            f'<input message="tns:{operation}Input"/><output message="tns:{operation}Output"/>'
+            f'</operation></portType>'
+            f'<binding name="{operation}Binding" type="tns:{operation}Port">'
+            f'<soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>'
+            f'<operation name="{operation}"><soap:operation soapAction="{operation}"/>'
+            f'<input><soap:body use="literal"/></input><output><soap:body use="literal"/></output>'
+            f'</operation></binding>'
+            f'<service name="{service}"><port name="{operation}Port" binding="tns:{operation}Binding">'
+            f'<soap:address location="{url}/{operation}"/></port></service>'
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+        'xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="http://drv.test/" targetNamespace="http://drv.test/">'
+        '<types><xs:schema targetNamespace="http://drv.test/" elementFormDefault="qualified">'
+        + ''.join(elements)
+        + '</xs:schema></types>'
+        + ''.join(definitions)
+        + '</definitions>'
+    )
+
+
+def to_element(name, value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ''.join(to_element(name, item) for item in value)
+    if isinstance(value, dict):
+        return f'<{name}>{"".join(to_element(key, item) for key, item in value.items())}</{name}>'
+    return f'<{name}>{escape(str(value))}</{name}>'
+
+
+def drv_regions():
+    return [{'Region_Id': code, 'Region_Num': code, 'Region_Name': f'Область {code}', 'Region_Short': f'О{code}'}
+            for code in (1, 2)]
+
+
+def drv_atos(region_code):
+    return [{'ATO_Id': region_code * 10 + number, 'ATO_Raj': f'Район {number}', 'ATO_Rad': 'Рада',
+             'ATO_Name': f'Село {region_code * 10 + number}'} for number in (1, 2)]
+
+
+def drv_streets(ato_code):
+    streets = []
+    for number in (1, 2):
+        code = ato_code * 10 + number
+        streets.append({
+            'Geon_Id': code, 'Geon_Name': f'вул. {code}', 'Geon_OldNames': None,
+            'BUILDS': {'BUILDS_COUNT': 2, 'BUILD': [
+                {'Bld_ID': code * 10 + building, 'Bld_Num': building, 'Bld_Korp': None, 'Bld_Ind': f'{ato_code:05d}'}
+                for building in (1, 2)
+            ]},
+        })
+    return streets
+
+
+class StubDrvHandler(BaseHTTPRequestHandler):
+    """
+    GET returns the WSDL, POST answers the SOAP calls of DRV_SERVICES.
+    The calls for later regions and ATOs are answered faster, so the results come out of order.
+    """
+    wsdl_requests = 0
+    calls = []
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.lock:
+            type(self).wsdl_requests += 1
+        self.send(get_drv_wsdl(f'http://127.0.0.1:{self.server.server_port}'))
+
+    def do_POST(self):
+        envelope = etree.fromstring(self.rfile.read(int(self.headers['Content-Length'])))
+        request = envelope.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')[0]
+        operation = etree.QName(request).localname
+        parameter = int(request[0].text) if len(request) else None
+        with self.lock:
+            type(self).calls.append((operation, parameter))
+        if operation == 'GetRegions':
+            items = to_element('Region', drv_regions())
+        elif operation == 'ATUUQuery':
+            time.sleep(0.1 / parameter)
+            items = to_element('ATO', drv_atos(parameter))
+        else:
+            time.sleep(0.1 / (parameter % 10))
+            items = to_element('GEONIM', drv_streets(parameter))
+        self.send(
+            '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>'
+            f'<{operation}Response xmlns="http://drv.test/">{items}<Message>OK</Message></{operation}Response>'
+            '</soap:Body></soap:Envelope>'
+        )
+
+
+class DrvServiceTestCase(TestCase):
+    def setUp(self):
+        StubDrvHandler.wsdl_requests = 0
+        StubDrvHandler.calls = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubDrvHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.converter = DrvConverter()
+        self.addCleanup(self.converter.transport.session.close)
+        self.converter.WSDL_URL = f'http://127.0.0.1:{self.server.server_port}/wsdl'
+        self.converter.rate_limiter = RateLimiter()
+
+    def test_fetch(self):
+        self.assertEqual([region['Region_Id'] for region in self.converter.parse_regions_data()], ['1', '2'])
+        regions = [DrvRegion(code=str(code)) for code in (1, 2)]
+        # the results are in the order of the items, though the later ones are answered first
+        atos = [(region.code, [ato['ATO_Id'] for ato in atos_data_list])
+                for region, atos_data_list in self.converter.fetch(self.converter.parse_atos_data, regions)]
+        self.assertEqual(atos, [('1', ['11', '12']), ('2', ['21', '22'])])
+        streets = [
+            (ato.code, [street['Geon_Id'] for street in streets_data_list])
+            for ato, streets_data_list in self.converter.fetch(
+                self.converter.parse_streets_data, [DrvAto(code=code) for code in ('11', '12', '21', '22')]
+            )
+        ]
+        self.assertEqual(streets, [('11', ['111', '112']), ('12', ['121', '122']),
+                                   ('21', ['211', '212']), ('22', ['221', '222'])])
+        # the clients of the services share the transport, so the WSDL is requested once
+        self.assertEqual(StubDrvHandler.wsdl_requests, 1)
+        self.assertEqual(len(self.converter.clients), 3)
+        for client in self.converter.clients.values():
+            self.assertIs(client.transport, self.converter.transport)
+
+    def test_process(self):
+        self.converter.process()
+        self.assertEqual(StubDrvHandler.calls[0], ('GetRegions', None))
+        self.assertEqual(sorted(StubDrvHandler.calls[1:3]), [('ATUUQuery', 1), ('ATUUQuery', 2)])
+        self.assertEqual(DrvRegion.objects.count(), 2)
+        self.assertEqual(
+            list(DrvAto.objects.order_by('code').values_list('code', 'region__code')),
+            [('11', '1'), ('12', '1'), ('21', '2'), ('22', '2')]
+        )
+        self.assertEqual(
+            list(DrvStreet.objects.order_by('code').values_list('code', 'ato__code', 'number_of_buildings')),
+            [(str(code), str(code // 10), 2) for code in (111, 112, 121, 122, 211, 212, 221, 222)]
+        )
+        self.assertEqual(DrvBuilding.objects.filter(last_seen_run=self.converter.import_run.id).count(), 16)
+        self.assertEqual(DrvBuilding.objects.get(code='1112').zip_code.code, '00011')
+        # nothing is changed in the source, so the streets are skipped by their fingerprints
+        converter = DrvConverter()
+        self.addCleanup(converter.transport.session.close)
+        converter.WSDL_URL = self.converter.WSDL_URL
+        converter.rate_limiter = RateLimiter()
+        converter.process()
+        self.assertEqual((converter.streets_skipped, converter.streets_changed), (8, 0))
+        self.assertEqual(DrvBuilding.objects.filter(last_seen_run=converter.import_run.id).count(), 16)
+
+
+class DrvConverterTestCase(TestCase):
+    def setUp(self):
+        self.region = DrvRegion.objects.create(code='1', number='1', name='область', short_name='о')
+        self.district = DrvDistrict.objects.create(region=self.region, name='район', code='область район')
+        self.council = DrvCouncil.objects.create(region=self.region, name='рада', code='область район рада')
+        self.ato = self.create_ato('11')
+        self.zip_code = ZipCode.objects.create(region=self.region, district=self.district, council=self.council,
+                                               ato=self.ato, code='00011')
+
+    def create_ato(self, code):
+        return DrvAto.objects.create(region=self.region, district=self.district, council=self.council,
+                                     name=f'село {code}', code=code)
+
+    def create_street(self, code, ato=None):
+        street = DrvStreet.objects.create(region=self.region, district=self.district, council=self.council,
+                                          ato=ato or self.ato, code=code, name=f'вул. {code}')
+        for number in (1, 2):
+            DrvBuilding.objects.create(region=self.region, district=self.district, council=self.council,
+                                       ato=street.ato, street=street, zip_code=self.zip_code,
+                                       code=f'{code}{number}', number=str(number))
+        return street
+
+    def get_street_data(self, code, zip_code='00011', name=None):
+        return {
+            'Geon_Id': code, 'Geon_Name': name or f'вул. {code}', 'Geon_OldNames': None,
+            'BUILDS': {'BUILDS_COUNT': 2, 'BUILD': [
+                {'Bld_ID': f'{code}{number}', 'Bld_Num': str(number), 'Bld_Korp': None, 'Bld_Ind': zip_code}
+                for number in (1, 2)
+            ]},
+        }
+
+    def get_converter(self):
+        converter = DrvConverter()
+        self.addCleanup(converter.transport.session.close)
+        converter.start_import_run()
+        return converter
+
+    def test_filter_changed_streets(self):
+        other_ato = self.create_ato('12')
+        streets = {code: self.create_street(code) for code in ('111', '112', '113', '114', '115')}
+        moved = self.create_street('116', other_ato)
+        streets_data = [self.get_street_data(code) for code in ('111', '112', '113', '114', '115', '116', '117')]
+        streets_data[1] = self.get_street_data('112', zip_code='00099')
+        # fingerprints of the previous update, the one of 113 points to another street
+        converter = self.get_converter()
+        converter.street_fingerprints.filter_changed(streets_data, lambda dictionary: dictionary['Geon_Id'])
+        for code, street in streets.items():
+            converter.street_fingerprints.add(code, street.id if code != '113' else moved.id)
+        converter.street_fingerprints.add('116', moved.id)
+        converter.street_fingerprints.commit()
+        # the street 114 is renamed, 117 is new
+        streets_data[3] = self.get_street_data('114', name='вул. нова')
+
+        converter = self.get_converter()
+        changed = converter.filter_changed_streets(streets_data, self.ato, ato_changed=False)
+        # the payloads of 112 (new zip code), 113 (another stored street) and 116 (moved to the ATO)
+        # are the same, but the stored rows are not
+        self.assertEqual([dictionary['Geon_Id'] for dictionary in changed], ['114', '117', '112', '113', '116'])
+        self.assertEqual((converter.streets_skipped, converter.streets_changed, converter.buildings_skipped),
+                         (2, 5, 4))
+        # buildings of the skipped streets are seen in the source
+        self.assertEqual(
+            set(DrvBuilding.objects.filter(last_seen_run=converter.import_run.id).values_list('street__code',
+                                                                                              flat=True)),
+            {'111', '115'}
+        )
+        self.assertNotIn('111', converter.outdated_streets_dict)
+        self.assertNotIn('115', converter.outdated_streets_dict)
+        self.assertIn('112', converter.outdated_streets_dict)
+        self.assertNotIn('00011', converter.outdated_zipcodes_dict)
+
+        # streets of a moved ATO are saved even with unchanged payloads
+        converter = self.get_converter()
+        changed = converter.filter_changed_streets(streets_data, self.ato, ato_changed=True)
+        self.assertEqual(len(changed), 7)
+        self.assertEqual(converter.streets_skipped, 0)
+        self.assertIn('111', converter.outdated_streets_dict)
+        self.assertIn('00011', converter.outdated_zipcodes_dict)
+
+    def test_save_building_data(self):
+        street = self.create_street('111')
+        DrvBuilding.objects.get(code='1112').soft_delete()
+        DrvBuilding.objects.filter(code='1111').update(updated_at='2020-01-01T00:00:00Z')
+        converter = self.get_converter()
+        unchanged = DrvBuilding.objects.get(code='1111')
+        self.assertEqual(converter.buildings_index['1111'],
+                         (unchanged.id, hash(converter.get_building_values(unchanged))))
+        # soft deleted buildings have no hash, so they are always updated
+        self.assertEqual(converter.buildings_index['1112'], (DrvBuilding.include_deleted_objects.get(code='1112').id,
+                                                             None))
+        buildings_data = self.get_street_data('111')['BUILDS']['BUILD']
+        buildings_data.append({'Bld_ID': '1113', 'Bld_Num': '3', 'Bld_Korp': 'А', 'Bld_Ind': '00011'})
+        converter.save_building_data(buildings_data, self.region, self.district, self.council, self.ato, street)
+        buildings = {building.code: building for building in DrvBuilding.include_deleted_objects.all()}
+        self.assertEqual(len(buildings), 3)
+        self.assertEqual(buildings['1113'].number, '3/А')
+        self.assertIsNone(buildings['1112'].deleted_at)
+        # the unchanged building is only stamped with the run
+        self.assertEqual(buildings['1111'].updated_at.year, 2020)
+        for building in buildings.values():
+            self.assertEqual(building.last_seen_run, converter.import_run.id)
+            self.assertEqual(converter.buildings_index[building.code],
+                             (building.id, hash(converter.get_building_values(building))))
 
-# Create your tests here.
+        # the number of the building is changed
+        buildings_data[0]['Bld_Korp'] = 'Б'
+        converter = self.get_converter()
+        converter.save_building_data(buildings_data, self.region, self.district, self.council, self.ato, street)
+        changed = DrvBuilding.objects.get(code='1111')
+        self.assertEqual(changed.number, '1/Б')
+        self.assertGreater(changed.updated_at.year, 2020)
+        self.assertEqual(converter.buildings_index['1111'], (changed.id, hash(converter.get_building_values(changed))))
+        self.assertEqual(DrvBuilding.objects.filter(last_seen_run=converter.import_run.id).count(), 3)